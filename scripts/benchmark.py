@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Measure the performance of the repository build tooling on synthetic
+recipe trees, without the real package tree or network access.
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    TypeVar,
+)
+from build import paths
+from build.compare import check_repo
+from build.index import Indexer
+from build.recipes import RecipeCache
+from build.repo import Repo
+from build.util import toltecmk_version
+from toltec import ipk  # type: ignore
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT  # type: ignore
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "-s",
+    "--sizes",
+    type=int,
+    nargs="+",
+    default=[100, 1000, 10000],
+    metavar="N",
+    help="numbers of recipes to benchmark with (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-p",
+    "--packages",
+    type=int,
+    default=2,
+    metavar="N",
+    help="number of packages defined by each recipe (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-a",
+    "--arches",
+    nargs="+",
+    default=["rmall"],
+    metavar="ARCH",
+    help="architectures of each recipe (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-g",
+    "--graph",
+    choices=("none", "chain", "star", "random"),
+    default="random",
+    help="""shape of the dependency graph between recipes: no dependencies,
+    a single chain, all recipes depending on the first one, or each recipe
+    depending on a few random earlier recipes (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "--remote-ratio",
+    type=float,
+    default=0.9,
+    metavar="RATIO",
+    help="""fraction of the packages that already exist on the fake remote
+    repository (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help="seed for generating random dependency graphs (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-o",
+    "--output",
+    metavar="PATH",
+    help="file where results are written as JSON (default: stdout)",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+logger = logging.getLogger(__name__)
+
+Result = TypeVar("Result")
+
+
+def generate_tree(recipe_dir: str, count: int, rand: random.Random) -> None:
+    """
+    Generate a synthetic tree of recipes.
+
+    :param recipe_dir: directory where the recipes are created
+    :param count: number of recipes to create
+    :param rand: source of randomness for the dependency graph
+    """
+    for index in range(count):
+        name = f"bench{index:05d}"
+
+        if args.graph == "chain":
+            deps = [index - 1] if index > 0 else []
+        elif args.graph == "star":
+            deps = [0] if index > 0 else []
+        elif args.graph == "random":
+            deps = sorted(set(rand.sample(range(index), min(index, 3))))
+        else:
+            deps = []
+
+        pkgnames = [name] + [
+            f"{name}-sub{sub}" for sub in range(1, args.packages)
+        ]
+        lines = [
+            "#!/usr/bin/env bash",
+            f"pkgnames=({' '.join(pkgnames)})",
+            f'pkgdesc="Synthetic recipe number {index}"',
+            "url=https://example.org",
+            "pkgver=1.0.0-1",
+            "timestamp=2021-01-01T00:00:00Z",
+            "section=utils",
+            'maintainer="Benchmark <benchmark@example.org>"',
+            "license=MIT",
+            f"archs=({' '.join(args.arches)})",
+            "makedepends=("
+            + " ".join(f"host:bench{dep:05d}" for dep in deps)
+            + ")",
+            "",
+        ]
+
+        if len(pkgnames) == 1:
+            lines += ["package() {", '    install -d "$pkgdir"/opt', "}"]
+        else:
+            for pkgname in pkgnames:
+                lines += [
+                    f"{pkgname}() {{",
+                    "    package() {",
+                    '        install -d "$pkgdir"/opt',
+                    "    }",
+                    "}",
+                ]
+
+        os.makedirs(os.path.join(recipe_dir, name))
+
+        with open(
+            os.path.join(recipe_dir, name, "package"), "w", encoding="utf-8"
+        ) as file:
+            file.write("\n".join(lines) + "\n")
+
+
+def generate_remote(repo: Repo, remote_dir: str, rand: random.Random) -> None:
+    """
+    Generate a fake remote repository containing part of the packages.
+
+    :param repo: repository whose packages should be published
+    :param remote_dir: directory where the packages and indexes are created
+    :param rand: source of randomness for choosing published packages
+    """
+    for package in repo.packages():
+        if rand.random() < args.remote_ratio:
+            path = os.path.join(remote_dir, package.filename())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, "wb") as file:
+                ipk.write(file, 0, package.control_fields(), {})
+
+    Indexer(remote_dir).update()
+
+
+@contextlib.contextmanager
+def serve(directory: str) -> Iterator[str]:
+    """
+    Serve a directory over HTTP on a local port.
+
+    :param directory: directory to serve
+    :returns: URL of the served directory
+    """
+
+    class Handler(SimpleHTTPRequestHandler):
+        """Serve files quietly."""
+
+        def log_message(self, *_: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(Handler, directory=directory)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def measure(
+    timings: Dict[str, float], name: str, function: Callable[[], Result]
+) -> Result:
+    """Time a function call and record its duration."""
+    logger.info("Running %s", name)
+    start = time.perf_counter()
+    result = function()
+    timings[name] = time.perf_counter() - start
+    logger.info("Finished %s in %.3f s", name, timings[name])
+    return result
+
+
+def run(count: int) -> Dict[str, float]:
+    """
+    Benchmark the build tooling on a synthetic tree.
+
+    :param count: number of recipes in the tree
+    :returns: duration of each benchmarked operation in seconds
+    """
+    rand = random.Random(args.seed)
+    timings: Dict[str, float] = {}
+
+    with tempfile.TemporaryDirectory(prefix="toltec-benchmark-") as root:
+        recipe_dir = os.path.join(root, "package")
+        repo_dir = os.path.join(root, "repo")
+        remote_dir = os.path.join(root, "remote")
+        cache = RecipeCache(os.path.join(root, "cache", "recipes"))
+        index_cache = os.path.join(root, "cache", "index.json")
+
+        logger.info("Generating %d recipes", count)
+        generate_tree(recipe_dir, count, rand)
+
+        repo = measure(timings, "parse", lambda: Repo(recipe_dir, repo_dir))
+        measure(
+            timings,
+            "parse_cache_cold",
+            lambda: Repo(recipe_dir, repo_dir, cache=cache),
+        )
+        measure(
+            timings,
+            "parse_cache_warm",
+            lambda: Repo(recipe_dir, repo_dir, cache=cache),
+        )
+
+        generate_remote(repo, remote_dir, rand)
+
+        with serve(remote_dir) as remote:
+            measure(
+                timings,
+                "plan_packages",
+                lambda: repo.fetch_packages(remote, plan_only=True),
+            )
+            measure(
+                timings, "fetch_packages", lambda: repo.fetch_packages(remote)
+            )
+            measure(
+                timings,
+                "order_dependencies",
+                lambda: repo.order_dependencies(
+                    list(repo.generic_recipes.values())
+                ),
+            )
+            measure(
+                timings,
+                "index_cold",
+                lambda: Indexer(repo_dir, index_cache).update(),
+            )
+            measure(
+                timings,
+                "index_warm",
+                lambda: Indexer(repo_dir, index_cache).update(),
+            )
+            measure(timings, "make_listing", repo.make_listing)
+            measure(
+                timings,
+                "compare_repo",
+                lambda: list(check_repo(repo_dir, remote)),
+            )
+
+    return timings
+
+
+def git_revision() -> str:
+    """Get the current revision of the Toltec repository, if known."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=paths.GIT_DIR,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+results: List[Dict[str, Any]] = []
+
+for size in args.sizes:
+    results.append({"recipes": size, "timings": run(size)})
+
+report = {
+    "revision": git_revision(),
+    "toltecmk": toltecmk_version(),
+    "python": platform.python_version(),
+    "cpus": os.cpu_count(),
+    "parameters": {
+        "packages": args.packages,
+        "arches": args.arches,
+        "graph": args.graph,
+        "remote_ratio": args.remote_ratio,
+        "seed": args.seed,
+    },
+    "results": results,
+}
+
+if args.output is not None:
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2)
+else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
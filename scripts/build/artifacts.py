@@ -0,0 +1,145 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Cache of built package archives, addressed by their build inputs."""
+
+import argparse
+import hashlib
+import logging
+import os
+from typing import (
+    Iterable,
+    List,
+    Optional,
+)
+
+from toltec.recipe import Package, Recipe  # type: ignore
+
+from . import paths
+from .cache import Cache
+from .util import link_or_copy, toltecmk_version, tree_digest
+
+logger = logging.getLogger(__name__)
+
+# Default maximum size of the artifact cache
+ARTIFACT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+
+class ArtifactCache(Cache):
+    """
+    Cache of package archives built from a recipe for a given arch.
+
+    Entries are keyed by everything that goes into a build: the contents of
+    the recipe directory (including its script and local sources), the
+    declared remote sources and their checksums, the Docker image, the
+    target arch and the version of toltecmk. Identical builds from different
+    channels or runs can thus share their archives.
+    """
+
+    def __init__(self, root: str, max_size: int = ARTIFACT_CACHE_SIZE) -> None:
+        super().__init__(root, max_size)
+
+    @staticmethod
+    def key(recipe: Recipe) -> str:
+        """
+        Compute the cache key of an arch version of a recipe.
+
+        :param recipe: recipe to compute the key of
+        :returns: cache key
+        """
+        sha256 = hashlib.sha256()
+
+        for part in (
+            toltecmk_version(),
+            tree_digest(recipe.path),
+            *sorted(
+                f"{source.url} {source.checksum}" for source in recipe.sources
+            ),
+            recipe.image,
+            recipe.arch,
+        ):
+            sha256.update(part.encode() + b"\0")
+
+        return sha256.hexdigest()
+
+    def restore(
+        self, key: str, packages: Iterable[Package], dist_dir: str
+    ) -> bool:
+        """
+        Restore previously built archives into a repository.
+
+        :param key: cache key of the recipe that builds the archives
+        :param packages: packages whose archives should be restored
+        :param dist_dir: repository where archives should be placed
+        :returns: true if all the requested archives were restored
+        """
+        entry = self.lookup(key)
+
+        if entry is None:
+            return False
+
+        packages = list(packages)
+        sources = [
+            os.path.join(entry, os.path.basename(package.filename()))
+            for package in packages
+        ]
+
+        if not all(os.path.isfile(source) for source in sources):
+            # Drop the incomplete entry so that it can be saved again
+            self.invalidate(key)
+            return False
+
+        for package, source in zip(packages, sources):
+            dest = os.path.join(dist_dir, package.filename())
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            link_or_copy(source, dest)
+            logger.info("Restored %s from cache", package.filename())
+
+        return True
+
+    def save(
+        self, key: str, packages: Iterable[Package], dist_dir: str
+    ) -> None:
+        """
+        Save newly built archives to the cache.
+
+        :param key: cache key of the recipe that built the archives
+        :param packages: packages whose archives should be saved
+        :param dist_dir: repository where the archives were built
+        """
+        archives: List[str] = [
+            os.path.join(dist_dir, package.filename()) for package in packages
+        ]
+
+        def populate(path: str) -> None:
+            for archive in archives:
+                link_or_copy(
+                    archive, os.path.join(path, os.path.basename(archive))
+                )
+
+        self.store(key, populate)
+
+
+def add_artifact_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add CLI options for controlling the artifact cache."""
+    parser.add_argument(
+        "--artifact-cache",
+        default=paths.ARTIFACT_CACHE_DIR,
+        metavar="DIR",
+        help="""directory where built archives are cached and reused when the
+        inputs of a build are unchanged, which can be shared between
+        channels (default: %(default)s)""",
+    )
+
+    parser.add_argument(
+        "--no-artifact-cache",
+        action="store_true",
+        help="always build archives instead of reusing cached ones",
+    )
+
+
+def open_artifact_cache(args: argparse.Namespace) -> Optional[ArtifactCache]:
+    """Open the artifact cache selected by the CLI options, if any."""
+    if args.no_artifact_cache:
+        return None
+
+    return ArtifactCache(args.artifact_cache)
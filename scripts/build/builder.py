@@ -0,0 +1,282 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Build recipes and create packages."""
+
+import argparse
+import contextlib
+import dataclasses
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    ContextManager,
+    List,
+    Mapping,
+    Optional,
+)
+
+from toltec import builder, util  # type: ignore
+from toltec.recipe import Package, Recipe, RecipeBundle  # type: ignore
+from toltec.util import auto_extract  # type: ignore
+
+from . import trace
+from .artifacts import ArtifactCache
+from .resources import LimitedDockerClient, ResourceHints, UsageMonitor
+from .sources import SourceCache
+from .stats import BuildStats
+
+logger = logging.getLogger(__name__)
+
+
+# pylint: disable-next=too-few-public-methods,too-many-instance-attributes
+class Builder(builder.Builder):
+    """
+    Helper class for building recipes.
+
+    Package archives are written under a temporary name and then moved into
+    place, so that concurrent builds and index generation never see a
+    partially written archive.
+
+    The architectures of a recipe can be built concurrently. Each of them
+    uses its own work directory and build container.
+    """
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        work_dir: str,
+        dist_dir: str,
+        stats: Optional[BuildStats] = None,
+        artifacts: Optional[ArtifactCache] = None,
+        sources: Optional[SourceCache] = None,
+        arch_jobs: int = 1,
+        containers: Optional[threading.Semaphore] = None,
+        resources: Optional[ResourceHints] = None,
+        limit_cpus: bool = False,
+    ) -> None:
+        """
+        Create a builder helper.
+
+        :param work_dir: directory where packages are built
+        :param dist_dir: directory where built packages are stored
+        :param stats: if not None, record the duration of each successful
+            arch build into this store
+        :param artifacts: if not None, restore archives from this cache
+            instead of building them when the build inputs are unchanged,
+            and save newly built archives to it
+        :param sources: if not None, get remote source files with a known
+            checksum from this cache, downloading them only when missing
+        :param arch_jobs: maximum number of architectures of a recipe to
+            build concurrently
+        :param containers: if not None, acquire this semaphore while running
+            each arch build, to cap the number of concurrent build containers
+            across builders
+        :param resources: if not None, record the resources used by the
+            containers of each successful arch build into this store
+        :param limit_cpus: if true, limit the CPU usage of the containers of
+            each arch build to its expected usage from :param:`resources`
+        """
+        super().__init__(work_dir, dist_dir)
+        self.stats = stats
+        self.artifacts = artifacts
+        self.sources = sources
+        self.arch_jobs = max(arch_jobs, 1)
+        self.containers = containers
+        self.resources = resources
+        self.limit_cpus = limit_cpus
+
+        if resources is not None:
+            self.docker = LimitedDockerClient(self.docker)
+
+    def __enter__(self) -> "Builder":
+        return self
+
+    def make(
+        self,
+        recipe_bundle: RecipeBundle,
+        build_matrix: Optional[Mapping[str, Optional[List[Package]]]] = None,
+        check_directory: bool = True,
+    ) -> bool:
+        arches = list(
+            build_matrix.keys() if build_matrix is not None else recipe_bundle
+        )
+
+        if self.arch_jobs == 1 or len(arches) <= 1:
+            return super().make(recipe_bundle, build_matrix, check_directory)
+
+        if check_directory and not util.check_directory(
+            self.work_dir,
+            f"The build directory '{self.work_dir}' \
+already exists.\nWould you like to [c]ancel, [r]emove that directory, \
+or [k]eep it (not recommended)?",
+        ):
+            return False
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        os.makedirs(self.dist_dir, exist_ok=True)
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.arch_jobs, len(arches))
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self._make_arch,
+                    recipe_bundle[arch],
+                    os.path.join(self.work_dir, arch),
+                    build_matrix[arch] if build_matrix is not None else None,
+                )
+                for arch in arches
+            ]
+
+            try:
+                for future in futures:
+                    if not future.result():
+                        return False
+            finally:
+                # Do not start other arches after a failure
+                for future in futures:
+                    future.cancel()
+
+        return True
+
+    def _make_arch(
+        self,
+        recipe: Recipe,
+        build_dir: str,
+        packages: Optional[List[Package]] = None,
+    ) -> bool:
+        with trace.span(
+            f"build {os.path.basename(recipe.path)} ({recipe.arch})",
+            "recipe",
+            recipe=os.path.basename(recipe.path),
+            arch=recipe.arch,
+        ):
+            return self._make_arch_cached(recipe, build_dir, packages)
+
+    def _make_arch_cached(
+        self,
+        recipe: Recipe,
+        build_dir: str,
+        packages: Optional[List[Package]],
+    ) -> bool:
+        """Build an arch of a recipe, reusing cached archives if possible."""
+        selected = (
+            packages if packages is not None else list(recipe.packages.values())
+        )
+
+        # Compute the key before hooks get a chance to modify the recipe
+        key = self.artifacts.key(recipe) if self.artifacts is not None else ""
+
+        if self.artifacts is not None and self.artifacts.restore(
+            key, selected, self.dist_dir
+        ):
+            return True
+
+        name = os.path.basename(recipe.path)
+
+        with (
+            self.containers or contextlib.nullcontext(),
+            self._monitor(recipe) as monitor,
+        ):
+            start = time.monotonic()
+            result = super()._make_arch(recipe, build_dir, packages)
+
+        if result and self.stats is not None:
+            self.stats.record(name, recipe.arch, time.monotonic() - start)
+
+        if result and self.resources is not None and monitor is not None:
+            usage = monitor.usage()
+
+            if usage is not None:
+                self.resources.record(name, recipe.arch, usage)
+
+        if result and self.artifacts is not None:
+            self.artifacts.save(key, selected, self.dist_dir)
+
+        return result
+
+    def _monitor(
+        self, recipe: Recipe
+    ) -> ContextManager[Optional[UsageMonitor]]:
+        """Limit and monitor the containers of an arch build, if enabled."""
+        if self.resources is None:
+            return contextlib.nullcontext()
+
+        expected = (
+            self.resources.get(os.path.basename(recipe.path), recipe.arch)
+            if self.limit_cpus
+            else None
+        )
+        return self.docker.limit(
+            expected.cpus if expected is not None else None
+        )
+
+    @staticmethod
+    def _archive(package: Package, pkg_dir: str, ar_path: str) -> None:
+        temp_path = os.path.join(
+            os.path.dirname(ar_path), "." + os.path.basename(ar_path) + ".part"
+        )
+        builder.Builder._archive(  # pylint:disable=protected-access
+            package, pkg_dir, temp_path
+        )
+        os.replace(temp_path, ar_path)
+
+    def _fetch_sources(self, recipe: Recipe, src_dir: str) -> None:
+        if self.sources is None:
+            super()._fetch_sources(recipe, src_dir)
+            return
+
+        cached = {
+            source
+            for source in recipe.sources
+            if self.sources.cacheable(source)
+        }
+        super()._fetch_sources(
+            dataclasses.replace(recipe, sources=recipe.sources - cached),
+            src_dir,
+        )
+
+        for source in cached:
+            local_path = os.path.join(src_dir, os.path.basename(source.url))
+
+            # Copy rather than link, since build scripts may alter sources
+            shutil.copyfile(self.sources.fetch(source), local_path)
+
+            if not source.noextract:
+                if not auto_extract(local_path, src_dir):
+                    logger.debug(
+                        "Not extracting %s (unsupported archive type)",
+                        local_path,
+                    )
+
+
+def add_builder_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add CLI options for controlling concurrent arch builds."""
+    parser.add_argument(
+        "--arch-jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="""maximum number of architectures of a recipe to build
+        concurrently (default: %(default)s)""",
+    )
+
+    parser.add_argument(
+        "--max-containers",
+        type=int,
+        metavar="N",
+        help="""maximum number of build containers to run at the same time
+        across all recipes (default: no limit)""",
+    )
+
+
+def open_container_limit(
+    args: argparse.Namespace,
+) -> Optional[threading.Semaphore]:
+    """Create the container limit selected by the CLI options, if any."""
+    if args.max_containers is None:
+        return None
+
+    return threading.BoundedSemaphore(max(args.max_containers, 1))
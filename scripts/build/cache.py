@@ -0,0 +1,224 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Size-bounded on-disk caches."""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import (
+    Callable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Cache:
+    """
+    Directory of cache entries addressed by a key.
+
+    Each entry is a directory that can hold any number of files. Entries are
+    created atomically and evicted in least-recently-used order when the
+    total size of the cache exceeds its limit. Entries that were returned
+    since the cache was opened are never evicted, since they may still be
+    in use.
+    """
+
+    def __init__(self, root: str, max_size: int) -> None:
+        """
+        Open a cache directory, creating it if needed.
+
+        :param root: directory where the cache entries are stored
+        :param max_size: maximum total size of the entries, in bytes
+        """
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        # Keys of the entries returned since the cache was opened
+        self._used: Set[str] = set()
+        # Total size of the entries, only measured when first needed and
+        # then updated as entries are stored
+        self._size: Optional[int] = None
+        # Set when only entries in use are left to evict, in which case
+        # nothing can be evicted until the cache is opened again
+        self._pinned = False
+
+    def path(self, key: str) -> str:
+        """Get the path to the directory of an entry."""
+        return os.path.join(self.root, key[:2], key)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        Find an entry in the cache and mark it as recently used.
+
+        :param key: key of the entry to find
+        :returns: path to the entry directory, or None if absent
+        """
+        path = self.path(key)
+
+        with self._lock:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+
+            self._used.add(key)
+
+        return path
+
+    def store(self, key: str, populate: Callable[[str], None]) -> str:
+        """
+        Create an entry in the cache.
+
+        Since entries are addressed by their contents, an existing entry is
+        kept rather than replaced, as it may be in use by another thread.
+
+        :param key: key of the entry to create
+        :param populate: callback that receives a temporary directory and
+            fills it with the files of the entry
+        :returns: path to the entry directory
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=".")
+
+        try:
+            populate(temp_path)
+            size = _tree_size(temp_path)
+
+            with self._lock:
+                self._used.add(key)
+
+                try:
+                    os.rename(temp_path, path)
+                except OSError:
+                    # The entry already exists, for example because another
+                    # thread or process stored it concurrently
+                    if not os.path.isdir(path):
+                        raise
+
+                    shutil.rmtree(temp_path)
+                    size = 0
+
+                if self._size is None:
+                    self._size = sum(size for _, _, size in self._entries())
+                else:
+                    self._size += size
+
+                if self._size > self.max_size and not self._pinned:
+                    self._evict()
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+        return path
+
+    def read(self, key: str, name: str) -> Optional[bytes]:
+        """
+        Read a file from an entry of the cache.
+
+        :param key: key of the entry to read from
+        :param name: name of the file inside the entry
+        :returns: contents of the file, or None if absent
+        """
+        path = self.lookup(key)
+
+        if path is None:
+            return None
+
+        try:
+            with open(os.path.join(path, name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key: str, name: str, data: bytes) -> None:
+        """
+        Create an entry of the cache made of a single file.
+
+        :param key: key of the entry to create
+        :param name: name of the file inside the entry
+        :param data: contents of the file
+        """
+
+        def populate(path: str) -> None:
+            with open(os.path.join(path, name), "wb") as file:
+                file.write(data)
+
+        self.store(key, populate)
+
+    def invalidate(self, key: str) -> None:
+        """Remove an entry from the cache, if it exists."""
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def clear(self) -> None:
+        """Remove all the entries from the cache."""
+        with self._lock:
+            for key, _, _ in self._entries():
+                self.invalidate(key)
+
+            self._used.clear()
+            self._size = 0
+            self._pinned = False
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Remove least recently used entries, with the lock held."""
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+
+        for key, _, size in sorted(entries, key=lambda entry: entry[1]):
+            if total <= self.max_size:
+                break
+
+            if key in self._used:
+                continue
+
+            logger.debug("Evicting cache entry %s", key)
+            self.invalidate(key)
+            total -= size
+
+        if total > self.max_size:
+            logger.debug(
+                "Cache %s exceeds its limit with entries in use", self.root
+            )
+            self._pinned = True
+
+        self._size = total
+
+    def _entries(self) -> List[Tuple[str, float, int]]:
+        """List the key, last use time and size of each entry."""
+        entries = []
+
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+
+            for entry in os.scandir(prefix.path):
+                if entry.name[0] == "." or not entry.is_dir():
+                    continue
+
+                entries.append(
+                    (entry.name, entry.stat().st_mtime, _tree_size(entry.path))
+                )
+
+        return entries
+
+
+def _tree_size(path: str) -> int:
+    """Compute the total size of the files in a directory."""
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(path)
+        for filename in filenames
+    )
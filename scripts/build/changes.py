@@ -0,0 +1,70 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Find which recipes are affected by changes to the Toltec repository."""
+
+import logging
+import os
+import subprocess
+from typing import List, Optional
+
+from . import paths
+
+logger = logging.getLogger(__name__)
+
+
+def changed_paths(rev_range: str, git_dir: str = paths.GIT_DIR) -> List[str]:
+    """
+    List the files changed in a range of Git revisions.
+
+    :param rev_range: revision range, such as `origin/testing...HEAD`,
+        or a single revision to compare the working tree against
+    :param git_dir: root of the Git repository
+    :returns: changed paths relative to the repository root
+    :raises subprocess.CalledProcessError: if Git fails
+    """
+    output = subprocess.run(
+        ["git", "diff", "--name-only", "--no-renames", "-z", rev_range, "--"],
+        cwd=git_dir,
+        check=True,
+        capture_output=True,
+    ).stdout.decode()
+    return [path for path in output.split("\0") if path]
+
+
+def changed_recipes(
+    changed: List[str],
+    recipe_dir: str = paths.RECIPE_DIR,
+    git_dir: str = paths.GIT_DIR,
+) -> Optional[List[str]]:
+    """
+    Map a list of changed files to the recipes that they affect directly.
+
+    Changes to a recipe directory affect that recipe only, while changes to
+    the build scripts may affect any recipe.
+
+    :param changed: changed paths relative to the repository root
+    :param recipe_dir: directory where recipe definitions are stored
+    :param git_dir: root of the Git repository
+    :returns: sorted names of the recipes whose definition changed and that
+        still exist, or None if all recipes are affected
+    """
+    recipe_prefix = os.path.relpath(recipe_dir, git_dir) + "/"
+    scripts_prefix = os.path.relpath(paths.SCRIPTS_DIR, git_dir) + "/"
+    names = set()
+
+    for path in changed:
+        if path.startswith(scripts_prefix):
+            logger.info(
+                "Build scripts changed in %s, affecting all recipes", path
+            )
+            return None
+
+        if path.startswith(recipe_prefix):
+            parts = path[len(recipe_prefix) :].split("/")
+
+            if len(parts) > 1 and os.path.isfile(
+                os.path.join(recipe_dir, parts[0], "package")
+            ):
+                names.add(parts[0])
+
+    return sorted(names)
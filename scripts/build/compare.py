@@ -0,0 +1,395 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Compare the contents of files, nested archives and repositories."""
+
+import difflib
+import hashlib
+import io
+import logging
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from enum import auto
+from enum import Enum
+from typing import (
+    IO,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import requests
+from toltec.util import file_sha256  # type: ignore
+
+from . import trace
+from .remote import (
+    CHUNK_SIZE,
+    DEFAULT_JOBS,
+    TIMEOUT,
+    RemoteIndex,
+    fetch_index,
+    make_session,
+)
+
+logger = logging.getLogger(__name__)
+
+# Maximum size of an archive member that is compared as text
+MAX_TEXT_SIZE = 1024 * 1024
+
+
+def _is_tarfile(file: IO[bytes]) -> bool:
+    """Check if a seekable file is a (possibly compressed) tar archive."""
+    try:
+        file.seek(0)
+        return tarfile.is_tarfile(file)
+    except (tarfile.TarError, OSError, EOFError):
+        return False
+    finally:
+        file.seek(0)
+
+
+def _diff_lines(  # pylint:disable=too-many-arguments
+    lines1: List[str],
+    lines2: List[str],
+    label1: str,
+    label2: str,
+    unified: bool,
+) -> str:
+    """
+    Describe the differences between two sequences of lines.
+
+    :param lines1: lines of the first file, without line endings
+    :param lines2: lines of the second file, without line endings
+    :param label1: name of the first file in unified diffs
+    :param label2: name of the second file in unified diffs
+    :param unified: if true, produce a unified diff, otherwise produce the
+        default output format of diff(1)
+    :returns: differences, one line per line
+    """
+    if unified:
+        return "\n".join(
+            difflib.unified_diff(
+                lines1, lines2, fromfile=label1, tofile=label2, lineterm=""
+            )
+        )
+
+    def span(start: int, end: int) -> str:
+        return str(start + 1) if end - start == 1 else f"{start + 1},{end}"
+
+    output = []
+    matcher = difflib.SequenceMatcher(None, lines1, lines2, autojunk=False)
+
+    for tag, start1, end1, start2, end2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+
+        if tag == "insert":
+            output.append(f"{start1}a{span(start2, end2)}")
+        elif tag == "delete":
+            output.append(f"{span(start1, end1)}d{start2}")
+        else:
+            output.append(f"{span(start1, end1)}c{span(start2, end2)}")
+
+        output.extend("< " + line for line in lines1[start1:end1])
+
+        if tag == "replace":
+            output.append("---")
+
+        output.extend("> " + line for line in lines2[start2:end2])
+
+    return "\n".join(output)
+
+
+def _diff_text(  # pylint:disable=too-many-arguments
+    file1: IO[bytes],
+    file2: IO[bytes],
+    label1: str,
+    label2: str,
+    unified: bool,
+) -> List[str]:
+    """Describe the differences between two non-archive files."""
+    if max(file1.seek(0, io.SEEK_END), file2.seek(0, io.SEEK_END)) <= (
+        MAX_TEXT_SIZE
+    ):
+        file1.seek(0)
+        file2.seek(0)
+
+        try:
+            text1 = file1.read().decode()
+            text2 = file2.read().decode()
+        except UnicodeDecodeError:
+            pass
+        else:
+            if "\0" in text1 or "\0" in text2:
+                return [f"Binary files {label1} and {label2} differ"]
+
+            diff = _diff_lines(
+                text1.splitlines(), text2.splitlines(), label1, label2, unified
+            )
+            return [f"Files {label1} and {label2} differ:\n{diff}"]
+
+    return [f"Binary files {label1} and {label2} differ"]
+
+
+def _diff_archives(  # pylint:disable=too-many-arguments
+    file1: IO[bytes],
+    file2: IO[bytes],
+    label1: str,
+    label2: str,
+    unified: bool,
+) -> List[str]:
+    """Describe the differences between two tar archives."""
+    with (
+        tarfile.open(fileobj=file1, mode="r:*") as archive1,
+        tarfile.open(fileobj=file2, mode="r:*") as archive2,
+    ):
+        names1 = archive1.getnames()
+        names2 = archive2.getnames()
+
+        if names1 != names2:
+            diff = _diff_lines(names1, names2, label1, label2, unified)
+            return [
+                f"Archives {label1} and {label2} contain different files:\n"
+                + diff
+            ]
+
+        differences = []
+
+        # Members are visited in archive order so that compressed archives
+        # are only decompressed once
+        for member1, member2 in zip(
+            archive1.getmembers(), archive2.getmembers()
+        ):
+            if not member1.isfile() or not member2.isfile():
+                continue
+
+            content1 = archive1.extractfile(member1)
+            content2 = archive2.extractfile(member2)
+            assert content1 is not None and content2 is not None
+
+            with content1, content2:
+                differences.extend(
+                    compare(
+                        content1,
+                        content2,
+                        f"{label1} -> {member1.name}",
+                        f"{label2} -> {member2.name}",
+                        unified,
+                    )
+                )
+
+        return differences
+
+
+def compare(  # pylint:disable=too-many-arguments
+    file1: IO[bytes],
+    file2: IO[bytes],
+    label1: str,
+    label2: str,
+    unified: bool = False,
+) -> List[str]:
+    """
+    Compare two files, recursing into archives.
+
+    Archives whose bytes differ are streamed and compared member by member
+    without being extracted, so that differences can be reported in the
+    innermost file that changed.
+
+    :param file1: first seekable file to compare
+    :param file2: second seekable file to compare
+    :param label1: name used to refer to the first file in reports
+    :param label2: name used to refer to the second file in reports
+    :param unified: if true, describe the differences between text files
+        as unified diffs instead of the default output format of diff(1)
+    :returns: human-readable descriptions of the differences, which is
+        empty if the files are identical
+    """
+    file1.seek(0)
+    file2.seek(0)
+    data_equal = True
+
+    while data_equal:
+        chunk1 = file1.read(io.DEFAULT_BUFFER_SIZE)
+        chunk2 = file2.read(io.DEFAULT_BUFFER_SIZE)
+        data_equal = chunk1 == chunk2
+
+        if not chunk1 and not chunk2:
+            return []
+
+    if _is_tarfile(file1) and _is_tarfile(file2):
+        try:
+            return _diff_archives(file1, file2, label1, label2, unified)
+        except (tarfile.TarError, OSError, EOFError):
+            # Fall back to comparing the raw bytes of corrupted archives
+            pass
+
+    return _diff_text(file1, file2, label1, label2, unified)
+
+
+class FileStatus(Enum):
+    """Possible outcomes of comparing a local file to its remote copy."""
+
+    # pylint: disable=invalid-name
+
+    # Both copies are identical
+    Identical = auto()
+
+    # Both copies exist but differ
+    Different = auto()
+
+    # The file does not exist on the remote repository
+    MissingRemote = auto()
+
+    # The remote copy could not be downloaded
+    Error = auto()
+
+    # pylint: enable=invalid-name
+
+
+class FileReport(NamedTuple):
+    """Result of comparing a local file to its remote copy."""
+
+    # Path of the file relative to the repository root
+    path: str
+
+    # Outcome of the comparison
+    status: FileStatus
+
+    # Human-readable descriptions of the differences
+    differences: List[str]
+
+
+def _download(
+    session: requests.Session, url: str
+) -> Optional[Tuple[io.BytesIO, str]]:
+    """
+    Download a remote file to memory.
+
+    :returns: contents and SHA-256 checksum of the file, or None if it does
+        not exist
+    :raises requests.RequestException: if the file cannot be downloaded
+    """
+    contents = io.BytesIO()
+    sha256 = hashlib.sha256()
+
+    with session.get(url, timeout=TIMEOUT, stream=True) as req:
+        if req.status_code == 404:
+            return None
+
+        req.raise_for_status()
+
+        for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+            trace.add_bytes(len(chunk))
+            sha256.update(chunk)
+            contents.write(chunk)
+
+    return contents, sha256.hexdigest()
+
+
+def _check_file(  # pylint:disable=too-many-arguments,too-many-locals
+    path: str,
+    local_repo: str,
+    remote: str,
+    session: requests.Session,
+    index: RemoteIndex,
+    unified: bool,
+) -> FileReport:
+    """Compare a file of a local repository to its remote copy."""
+    local_path = os.path.join(local_repo, path)
+    local_size = os.path.getsize(local_path)
+    local_sha256 = file_sha256(local_path)
+    entry = index.get(path)
+
+    # Packages listed in the remote indexes do not need to be downloaded
+    # if their size and checksum match
+    if entry is not None and (entry.size, entry.sha256) == (
+        local_size,
+        local_sha256,
+    ):
+        return FileReport(path, FileStatus.Identical, [])
+
+    try:
+        fetched = _download(session, f"{remote}/{path}")
+    except requests.RequestException as err:
+        return FileReport(
+            path, FileStatus.Error, [f"Unable to fetch remote {path}: {err}"]
+        )
+
+    if fetched is None:
+        return FileReport(
+            path,
+            FileStatus.MissingRemote,
+            [f"File {path} is missing from the remote repository"],
+        )
+
+    remote_file, remote_sha256 = fetched
+
+    if (remote_file.tell(), remote_sha256) == (local_size, local_sha256):
+        return FileReport(path, FileStatus.Identical, [])
+
+    with open(local_path, "rb") as local_file:
+        differences = compare(
+            local_file,
+            remote_file,
+            f"local {path}",
+            f"remote {path}",
+            unified,
+        )
+
+    return FileReport(
+        path,
+        FileStatus.Different if differences else FileStatus.Identical,
+        differences,
+    )
+
+
+def check_repo(
+    local_repo: str,
+    remote: str,
+    jobs: int = DEFAULT_JOBS,
+    unified: bool = False,
+) -> Iterator[FileReport]:
+    """
+    Compare all the files of a local repository to a remote repository.
+
+    Remote files are downloaded concurrently and compared by size and
+    checksum first. Archives that differ are then compared member by member
+    to pinpoint the differences.
+
+    :param local_repo: root of the local repository
+    :param remote: root of the remote repository
+    :param jobs: maximum number of concurrent requests to the remote
+    :param unified: describe differences between text files as unified
+        diffs, see :func:`compare`
+    :returns: report for each local file, in path order
+    """
+    files = sorted(
+        os.path.relpath(os.path.join(dirpath, filename), local_repo)
+        for dirpath, _, filenames in os.walk(local_repo)
+        for filename in filenames
+    )
+    arches = [
+        os.path.dirname(path)
+        for path in files
+        if os.path.basename(path) == "Packages" and os.path.dirname(path)
+    ]
+
+    with (
+        make_session(jobs) as session,
+        ThreadPoolExecutor(max_workers=jobs) as executor,
+    ):
+        index: RemoteIndex = {}
+
+        try:
+            index = fetch_index(session, remote, arches)
+        except requests.RequestException as err:
+            logger.warning("Unable to fetch remote indexes: %s", err)
+
+        yield from executor.map(
+            lambda path: _check_file(
+                path, local_repo, remote, session, index, unified
+            ),
+            files,
+        )
@@ -0,0 +1,506 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Create delta archives between consecutive versions of packages.
+
+A delta archive lets devices that have the previous version of a package
+rebuild the new version while only downloading the files that changed.
+It contains the control sub-archive of the new package, the header of
+each member of its data sub-archive, the contents of the members that
+are not in the previous version, and the name of the base member holding
+the contents of the others. Since packages are written reproducibly, the
+new archive is then rebuilt byte for byte by writing those members again.
+
+Deltas are listed in a `deltas.json` sidecar index next to the `Packages`
+index of each architecture, and only kept when they are verified to
+rebuild the exact new package and are smaller than it.
+
+Rebuilding packages relies on private helpers of the toltecmk package
+writer, so deltas are only created with the toltecmk versions that they
+were checked against, and only applied with the version that created
+them. Otherwise, only full packages are published.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Dict,
+    IO,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from toltec import ipk  # type: ignore
+from toltec.util import file_sha256  # type: ignore
+
+from .util import toltecmk_version, write_json
+
+logger = logging.getLogger(__name__)
+
+# Extension of delta archives
+DELTA_SUFFIX = ".ipkdelta"
+
+# Name of the sidecar index listing the deltas of a directory
+DELTA_INDEX_NAME = "deltas.json"
+
+# Version of the delta format, increased on incompatible changes
+DELTA_FORMAT = 1
+
+# Versions of toltecmk whose package writer is reproduced by
+# :func:`_write_package`
+SUPPORTED_TOLTECMK = ("0.3.3",)
+
+# Members of the outer archive of a package, in the order written by
+# :func:`toltec.ipk.write`
+PACKAGE_MEMBERS = [".", "./control.tar.gz", "./data.tar.gz", "./debian-binary"]
+
+# Header fields of the members of a data sub-archive
+HEADER_FIELDS = (
+    "name",
+    "mode",
+    "uid",
+    "gid",
+    "size",
+    "mtime",
+    "linkname",
+    "uname",
+    "gname",
+    "devmajor",
+    "devminor",
+)
+
+
+class DeltaError(Exception):
+    """Raised when a package cannot be rebuilt from its members."""
+
+
+class DeltaEntry(NamedTuple):
+    """Delta archive listed in a sidecar index."""
+
+    # Name of the package
+    package: str
+
+    # Archive of the previous version, relative to the index directory
+    base: str
+
+    # Archive of the new version, relative to the index directory
+    target: str
+
+    # Delta archive, relative to the index directory
+    delta: str
+
+    # Size of the delta archive in bytes
+    size: int
+
+    # SHA-256 digests of the delta, base and target archives
+    sha256: str
+    base_sha256: str
+    target_sha256: str
+
+    # Version of toltecmk that created the delta
+    toltecmk: str
+
+
+def delta_filename(target: str, base_version: str) -> str:
+    """
+    Get the name of the delta archive between two versions of a package.
+
+    :param target: path of the archive of the new version
+    :param base_version: previous version of the package
+    :returns: path of the delta archive next to the new archive
+    """
+    stem = target[: -len(".ipk")] if target.endswith(".ipk") else target
+    return f"{stem}_from_{base_version}{DELTA_SUFFIX}"
+
+
+def _read_member(archive: tarfile.TarFile, name: str) -> bytes:
+    """Read the contents of an archive member."""
+    file = archive.extractfile(name)
+
+    if file is None:
+        raise DeltaError(f"Member {name} is not a regular file")
+
+    with file:
+        return file.read()
+
+
+def _read_package(file: IO[bytes]) -> Tuple[int, bytes, bytes]:
+    """
+    Split a package into its sub-archives.
+
+    :param file: package archive
+    :returns: fixed modification time of the package members, contents of
+        the control sub-archive and contents of the data sub-archive
+    :raises DeltaError: if the package does not have the layout written by
+        :func:`toltec.ipk.write`
+    """
+    try:
+        with tarfile.open(fileobj=file, mode="r:gz") as archive:
+            members = archive.getmembers()
+
+            if [member.name for member in members] != PACKAGE_MEMBERS:
+                raise DeltaError("Unexpected package layout")
+
+            return (
+                members[0].mtime,
+                _read_member(archive, "./control.tar.gz"),
+                _read_member(archive, "./data.tar.gz"),
+            )
+    except (tarfile.TarError, EOFError, OSError) as err:
+        raise DeltaError(f"Unreadable package: {err}") from err
+
+
+def _write_package(
+    file: IO[bytes],
+    epoch: int,
+    control: bytes,
+    data: bytes,
+) -> None:
+    """Write a package the same way as :func:`toltec.ipk.write`."""
+    # pylint:disable=protected-access
+    with ipk._targz_open(file, epoch) as archive:
+        root_info = tarfile.TarInfo("./")
+        root_info.type = tarfile.DIRTYPE
+        archive.addfile(ipk._clean_info(None, epoch, root_info))
+
+        ipk._add_file(archive, "control.tar.gz", 0o644, epoch, control)
+        ipk._add_file(archive, "data.tar.gz", 0o644, epoch, data)
+        ipk._add_file(archive, "debian-binary", 0o644, epoch, b"2.0\n")
+
+
+def _header(member: tarfile.TarInfo) -> Dict[str, Any]:
+    """Get the header fields of a data member."""
+    header = {field: getattr(member, field) for field in HEADER_FIELDS}
+    header["type"] = member.type.decode("ascii")
+    return header
+
+
+def _member(header: Mapping[str, Any]) -> tarfile.TarInfo:
+    """Create a data member from its header fields."""
+    member = tarfile.TarInfo(header["name"])
+
+    for field in HEADER_FIELDS:
+        setattr(member, field, header[field])
+
+    member.type = header["type"].encode("ascii")
+    return member
+
+
+def _base_contents(data: bytes) -> Dict[str, bytes]:
+    """Get the contents of the regular files of a data sub-archive."""
+    contents = {}
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as archive:
+        for member in archive.getmembers():
+            if member.isreg():
+                contents[member.name] = _read_member(archive, member.name)
+
+    return contents
+
+
+def _rebuild(base_data: bytes, delta: IO[bytes]) -> bytes:
+    """
+    Rebuild a package from the data sub-archive of its previous version
+    and a delta archive.
+
+    :raises DeltaError: if the delta is invalid or does not apply
+    """
+    try:
+        with tarfile.open(fileobj=delta, mode="r:gz") as delta_archive:
+            info = json.loads(_read_member(delta_archive, "./delta.json"))
+
+            if info.get("format") != DELTA_FORMAT:
+                raise DeltaError("Unsupported delta format")
+
+            if info.get("toltecmk") != toltecmk_version():
+                raise DeltaError(
+                    f"Delta created with toltecmk {info.get('toltecmk')}, "
+                    f"but toltecmk {toltecmk_version()} is installed"
+                )
+
+            base = _base_contents(base_data)
+            data = io.BytesIO()
+
+            # pylint:disable-next=protected-access
+            with ipk._targz_open(data, info["epoch"]) as data_archive:
+                for index, header in enumerate(info["members"]):
+                    member = _member(header)
+                    contents = None
+
+                    if "base" in header:
+                        contents = base[header["base"]]
+                    elif member.isreg():
+                        contents = _read_member(
+                            delta_archive, f"./members/{index}"
+                        )
+
+                    data_archive.addfile(
+                        member,
+                        io.BytesIO(contents) if contents is not None else None,
+                    )
+
+            package = io.BytesIO()
+            _write_package(
+                package,
+                info["epoch"],
+                _read_member(delta_archive, "./control.tar.gz"),
+                data.getvalue(),
+            )
+            return package.getvalue()
+    except (tarfile.TarError, EOFError, KeyError, ValueError) as err:
+        raise DeltaError(f"Invalid delta: {err}") from err
+
+
+def apply_delta(base_path: str, delta_path: str, file: IO[bytes]) -> None:
+    """
+    Rebuild a package from its previous version and a delta archive.
+
+    :param base_path: archive of the previous version of the package
+    :param delta_path: delta archive
+    :param file: file to which the rebuilt package is written
+    :raises DeltaError: if the delta does not apply to the base archive
+    """
+    with open(base_path, "rb") as base, open(delta_path, "rb") as delta:
+        _, _, base_data = _read_package(base)
+        file.write(_rebuild(base_data, delta))
+
+
+def verify_delta(base_path: str, delta_path: str, target_path: str) -> bool:
+    """
+    Check that a delta rebuilds a package byte for byte.
+
+    :param base_path: archive of the previous version of the package
+    :param delta_path: delta archive
+    :param target_path: archive of the new version of the package
+    :returns: true if the rebuilt package is identical to the new archive
+    """
+    rebuilt = io.BytesIO()
+
+    try:
+        apply_delta(base_path, delta_path, rebuilt)
+    except DeltaError as err:
+        logger.debug("Unable to apply %s: %s", delta_path, err)
+        return False
+
+    with open(target_path, "rb") as target:
+        return target.read() == rebuilt.getvalue()
+
+
+def make_delta(  # pylint:disable=too-many-locals
+    base_path: str, target_path: str, delta_path: str
+) -> bool:
+    """
+    Create a delta archive between two versions of a package.
+
+    The delta is only kept if it rebuilds the new package byte for byte,
+    which requires both packages to have been written reproducibly, and if
+    it is smaller than the new package.
+
+    :param base_path: archive of the previous version of the package
+    :param target_path: archive of the new version of the package
+    :param delta_path: path of the delta archive to create
+    :returns: true if the delta was created
+    """
+    try:
+        with open(base_path, "rb") as base:
+            _, _, base_data = _read_package(base)
+
+        with open(target_path, "rb") as target:
+            epoch, control, data = _read_package(target)
+
+        # Base member holding each distinct file contents
+        known = {
+            hashlib.sha256(contents).digest(): name
+            for name, contents in _base_contents(base_data).items()
+        }
+        headers = []
+        delta = io.BytesIO()
+
+        # pylint:disable-next=protected-access
+        with ipk._targz_open(delta, epoch) as delta_archive:
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as archive:
+                for index, member in enumerate(archive.getmembers()):
+                    header = _header(member)
+
+                    if member.isreg():
+                        contents = _read_member(archive, member.name)
+                        digest = hashlib.sha256(contents).digest()
+
+                        if digest in known:
+                            header["base"] = known[digest]
+                        else:
+                            # pylint:disable-next=protected-access
+                            ipk._add_file(
+                                delta_archive,
+                                f"members/{index}",
+                                0o644,
+                                epoch,
+                                contents,
+                            )
+
+                    headers.append(header)
+
+            # pylint:disable=protected-access
+            ipk._add_file(
+                delta_archive, "control.tar.gz", 0o644, epoch, control
+            )
+            ipk._add_file(
+                delta_archive,
+                "delta.json",
+                0o644,
+                epoch,
+                json.dumps(
+                    {
+                        "format": DELTA_FORMAT,
+                        "toltecmk": toltecmk_version(),
+                        "epoch": epoch,
+                        "members": headers,
+                    }
+                ).encode(),
+            )
+            # pylint:enable=protected-access
+    except DeltaError as err:
+        logger.debug("Unable to create %s: %s", delta_path, err)
+        return False
+
+    if delta.tell() >= os.path.getsize(target_path):
+        logger.debug("Skipping %s as it is not smaller", delta_path)
+        return False
+
+    delta.seek(0)
+
+    try:
+        rebuilt = _rebuild(base_data, delta)
+    except DeltaError as err:
+        logger.debug("Unable to apply %s: %s", delta_path, err)
+        return False
+
+    with open(target_path, "rb") as target:
+        if target.read() != rebuilt:
+            logger.debug("Skipping %s as it is not reproducible", delta_path)
+            return False
+
+    temp_path = delta_path + ".tmp"
+
+    with open(temp_path, "wb") as file:
+        file.write(delta.getvalue())
+
+    os.replace(temp_path, delta_path)
+    return True
+
+
+def _read_index(index_dir: str) -> List[DeltaEntry]:
+    """Read the sidecar index of a directory."""
+    try:
+        with open(
+            os.path.join(index_dir, DELTA_INDEX_NAME), encoding="utf-8"
+        ) as file:
+            return [DeltaEntry(**entry) for entry in json.load(file)]
+    except FileNotFoundError:
+        return []
+    except (ValueError, TypeError):
+        logger.warning("Ignoring unreadable delta index in %s", index_dir)
+        return []
+
+
+def _update_index(index_dir: str, created: List[DeltaEntry]) -> None:
+    """
+    Add new deltas to the sidecar index of a directory, removing the deltas
+    whose new package is gone.
+    """
+    entries: Dict[str, DeltaEntry] = {}
+
+    for entry in _read_index(index_dir) + created:
+        if os.path.isfile(os.path.join(index_dir, entry.target)):
+            entries[entry.delta] = entry
+        else:
+            try:
+                os.remove(os.path.join(index_dir, entry.delta))
+            except FileNotFoundError:
+                pass
+
+    write_json(
+        os.path.join(index_dir, DELTA_INDEX_NAME),
+        [entries[delta]._asdict() for delta in sorted(entries)],
+        indent=2,
+    )
+
+
+def _parse_filename(path: str) -> Tuple[str, str]:
+    """Get the name and version of a package from its archive path."""
+    name, version, _ = os.path.basename(path).split("_", 2)
+    return name, version
+
+
+def generate_deltas(
+    repo_dir: str, bases: Mapping[str, str], jobs: int = 1
+) -> List[DeltaEntry]:
+    """
+    Create delta archives for new packages and update the sidecar indexes.
+
+    :param repo_dir: root of the package repository
+    :param bases: mapping of the paths of new package archives, relative to
+        the repository, to the path of the archive of their previous version
+    :param jobs: maximum number of deltas created concurrently
+    :returns: entries of the created deltas
+    """
+    version = toltecmk_version()
+
+    if version not in SUPPORTED_TOLTECMK:
+        logger.warning(
+            "Delta packages are not supported with toltecmk %s, only "
+            "publishing full packages",
+            version,
+        )
+        return []
+
+    def create(target: str) -> Optional[DeltaEntry]:
+        base_path = bases[target]
+        target_path = os.path.join(repo_dir, target)
+        _, base_version = _parse_filename(base_path)
+        delta_path = os.path.join(
+            repo_dir, delta_filename(target, base_version)
+        )
+
+        if not make_delta(base_path, target_path, delta_path):
+            return None
+
+        logger.debug("Created %s", delta_path)
+        return DeltaEntry(
+            package=_parse_filename(target)[0],
+            base=os.path.basename(base_path),
+            target=os.path.basename(target),
+            delta=os.path.basename(delta_path),
+            size=os.path.getsize(delta_path),
+            sha256=file_sha256(delta_path),
+            base_sha256=file_sha256(base_path),
+            target_sha256=file_sha256(target_path),
+            toltecmk=version,
+        )
+
+    targets = sorted(bases)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(create, targets))
+
+    created = []
+
+    for index_dir in sorted({os.path.dirname(target) for target in targets}):
+        entries = [
+            entry
+            for target, entry in zip(targets, results)
+            if entry is not None and os.path.dirname(target) == index_dir
+        ]
+        _update_index(os.path.join(repo_dir, index_dir), entries)
+        created.extend(entries)
+
+    return created
@@ -0,0 +1,381 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Index the dependencies between recipes to answer reverse-dependency and
+impact queries without parsing the whole recipe tree.
+
+The index stores, for each architecture of each recipe, the packages it
+provides, its host build dependencies and the installation dependencies
+of its packages. It is persisted between runs, and only the recipes that
+changed since the last run are parsed again when it is updated.
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from . import trace
+from .graphlib import TopologicalSorter
+from .util import list_recipes, toltecmk_version, tree_digest, write_json
+
+logger = logging.getLogger(__name__)
+
+# Version of the index format, increased on incompatible changes
+INDEX_VERSION = 1
+
+# Kinds of dependencies between recipes
+HOST = "host"
+INSTALL = "install"
+
+# Suffix of the arches that target a specific OS version
+OS_SUFFIX_REGEX = re.compile(r"os\d+$")
+
+# Name and arch of a recipe
+Node = Tuple[str, str]
+
+# Function parsing a list of recipes, returning a mapping of each recipe
+# name to its RecipeBundle
+Loader = Callable[[List[str]], Mapping[str, Any]]
+
+
+class Dependent(NamedTuple):
+    """Recipe arch that depends on a queried recipe or package."""
+
+    # Name of the dependent recipe
+    recipe: str
+
+    # Arch of the dependent recipe
+    arch: str
+
+    # Kind of dependency, either HOST or INSTALL
+    kind: str
+
+    # Name of the package that is depended upon
+    package: str
+
+    # Name of the recipe providing that package
+    provider: str
+
+    # Number of dependency edges from the queried recipes
+    depth: int
+
+
+def _visible(kind: str, arch: str, provider_arch: str) -> bool:
+    """
+    Check if a package built for an arch can satisfy a dependency of
+    a recipe built for another arch.
+
+    Host dependencies are installed from the `rmall` feed and the feed of
+    the recipe arch. Installation dependencies are resolved on the device,
+    where any arch made for the same device model can be installed.
+    """
+    if kind == HOST:
+        return provider_arch in ("rmall", arch)
+
+    device = OS_SUFFIX_REGEX.sub("", arch)
+    provider_device = OS_SUFFIX_REGEX.sub("", provider_arch)
+    return "rmall" in (device, provider_device) or device == provider_device
+
+
+def _describe(bundle: Any) -> Dict[str, Dict[str, List[str]]]:
+    """Extract the dependency information of a parsed recipe."""
+    arches = {}
+
+    for arch, recipe in bundle.items():
+        provides: Set[str] = set()
+        install: Set[str] = set()
+
+        for package in recipe.packages.values():
+            provides.add(package.name)
+            provides.update(dep.package for dep in package.provides if dep)
+            install.update(dep.package for dep in package.installdepends if dep)
+
+        arches[arch] = {
+            "provides": sorted(provides),
+            HOST: sorted(
+                dep.package
+                for dep in recipe.makedepends
+                if dep.kind.value == HOST
+            ),
+            INSTALL: sorted(install - provides),
+        }
+
+    return arches
+
+
+class DependencyIndex:
+    """Persisted index of the dependencies between recipes."""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """
+        Load a dependency index.
+
+        :param path: file where the index is persisted (default: only keep
+            the index in memory)
+        """
+        self.path = path
+        # Cache key and dependency information of each recipe
+        self._recipes: Dict[str, Dict[str, Any]] = {}
+        self._providers: Optional[Dict[str, List[Node]]] = None
+
+        if path is not None:
+            try:
+                with open(path, encoding="utf-8") as file:
+                    data = json.load(file)
+
+                if data.get("version") == INDEX_VERSION:
+                    self._recipes = data["recipes"]
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logger.warning("Ignoring unreadable dependency index %s", path)
+
+    @trace.traced("update dependency index")
+    def update(self, recipe_dir: str, load: Loader) -> List[str]:
+        """
+        Bring the index up to date with a recipe tree.
+
+        Recipes are recognized as unchanged from the contents of their
+        directory, so that up-to-date indexes can be used without loading
+        the recipe parser at all.
+
+        :param recipe_dir: directory where recipe definitions are stored
+        :param load: function called for parsing the recipes that changed,
+            such as :func:`recipes.load_recipes`
+        :returns: names of the recipes that were indexed again
+        """
+        names = list_recipes(recipe_dir)
+        version = toltecmk_version()
+        keys = {
+            name: f"{version}:{tree_digest(os.path.join(recipe_dir, name))}"
+            for name in names
+        }
+        stale = [
+            name
+            for name in names
+            if self._recipes.get(name, {}).get("key") != keys[name]
+        ]
+        removed = set(self._recipes) - set(names)
+
+        if not stale and not removed:
+            return []
+
+        bundles = load(stale) if stale else {}
+
+        for name in stale:
+            logger.debug("Indexing dependencies of %s", name)
+            self._recipes[name] = {
+                "key": keys[name],
+                "arches": _describe(bundles[name]),
+            }
+
+        for name in removed:
+            del self._recipes[name]
+
+        self._providers = None
+
+        if self.path is not None:
+            write_json(
+                self.path,
+                {"version": INDEX_VERSION, "recipes": self._recipes},
+                sort_keys=True,
+            )
+
+        return stale
+
+    def _provider_map(self) -> Dict[str, List[Node]]:
+        """Map each package name to the recipe arches providing it."""
+        if self._providers is None:
+            self._providers = {}
+
+            for name, entry in sorted(self._recipes.items()):
+                for arch, info in entry["arches"].items():
+                    for package in info["provides"]:
+                        self._providers.setdefault(package, []).append(
+                            (name, arch)
+                        )
+
+        return self._providers
+
+    def _reverse_edges(
+        self, kinds: Tuple[str, ...]
+    ) -> Dict[Node, List[Tuple[Node, str, str]]]:
+        """
+        Map each recipe arch to the recipe arches that depend on it.
+
+        :param kinds: kinds of dependencies to include
+        :returns: dependent recipe arch, kind of dependency and package
+            depended upon for each recipe arch
+        """
+        reverse: Dict[Node, List[Tuple[Node, str, str]]] = {}
+        providers = self._provider_map()
+
+        for name, entry in self._recipes.items():
+            for arch, info in entry["arches"].items():
+                for kind in kinds:
+                    for package in info[kind]:
+                        reverse_deps = (
+                            (provider, ((name, arch), kind, package))
+                            for provider in providers.get(package, [])
+                            if provider[0] != name
+                            and _visible(kind, arch, provider[1])
+                        )
+
+                        for provider, edge in reverse_deps:
+                            reverse.setdefault(provider, []).append(edge)
+
+        return reverse
+
+    def resolve(self, targets: Iterable[str]) -> List[Node]:
+        """
+        Find the recipe arches designated by recipe or package names.
+
+        :param targets: names of recipes or packages
+        :returns: matching recipe arches
+        :raises KeyError: if a name matches no recipe and no package
+        """
+        nodes: List[Node] = []
+
+        for target in targets:
+            if target in self._recipes:
+                nodes.extend(
+                    (target, arch) for arch in self._recipes[target]["arches"]
+                )
+            elif target in self._provider_map():
+                nodes.extend(self._provider_map()[target])
+            else:
+                raise KeyError(f"Unknown recipe or package {target}")
+
+        return sorted(set(nodes))
+
+    def dependents(
+        self,
+        targets: Iterable[str],
+        kinds: Iterable[str] = (HOST, INSTALL),
+        transitive: bool = True,
+    ) -> List[Dependent]:
+        """
+        Find the recipe arches that depend on some recipes or packages.
+
+        :param targets: names of the recipes or packages to look for
+        :param kinds: kinds of dependencies to follow
+        :param transitive: also find the recipes that depend on the
+            dependents, and so on
+        :returns: dependent recipe arches, closest ones first
+        :raises KeyError: if a target matches no recipe and no package
+        """
+        reverse = self._reverse_edges(tuple(kinds))
+        start = self.resolve(targets)
+        seen: Set[Node] = set(start)
+        queue: Deque[Tuple[Node, int]] = collections.deque(
+            (node, 0) for node in start
+        )
+        found: List[Dependent] = []
+
+        while queue:
+            node, depth = queue.popleft()
+
+            for dependent, kind, package in sorted(reverse.get(node, [])):
+                if dependent in seen:
+                    continue
+
+                seen.add(dependent)
+                found.append(
+                    Dependent(
+                        recipe=dependent[0],
+                        arch=dependent[1],
+                        kind=kind,
+                        package=package,
+                        provider=node[0],
+                        depth=depth + 1,
+                    )
+                )
+
+                if transitive:
+                    queue.append((dependent, depth + 1))
+
+        return found
+
+    def impact(self, targets: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Find the recipe arches that must be rebuilt when some recipes or
+        packages change.
+
+        These are the changed recipe arches and all the recipe arches that
+        transitively depend on them through host build dependencies.
+
+        :param targets: names of the changed recipes or packages
+        :returns: arches to rebuild for each recipe, with recipes listed
+            in an order in which they can be built
+        :raises KeyError: if a target matches no recipe and no package
+        """
+        targets = list(targets)
+        nodes = self.resolve(targets) + [
+            (dependent.recipe, dependent.arch)
+            for dependent in self.dependents(targets, kinds=(HOST,))
+        ]
+        arches: Dict[str, List[str]] = {}
+
+        for name, arch in nodes:
+            arches.setdefault(name, []).append(arch)
+
+        return {name: sorted(arches[name]) for name in self.order(arches)}
+
+    def graph(self, names: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Compute the host build dependencies between a set of recipes.
+
+        :param names: names of the recipes to inspect
+        :returns: mapping of each recipe to the recipes from the set that
+            need to be built before it
+        """
+        names = set(names)
+        providers = self._provider_map()
+        graph: Dict[str, List[str]] = {}
+
+        for name in sorted(names):
+            deps: Set[str] = set()
+
+            for arch, info in self._recipes[name]["arches"].items():
+                for package in info[HOST]:
+                    for provider, provider_arch in providers.get(package, []):
+                        if (
+                            provider in names
+                            and provider != name
+                            and _visible(HOST, arch, provider_arch)
+                        ):
+                            deps.add(provider)
+
+            graph[name] = sorted(deps)
+
+        return graph
+
+    def order(self, names: Iterable[str]) -> List[str]:
+        """
+        Order a set of recipes so that each recipe comes after the recipes
+        it needs for building.
+
+        :param names: names of the recipes to order
+        :returns: ordered names
+        :raises graphlib.CycleError: if a circular dependency exists
+        """
+        # See <https://github.com/PyCQA/pylint/issues/2822>
+        toposort: TopologicalSorter[  # pylint:disable=unsubscriptable-object
+            str
+        ] = TopologicalSorter(self.graph(names))
+        return list(toposort.static_order())
@@ -0,0 +1,152 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Incrementally generate package indexes."""
+
+import gzip
+import json
+import logging
+import os
+import textwrap
+import threading
+from typing import (
+    Dict,
+    Iterable,
+    Optional,
+    Tuple,
+)
+
+from toltec import ipk  # type: ignore
+from toltec.util import file_sha256  # type: ignore
+
+from . import trace
+from .util import write_json
+
+logger = logging.getLogger(__name__)
+
+
+class Indexer:  # pylint: disable=too-few-public-methods
+    """
+    Generate package indexes, only reading archives that changed.
+
+    The index entry of each archive is cached along with the archive size
+    and modification time, so that regenerating an index after adding a few
+    packages does not require reading every archive of the repository again.
+    Indexes can be updated from several threads.
+    """
+
+    def __init__(self, repo_dir: str, cache_path: Optional[str] = None) -> None:
+        """
+        Create an indexer.
+
+        :param repo_dir: root directory of the package repository
+        :param cache_path: file where cached index entries are persisted
+            across runs (default: only cache entries in memory)
+        """
+        self.repo_dir = repo_dir
+        self.cache_path = cache_path
+        # Size, modification time and index entry of each archive
+        self._entries: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+
+        if cache_path is not None:
+            try:
+                with open(cache_path, encoding="utf-8") as file:
+                    self._entries = json.load(file)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logger.warning("Ignoring unreadable index cache %s", cache_path)
+
+    @trace.traced("make index")
+    def update(self, subdirs: Optional[Iterable[str]] = None) -> None:
+        """
+        Regenerate package indexes.
+
+        :param subdirs: directories of the repository, relative to its root,
+            whose index should be regenerated (default: the root directory
+            and all its subdirectories)
+        """
+        if subdirs is None:
+            logger.info("Generating package index")
+            subdirs = sorted(
+                os.path.relpath(dirpath, self.repo_dir)
+                for dirpath, _, _ in os.walk(self.repo_dir)
+            )
+
+        with self._lock:
+            for subdir in subdirs:
+                if os.path.isdir(os.path.join(self.repo_dir, subdir)):
+                    self._index_dir(os.path.normpath(subdir))
+
+            self._save()
+
+    def _index_dir(self, subdir: str) -> None:
+        """Regenerate the index of a single directory."""
+        base_dir = os.path.join(self.repo_dir, subdir)
+        index = ""
+        seen = set()
+
+        for entry in sorted(os.scandir(base_dir), key=lambda e: e.name):
+            if entry.is_file() and entry.name.endswith(".ipk"):
+                key = os.path.normpath(os.path.join(subdir, entry.name))
+                seen.add(key)
+                index += self._entry(key, entry)
+
+        # Forget about archives that were removed from this directory
+        prefix = "" if subdir == "." else subdir
+
+        for key in list(self._entries):
+            if os.path.dirname(key) == prefix and key not in seen:
+                del self._entries[key]
+
+        index_path = os.path.join(base_dir, "Packages")
+        index_gzip_path = os.path.join(base_dir, "Packages.gz")
+
+        with open(index_path + ".tmp", "w", encoding="utf-8") as index_file:
+            index_file.write(index)
+
+        with open(index_gzip_path + ".tmp", "wb") as index_gzip_file:
+            with gzip.GzipFile(
+                filename="Packages",
+                mode="wb",
+                fileobj=index_gzip_file,
+                mtime=0,
+            ) as index_gzip:
+                index_gzip.write(index.encode("utf-8"))
+
+        os.replace(index_path + ".tmp", index_path)
+        os.replace(index_gzip_path + ".tmp", index_gzip_path)
+
+    def _entry(self, key: str, entry: os.DirEntry) -> str:
+        """Get the index entry for an archive, reading it if needed."""
+        stat = entry.stat()
+        cached = self._entries.get(key)
+
+        if cached is not None and (cached[0], cached[1]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return cached[2]
+
+        logger.debug("Reading package metadata from %s", key)
+
+        with ipk.Reader(entry.path) as package:
+            metadata = package.metadata
+            assert metadata is not None
+
+        metadata += textwrap.dedent(
+            f"""\
+            Filename: {entry.name}
+            SHA256sum: {file_sha256(entry.path)}
+            Size: {stat.st_size}
+
+            """
+        )
+
+        self._entries[key] = (stat.st_size, stat.st_mtime_ns, metadata)
+        return metadata
+
+    def _save(self) -> None:
+        """Persist cached index entries."""
+        if self.cache_path is not None:
+            write_json(self.cache_path, self._entries)
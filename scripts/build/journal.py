@@ -0,0 +1,174 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Record the progress of repository builds so that they can be resumed.
+
+The journal is a file where one JSON object is appended per line for each
+event of a build:
+
+- `start`: a new build started, discarding the events of previous builds
+- `resume`: a build started from where the previous one stopped
+- `plan`: a recipe was found to need building for some arches
+- `outcome`: a recipe build finished, with its status, the key of the
+  recipe and the SHA-256 digest of each package it built
+
+Each line is flushed to disk before going on, and lines that cannot be
+read, such as a last line cut short when the build was killed, are ignored.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+)
+
+from toltec.util import file_sha256  # type: ignore
+
+from .scheduler import BuildStatus
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Append-only record of the events of a repository build."""
+
+    def __init__(self, path: str, resume: bool = False) -> None:
+        """
+        Open the build journal.
+
+        :param path: file where the journal is stored
+        :param resume: if true, keep the events of previous builds and make
+            their outcomes available in :attr:`previous`, otherwise start a
+            new journal
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # Last outcome recorded for each recipe by previous builds
+        self.previous: Dict[str, Dict[str, Any]] = {}
+
+        if resume:
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, "w", encoding="utf-8"):
+                pass
+
+        self._append({"event": "resume" if resume else "start"})
+
+    def _load(self) -> None:
+        """Read the outcomes recorded by previous builds."""
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if entry.get("event") == "start":
+                        self.previous.clear()
+                    elif entry.get("event") == "outcome":
+                        self.previous[entry["recipe"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        """Durably add an event to the journal."""
+        line = json.dumps({"time": time.time(), **entry}, sort_keys=True)
+
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def plan(self, recipe: str, arches: Iterable[str]) -> None:
+        """
+        Record that a recipe needs building.
+
+        :param recipe: name of the recipe
+        :param arches: arches of the recipe that need building
+        """
+        self._append(
+            {"event": "plan", "recipe": recipe, "arches": list(arches)}
+        )
+
+    def outcome(  # pylint:disable=too-many-arguments
+        self,
+        recipe: str,
+        status: BuildStatus,
+        key: str,
+        repo_dir: str,
+        filenames: Iterable[str] = (),
+    ) -> None:
+        """
+        Record the outcome of a recipe build.
+
+        :param recipe: name of the recipe
+        :param status: outcome of the build
+        :param key: key identifying the inputs of the recipe, such as
+            :meth:`RecipeCache.key`
+        :param repo_dir: repository where packages are stored
+        :param filenames: paths of the built packages relative to the
+            repository, whose digest is recorded
+        """
+        self._append(
+            {
+                "event": "outcome",
+                "recipe": recipe,
+                "status": status.name.lower(),
+                "key": key,
+                "files": {
+                    filename: file_sha256(os.path.join(repo_dir, filename))
+                    for filename in filenames
+                },
+            }
+        )
+
+    def completed(self, repo_dir: str, keys: Mapping[str, str]) -> List[str]:
+        """
+        Find the recipes built by previous builds whose packages are intact.
+
+        Packages recorded for a recipe that changed since, or whose contents
+        do not match the recorded digest anymore, are removed so that they
+        get built again.
+
+        :param repo_dir: repository where packages are stored
+        :param keys: current key of each recipe to check
+        :returns: names of the recipes that do not need building again
+        """
+        completed = []
+
+        for recipe, key in keys.items():
+            entry = self.previous.get(recipe)
+
+            if entry is None or entry["status"] != "built":
+                continue
+
+            intact = entry["key"] == key and all(
+                os.path.isfile(os.path.join(repo_dir, filename))
+                and file_sha256(os.path.join(repo_dir, filename)) == digest
+                for filename, digest in entry["files"].items()
+            )
+
+            if intact:
+                completed.append(recipe)
+                continue
+
+            logger.warning("Packages built for %s are outdated", recipe)
+
+            for filename in entry["files"]:
+                try:
+                    os.remove(os.path.join(repo_dir, filename))
+                except FileNotFoundError:
+                    pass
+
+        return completed
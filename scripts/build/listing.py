@@ -0,0 +1,214 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Generate the static web listing of a package repository.
+
+The listing is made of an HTML page and a compact JSON index of the
+packages, from which the page renders and filters its rows. Static tables
+are only embedded in the page for browsers without JavaScript. Both files
+are only rewritten when the metadata of the listed packages or the page
+template change.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+)
+from toltec.recipe import Package  # type: ignore
+
+from . import paths
+
+logger = logging.getLogger(__name__)
+
+# Directory containing the page templates
+TEMPLATE_DIR = os.path.join(paths.SCRIPTS_DIR, "templates")
+
+# Name of the page template
+TEMPLATE_NAME = "listing.html"
+
+# Directory where compiled templates are cached across runs
+TEMPLATE_CACHE_DIR = os.path.join(paths.CACHE_DIR, "templates")
+
+# Names of the generated files, relative to the repository root
+LISTING_NAME = "index.html"
+SEARCH_INDEX_NAME = "packages.json"
+
+# Fields of each package in the search index, in order, where `filenames`
+# holds the path of the archive for each of the `arches`
+SEARCH_FIELDS = (
+    "name",
+    "version",
+    "section",
+    "description",
+    "arches",
+    "license",
+    "url",
+    "filenames",
+)
+
+# Marker embedded in the listing page to recognize up-to-date listings
+DIGEST_REGEX = re.compile(rb'<meta name="listing-digest" content="(\w+)">')
+
+
+class ListingEntry(NamedTuple):
+    """Package shown in the listing, with its builds for every arch."""
+
+    name: str
+    section: str
+    version: str
+    desc: str
+    license: str
+    url: str
+
+    # Arch and path relative to the repository root of each archive
+    downloads: List[Tuple[str, str]]
+
+
+def group_packages(
+    packages: Iterable[Package],
+) -> Dict[str, List[ListingEntry]]:
+    """
+    Group packages by section and then by shared package name.
+
+    :param packages: packages to group
+    :returns: entries of each section, both sorted by name
+    """
+    grouped: Dict[str, Dict[str, List[Package]]] = {}
+
+    for package in sorted(
+        packages, key=lambda package: (package.section, package.name)
+    ):
+        grouped.setdefault(package.section, {}).setdefault(
+            package.name, []
+        ).append(package)
+
+    return {
+        section: [
+            ListingEntry(
+                name=name,
+                section=section,
+                version=str(builds[0].version),
+                desc=builds[0].desc,
+                license=builds[0].license,
+                url=builds[0].url,
+                downloads=[
+                    (build.parent.arch, build.filename()) for build in builds
+                ],
+            )
+            for name, builds in names.items()
+        ]
+        for section, names in grouped.items()
+    }
+
+
+@functools.cache
+def _template() -> Template:
+    """Load the page template, compiling it at most once per run."""
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+        autoescape=True,
+    ).get_template(TEMPLATE_NAME)
+
+
+def _template_digest() -> str:
+    """Compute a digest of the page template source."""
+    with open(os.path.join(TEMPLATE_DIR, TEMPLATE_NAME), "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _current_digest(listing_path: str) -> Optional[str]:
+    """Read the digest embedded in an existing listing page."""
+    try:
+        with open(listing_path, "rb") as file:
+            match = DIGEST_REGEX.search(file.read(4096))
+    except FileNotFoundError:
+        return None
+
+    return match.group(1).decode() if match is not None else None
+
+
+def _write(path: str, contents: str) -> None:
+    """Atomically replace the contents of a file."""
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        file.write(contents)
+
+    os.replace(path + ".tmp", path)
+
+
+def make_listing(repo_dir: str, packages: Iterable[Package]) -> bool:
+    """
+    Generate the web listing of a repository if it is out of date.
+
+    :param repo_dir: root of the repository
+    :param packages: packages to list
+    :returns: true if the listing was regenerated
+    """
+    sections = group_packages(packages)
+    search_index: Dict[str, Any] = {
+        "fields": SEARCH_FIELDS,
+        "packages": [
+            [
+                entry.name,
+                entry.version,
+                entry.section,
+                entry.desc,
+                [arch for arch, _ in entry.downloads],
+                entry.license,
+                entry.url,
+                [filename for _, filename in entry.downloads],
+            ]
+            for entries in sections.values()
+            for entry in entries
+        ],
+    }
+    search_json = json.dumps(
+        search_index, separators=(",", ":"), ensure_ascii=False
+    )
+
+    digest = hashlib.sha256()
+    digest.update(_template_digest().encode())
+    digest.update(
+        json.dumps(sections, sort_keys=True, ensure_ascii=False).encode()
+    )
+    digest_hex = digest.hexdigest()
+
+    listing_path = os.path.join(repo_dir, LISTING_NAME)
+    search_path = os.path.join(repo_dir, SEARCH_INDEX_NAME)
+
+    if _current_digest(listing_path) == digest_hex and os.path.exists(
+        search_path
+    ):
+        logger.debug("Web listing is up to date")
+        return False
+
+    os.makedirs(repo_dir, exist_ok=True)
+    _write(search_path, search_json)
+    _write(
+        listing_path,
+        _template().render(
+            sections=sections,
+            digest=digest_hex,
+            search_index=SEARCH_INDEX_NAME,
+        ),
+    )
+    return True
@@ -18,3 +18,41 @@ WORK_DIR = os.path.join(GIT_DIR, "build", "package")
 
 # Directory used for storing built packages
 REPO_DIR = os.path.join(GIT_DIR, "build", "repo")
+
+# Directory where distributed build workers keep their own repository and
+# working directories
+WORKERS_DIR = os.path.join(GIT_DIR, "build", "workers")
+
+# Directory used for caching data between builds
+CACHE_DIR = os.path.join(GIT_DIR, "build", "cache")
+
+# File where the duration of past builds is recorded
+STATS_PATH = os.path.join(GIT_DIR, "build", "stats.json")
+
+# File where the progress of the latest repository build is recorded
+JOURNAL_PATH = os.path.join(GIT_DIR, "build", "journal.jsonl")
+
+# File where the resources used by past builds are recorded
+USAGE_PATH = os.path.join(GIT_DIR, "build", "usage.json")
+
+# File where the expected resource usage of heavy recipes is declared
+RESOURCE_HINTS_PATH = os.path.join(SCRIPTS_DIR, "build", "resources.txt")
+
+# File where the metadata of indexed packages is cached
+INDEX_CACHE_PATH = os.path.join(CACHE_DIR, "index.json")
+
+# File where the dependencies between recipes are indexed
+DEPENDENCY_INDEX_PATH = os.path.join(CACHE_DIR, "dependencies.json")
+
+# Directory where the HTTP validators of fetched packages are saved
+REMOTE_METADATA_DIR = os.path.join(CACHE_DIR, "remote")
+
+# Directory where built archives are cached for reuse across builds
+ARTIFACT_CACHE_DIR = os.path.join(CACHE_DIR, "artifacts")
+
+# Directory where downloaded source files are cached
+SOURCE_CACHE_DIR = os.path.join(CACHE_DIR, "sources")
+
+# Directory where previously published packages are downloaded for
+# creating delta packages
+DELTA_BASE_DIR = os.path.join(CACHE_DIR, "deltas")
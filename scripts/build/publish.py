@@ -0,0 +1,328 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Publish a package repository to a directory by only copying what changed.
+
+Each published directory holds a manifest listing the size, modification
+time and SHA-256 digest of each of its files. Publishing compares the
+manifest of the source repository with the one of the target, copies new
+and changed files, then replaces the index files, and finally removes the
+files that are gone. Every file is written under a temporary name and then
+moved into place, so that clients never see a partial file, and indexes
+only change once all the packages they list are available.
+
+Files identical to a file that is already published, in the target or in
+other channels of the same server, are hard-linked instead of copied.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+from .util import write_json
+
+logger = logging.getLogger(__name__)
+
+# Name of the manifest file at the root of each published directory
+MANIFEST_NAME = ".manifest.json"
+
+# Version of the manifest format, increased on incompatible changes
+MANIFEST_VERSION = 1
+
+# Names of the files that describe the packages of a repository, which are
+# published after the packages themselves
+INDEX_NAMES = (
+    "Packages",
+    "Packages.gz",
+    "Compatibility",
+    "index.html",
+    "packages.json",
+    "deltas.json",
+)
+
+# Files at least this large are hashed through a memory map instead of
+# being read into memory
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# Default number of files hashed or copied concurrently
+DEFAULT_JOBS = os.cpu_count() or 1
+
+
+class ManifestEntry(NamedTuple):
+    """Metadata about a published file."""
+
+    # Size of the file in bytes
+    size: int
+
+    # Modification time of the file in nanoseconds
+    mtime_ns: int
+
+    # SHA-256 digest of the file contents
+    sha256: str
+
+
+# Files of a directory, keyed by their path relative to the directory
+Manifest = Dict[str, ManifestEntry]
+
+
+class PublishStats(NamedTuple):
+    """Changes made to a target directory by a publication."""
+
+    # Files that were copied from the source
+    copied: List[str]
+
+    # Files that were hard-linked to an identical published file
+    linked: List[str]
+
+    # Files that were removed because they are not in the source anymore
+    removed: List[str]
+
+
+def hash_file(path: str) -> str:
+    """
+    Compute the SHA-256 digest of a file.
+
+    :param path: path to the file
+    :returns: hexadecimal digest
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < MMAP_THRESHOLD:
+            return hashlib.sha256(file.read()).hexdigest()
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def is_index(relpath: str) -> bool:
+    """Check if a file describes the packages of a repository."""
+    return os.path.basename(relpath) in INDEX_NAMES
+
+
+def read_manifest(root: str) -> Manifest:
+    """
+    Read the manifest saved in a directory.
+
+    :param root: directory to read the manifest of
+    :returns: saved manifest, or an empty one if it is missing or unreadable
+    """
+    try:
+        with open(os.path.join(root, MANIFEST_NAME), encoding="utf-8") as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning("Ignoring unreadable manifest in %s", root)
+        return {}
+
+    if data.get("version") != MANIFEST_VERSION:
+        return {}
+
+    return {
+        relpath: ManifestEntry(*entry)
+        for relpath, entry in data["files"].items()
+    }
+
+
+def write_manifest(root: str, manifest: Manifest) -> None:
+    """Atomically save the manifest of a directory."""
+    write_json(
+        os.path.join(root, MANIFEST_NAME),
+        {"version": MANIFEST_VERSION, "files": manifest},
+        sort_keys=True,
+    )
+
+
+def scan(  # pylint:disable=too-many-locals
+    root: str, previous: Optional[Manifest] = None, jobs: int = DEFAULT_JOBS
+) -> Manifest:
+    """
+    Compute the manifest of a directory.
+
+    Files are hashed concurrently, and files whose size and modification
+    time match a previous manifest are not hashed again.
+
+    :param root: directory to scan, which may not exist
+    :param previous: earlier manifest of the same directory
+    :param jobs: maximum number of files hashed concurrently
+    :returns: manifest of the directory, ignoring hidden files
+    """
+    previous = previous or {}
+    manifest: Manifest = {}
+    stale: Dict[str, os.stat_result] = {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+
+        for filename in filenames:
+            if filename.startswith("."):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, root)
+            stat = os.stat(path)
+            entry = previous.get(relpath)
+
+            if entry is not None and (entry.size, entry.mtime_ns) == (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                manifest[relpath] = entry
+            else:
+                stale[relpath] = stat
+
+    if stale:
+        logger.debug("Hashing %d files in %s", len(stale), root)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            digests = executor.map(
+                hash_file, (os.path.join(root, relpath) for relpath in stale)
+            )
+
+            for (relpath, stat), digest in zip(stale.items(), digests):
+                manifest[relpath] = ManifestEntry(
+                    stat.st_size, stat.st_mtime_ns, digest
+                )
+
+    return dict(sorted(manifest.items()))
+
+
+def _place(source: Optional[str], fallback: str, dest: str) -> bool:
+    """
+    Atomically put a file in place, linking it to an identical file if
+    possible and copying it otherwise.
+
+    :param source: identical file to link to, if any
+    :param fallback: file to copy if linking fails
+    :param dest: path of the new file
+    :returns: true if the file was linked
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp_path = os.path.join(
+        os.path.dirname(dest), "." + os.path.basename(dest) + ".publish"
+    )
+
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+
+    linked = False
+
+    if source is not None:
+        try:
+            os.link(source, temp_path)
+            linked = True
+        except OSError:
+            pass
+
+    if not linked:
+        shutil.copy2(fallback, temp_path)
+
+    os.replace(temp_path, dest)
+    return linked
+
+
+def _prune(root: str, relpath: str) -> None:
+    """Remove the empty parent directories of a removed file."""
+    parent = os.path.dirname(relpath)
+
+    while parent:
+        try:
+            os.rmdir(os.path.join(root, parent))
+        except OSError:
+            return
+
+        parent = os.path.dirname(parent)
+
+
+def publish(  # pylint:disable=too-many-locals
+    source: str,
+    target: str,
+    link_dests: Iterable[str] = (),
+    jobs: int = DEFAULT_JOBS,
+    dry_run: bool = False,
+) -> PublishStats:
+    """
+    Make a target directory identical to a source repository.
+
+    :param source: repository to publish
+    :param target: directory to publish to, created if needed
+    :param link_dests: other published directories, such as the other
+        channels of the same server, whose files are hard-linked into the
+        target when identical
+    :param jobs: maximum number of files hashed or copied concurrently
+    :param dry_run: only report what would change
+    :returns: changes made to the target
+    """
+    source_manifest = scan(source, read_manifest(source), jobs)
+    target_manifest = scan(target, read_manifest(target), jobs)
+
+    if not dry_run:
+        write_manifest(source, source_manifest)
+
+    changed = [
+        relpath
+        for relpath, entry in source_manifest.items()
+        if relpath not in target_manifest
+        or target_manifest[relpath].sha256 != entry.sha256
+    ]
+    removed = sorted(set(target_manifest) - set(source_manifest))
+
+    # Published files with a given digest, preferring the target itself but
+    # leaving out the target files that are about to be replaced
+    published: Dict[str, str] = {}
+
+    for root in link_dests:
+        for relpath, entry in scan(root, read_manifest(root), jobs).items():
+            published[entry.sha256] = os.path.join(root, relpath)
+
+    replaced = set(changed)
+
+    for relpath, entry in target_manifest.items():
+        if relpath not in replaced:
+            published[entry.sha256] = os.path.join(target, relpath)
+    stats = PublishStats(copied=[], linked=[], removed=removed)
+
+    def transfer(relpath: str) -> None:
+        dest = os.path.join(target, relpath)
+        origin = published.get(source_manifest[relpath].sha256)
+
+        if dry_run:
+            linked = origin is not None
+        else:
+            linked = _place(origin, os.path.join(source, relpath), dest)
+
+        (stats.linked if linked else stats.copied).append(relpath)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(
+            executor.map(
+                transfer,
+                (relpath for relpath in changed if not is_index(relpath)),
+            )
+        )
+
+    # Indexes only list packages that are all in place by now
+    for relpath in changed:
+        if is_index(relpath):
+            transfer(relpath)
+
+    if not dry_run:
+        for relpath in removed:
+            os.remove(os.path.join(target, relpath))
+            _prune(target, relpath)
+
+        write_manifest(target, scan(target, source_manifest, jobs))
+
+    stats.copied.sort()
+    stats.linked.sort()
+    return stats
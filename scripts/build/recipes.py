@@ -0,0 +1,243 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Discover and load recipe definitions."""
+
+import hashlib
+import logging
+import os
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+)
+
+from toltec import parse_recipe  # type: ignore
+from toltec.recipe import RecipeBundle  # type: ignore
+
+from . import trace
+from .cache import Cache
+from .util import list_recipes, toltecmk_version, tree_digest
+
+logger = logging.getLogger(__name__)
+
+# Default maximum size of the parsed recipe cache
+RECIPE_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class RecipeCache(Cache):
+    """
+    Cache of parsed recipes.
+
+    Entries are keyed by the contents of the recipe directory and by the
+    version of toltecmk used to parse it, so that any change to a recipe,
+    to one of its local source files or to the parser invalidates them.
+    """
+
+    def __init__(self, root: str, max_size: int = RECIPE_CACHE_SIZE) -> None:
+        super().__init__(root, max_size)
+
+    @staticmethod
+    def key(path: str) -> str:
+        """
+        Compute the cache key of a recipe.
+
+        :param path: path to the recipe directory
+        :returns: cache key
+        """
+        return hashlib.sha256(
+            f"{toltecmk_version()}:{tree_digest(path)}".encode()
+        ).hexdigest()
+
+    def get(self, key: str, path: str) -> Optional[RecipeBundle]:
+        """
+        Load a parsed recipe from the cache.
+
+        :param key: cache key of the recipe
+        :param path: path to the recipe directory
+        :returns: parsed recipe, or None if absent from the cache
+        """
+        data = self.read(key, "recipe.pickle")
+
+        if data is None:
+            return None
+
+        try:
+            bundle = pickle.loads(data)
+        except Exception:  # pylint:disable=broad-exception-caught
+            logger.warning("Discarding unreadable cached recipe %s", path)
+            self.invalidate(key)
+            return None
+
+        # Cached recipes may have been parsed from another location
+        for recipe in bundle.values():
+            recipe.path = path
+
+        return bundle
+
+    def put(self, key: str, bundle: RecipeBundle) -> None:
+        """
+        Store a parsed recipe in the cache.
+
+        :param key: cache key of the recipe
+        :param bundle: parsed recipe
+        """
+        self.write(key, "recipe.pickle", pickle.dumps(bundle))
+
+
+def find_recipes_mentioning(
+    recipe_dir: str,
+    words: Iterable[str],
+    names: Optional[Iterable[str]] = None,
+) -> List[str]:
+    """
+    Find recipes whose definition mentions any word from a set, without
+    parsing them.
+
+    This is a cheap way to narrow down the recipes that may depend on or
+    provide a given package before parsing them.
+
+    :param recipe_dir: directory where recipe definitions are stored
+    :param words: words to look for, such as package names
+    :param names: names of the recipes to search (default: all recipes)
+    :returns: names of the matching recipes
+    """
+    words = sorted(set(words))
+
+    if not words:
+        return []
+
+    pattern = re.compile(
+        r"(?<![\w.+-])(?:" + "|".join(map(re.escape, words)) + r")(?![\w.+-])"
+    )
+    matches = []
+
+    for name in names if names is not None else list_recipes(recipe_dir):
+        path = os.path.join(recipe_dir, name, "package")
+
+        with open(path, encoding="utf-8") as file:
+            if pattern.search(file.read()):
+                matches.append(name)
+
+    return matches
+
+
+@trace.traced("load recipes")
+def load_recipes(
+    recipe_dir: str,
+    names: Iterable[str],
+    jobs: Optional[int] = None,
+    cache: Optional[RecipeCache] = None,
+) -> Dict[str, RecipeBundle]:
+    """
+    Parse a set of recipes, using a pool of worker processes.
+
+    :param recipe_dir: directory where recipe definitions are stored
+    :param names: names of the recipes to parse
+    :param jobs: number of worker processes to use (default: number of
+        CPUs, pass 1 to parse in the current process)
+    :param cache: cache from which to load unchanged recipes and where to
+        store newly parsed ones (default: always parse)
+    :returns: parsed recipes, in the same order as :param:`names`
+    """
+    names = list(names)
+    paths = {name: os.path.join(recipe_dir, name) for name in names}
+    bundles: Dict[str, RecipeBundle] = {}
+    keys: Dict[str, str] = {}
+
+    if cache is not None:
+        for name, path in paths.items():
+            keys[name] = cache.key(path)
+            bundle = cache.get(keys[name], path)
+
+            if bundle is not None:
+                bundles[name] = bundle
+
+        logger.debug("Loaded %d recipes from cache", len(bundles))
+
+    missing = [name for name in names if name not in bundles]
+    jobs = min(jobs or os.cpu_count() or 1, len(missing))
+
+    if jobs <= 1:
+        parsed = [parse_recipe(paths[name]) for name in missing]
+    else:
+        logger.debug("Parsing %d recipes with %d workers", len(missing), jobs)
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            parsed = list(
+                executor.map(parse_recipe, (paths[name] for name in missing))
+            )
+
+    for name, bundle in zip(missing, parsed):
+        bundles[name] = bundle
+
+        if cache is not None:
+            cache.put(keys[name], bundle)
+
+    return {name: bundles[name] for name in names}
+
+
+class LazyRecipes(Mapping[str, RecipeBundle]):
+    """Mapping of recipe names to recipes that are parsed on first access."""
+
+    def __init__(
+        self,
+        recipe_dir: str,
+        jobs: Optional[int] = None,
+        cache: Optional[RecipeCache] = None,
+    ) -> None:
+        """
+        Create a lazy recipe mapping.
+
+        :param recipe_dir: directory where recipe definitions are stored
+        :param jobs: number of worker processes to use when loading
+            several recipes at once with :meth:`preload`
+        :param cache: cache of parsed recipes to use
+        """
+        self.recipe_dir = recipe_dir
+        self.jobs = jobs
+        self.cache = cache
+        self._names = list_recipes(recipe_dir)
+        self._loaded: Dict[str, RecipeBundle] = {}
+
+    def __getitem__(self, name: str) -> RecipeBundle:
+        if name not in self._loaded:
+            if name not in self._names:
+                raise KeyError(name)
+
+            self._loaded.update(
+                load_recipes(self.recipe_dir, (name,), 1, self.cache)
+            )
+
+        return self._loaded[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._names
+
+    def preload(self, names: Optional[Iterable[str]] = None) -> None:
+        """
+        Parse a set of recipes in parallel ahead of their first access.
+
+        :param names: names of the recipes to load (default: all recipes)
+        """
+        missing = [
+            name
+            for name in (names if names is not None else self._names)
+            if name not in self._loaded
+        ]
+
+        if missing:
+            self._loaded.update(
+                load_recipes(self.recipe_dir, missing, self.jobs, self.cache)
+            )
@@ -0,0 +1,519 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Access remote package repositories over HTTP."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from typing import (
+    Dict,
+    Iterable,
+    NamedTuple,
+    Optional,
+)
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import trace
+from .util import write_json
+
+logger = logging.getLogger(__name__)
+
+# Size of the buffers used when streaming downloads to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Timeout in seconds for connecting to and reading from a remote server
+TIMEOUT = 5
+
+# Default number of concurrent requests to a remote server
+DEFAULT_JOBS = 8
+
+# Number of times a failed download is retried
+RETRIES = 4
+
+# Delay in seconds before the first retry of a download, doubled after
+# each further failure
+BACKOFF = 1.0
+
+# Number of consecutive failed requests after which a remote server is
+# considered unavailable
+BREAKER_THRESHOLD = 8
+
+# Time in seconds during which no request is sent to a remote server that
+# is considered unavailable
+BREAKER_COOLDOWN = 30.0
+
+# Statuses of responses to requests that are worth retrying
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """Raised when a remote file cannot be downloaded."""
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests to a remote server that keeps failing.
+
+    After a given number of consecutive failures, the breaker opens and
+    requests are refused until a cool-down period has passed. A single
+    request is then let through, and the breaker closes again if it
+    succeeds.
+    """
+
+    def __init__(
+        self,
+        threshold: int = BREAKER_THRESHOLD,
+        cooldown: float = BREAKER_COOLDOWN,
+    ) -> None:
+        """
+        Create a closed breaker.
+
+        :param threshold: number of consecutive failures that open the breaker
+        :param cooldown: time in seconds for which an open breaker refuses
+            requests
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    def check(self) -> None:
+        """
+        Make sure that a request can be sent.
+
+        :raises DownloadError: if the breaker is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            if time.monotonic() - self._opened_at < self.cooldown:
+                raise DownloadError(
+                    "Remote server is unavailable after "
+                    f"{self._failures} consecutive failures"
+                )
+
+            # Let one request probe the server, and refuse the other ones
+            # until it completes
+            self._opened_at = time.monotonic()
+
+    def success(self) -> None:
+        """Record a successful request."""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self) -> None:
+        """Record a failed request."""
+        with self._lock:
+            self._failures += 1
+
+            if self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logger.warning(
+                        "Remote server failed %d times in a row, pausing "
+                        "requests for %d seconds",
+                        self._failures,
+                        self.cooldown,
+                    )
+
+                self._opened_at = time.monotonic()
+
+
+def make_session(pool_size: int = DEFAULT_JOBS) -> requests.Session:
+    """
+    Create an HTTP session that reuses connections across requests.
+
+    :param pool_size: maximum number of connections kept open to each host,
+        should match the number of threads sharing the session
+    :returns: new session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class IndexEntry(NamedTuple):
+    """Metadata about a package archive listed in a repository index."""
+
+    # Version number of the package
+    version: str
+
+    # Size of the archive in bytes
+    size: int
+
+    # SHA-256 checksum of the archive
+    sha256: str
+
+
+# Packages available in a repository, keyed by their archive path relative
+# to the repository root (same format as `Package.filename()`)
+RemoteIndex = Dict[str, IndexEntry]
+
+
+def parse_index(index: str, prefix: str = "") -> RemoteIndex:
+    """
+    Parse the contents of a `Packages` index file.
+
+    :param index: contents of the index
+    :param prefix: directory of the index relative to the repository root
+    :returns: entries of the index, keyed by archive path
+    """
+    entries = {}
+
+    for paragraph in index.split("\n\n"):
+        fields = {}
+
+        for line in paragraph.splitlines():
+            if line and not line[0].isspace() and ":" in line:
+                key, value = line.split(":", 1)
+                fields[key] = value.strip()
+
+        if "Filename" in fields:
+            path = fields["Filename"]
+
+            if prefix:
+                path = prefix + "/" + path
+
+            entries[path] = IndexEntry(
+                version=fields.get("Version", ""),
+                size=int(fields.get("Size", -1)),
+                sha256=fields.get("SHA256sum", ""),
+            )
+
+    return entries
+
+
+def fetch_index(
+    session: requests.Session, remote: str, arches: Iterable[str]
+) -> RemoteIndex:
+    """
+    Download and parse the package indexes of a remote repository.
+
+    :param session: HTTP session to use for downloading
+    :param remote: root of the remote repository
+    :param arches: architectures whose indexes should be downloaded
+    :returns: entries of all the indexes, keyed by archive path
+    :raises requests.HTTPError: if an index cannot be downloaded for
+        a reason other than it not existing
+    """
+    entries: RemoteIndex = {}
+
+    for arch in sorted(set(arches)):
+        req = session.get(f"{remote}/{arch}/Packages", timeout=TIMEOUT)
+
+        if req.status_code == 404:
+            logger.debug("No remote index for architecture %s", arch)
+            continue
+
+        req.raise_for_status()
+        trace.add_bytes(len(req.content))
+        entries.update(parse_index(req.text, arch))
+
+    return entries
+
+
+def _conditions(dest: str, metadata: Optional[str]) -> Dict[str, str]:
+    """
+    Make the headers of a request that only succeeds if a remote file
+    changed since it was downloaded.
+
+    The validators saved along with the last download are used if the local
+    copy did not change since then, otherwise the modification time of the
+    local copy is used.
+
+    :param dest: path to the local copy of the file
+    :param metadata: path to the validators saved by the last download
+    :returns: conditional request headers
+    """
+    stat = os.stat(dest)
+    saved = {}
+
+    if metadata is not None:
+        try:
+            with open(metadata, encoding="utf-8") as file:
+                saved = json.load(file)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    if (saved.get("size"), saved.get("mtime_ns")) == (
+        stat.st_size,
+        stat.st_mtime_ns,
+    ):
+        headers = {}
+
+        if saved.get("etag"):
+            headers["If-None-Match"] = saved["etag"]
+
+        if saved.get("last_modified"):
+            headers["If-Modified-Since"] = saved["last_modified"]
+
+        if headers:
+            return headers
+
+    return {"If-Modified-Since": formatdate(stat.st_mtime, usegmt=True)}
+
+
+def _save_validators(req: requests.Response, dest: str, metadata: str) -> None:
+    """Save the validators of a downloaded file along with its stat."""
+    stat = os.stat(dest)
+    write_json(
+        metadata,
+        {
+            "etag": req.headers.get("ETag"),
+            "last_modified": req.headers.get("Last-Modified"),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        },
+    )
+
+
+def _partial_validator(temp_path: str) -> Optional[str]:
+    """
+    Get the validator of the remote file a partial download comes from,
+    suitable for an If-Range header.
+
+    Strong entity tags are preferred, since weak ones cannot be used for
+    range requests, and the last modification date is used otherwise.
+
+    :param temp_path: path to the partial download
+    :returns: validator, or None if none was saved
+    """
+    try:
+        with open(temp_path + ".json", encoding="utf-8") as file:
+            saved = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    etag = saved.get("etag")
+
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return saved.get("last_modified")
+
+
+def _discard_partial(temp_path: str) -> None:
+    """Remove a partial download and its saved validator."""
+    for path in (temp_path, temp_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _download_once(  # pylint:disable=too-many-branches,too-many-locals
+    session: requests.Session,
+    url: str,
+    temp_path: str,
+    expected: Optional[IndexEntry],
+    conditions: Optional[Dict[str, str]] = None,
+) -> Optional[requests.Response]:
+    """
+    Download a remote file to a temporary path, resuming any previous
+    partial download.
+
+    The validators of the remote file are saved next to the partial
+    download, so that it is only resumed if the remote file did not change
+    in the meantime, and downloaded from the start otherwise.
+
+    :returns: response to the request, or None if the file does not exist
+    :raises requests.RequestException: if the transfer fails
+    :raises DownloadError: if the downloaded file is corrupted
+    """
+    offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    headers = dict(conditions or {})
+
+    if offset:
+        validator = _partial_validator(temp_path)
+
+        if validator is None:
+            # Without a validator, the partial file cannot safely be
+            # completed with the current remote contents
+            _discard_partial(temp_path)
+            offset = 0
+        else:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+    with session.get(url, headers=headers, timeout=TIMEOUT, stream=True) as req:
+        if req.status_code in (304, 404, 410, 416):
+            # Read the body of responses without contents, otherwise their
+            # connection is closed instead of being reused
+            _ = req.content
+
+        if req.status_code in (404, 410):
+            return None
+
+        if req.status_code == 304:
+            _discard_partial(temp_path)
+            return req
+
+        if req.status_code == 416:
+            # The partial file is not a prefix of the remote file
+            _discard_partial(temp_path)
+            raise DownloadError(f"Discarding stale partial download of {url}")
+
+        req.raise_for_status()
+        sha256 = hashlib.sha256()
+
+        if req.status_code == 206:
+            if not req.headers.get("Content-Range", "").startswith(
+                f"bytes {offset}-"
+            ):
+                _discard_partial(temp_path)
+                raise DownloadError(f"Unexpected range received for {url}")
+
+            with open(temp_path, "rb") as partial:
+                for chunk in iter(lambda: partial.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+
+            mode = "ab"
+        else:
+            # Either a new download, or the remote file changed since the
+            # partial download started
+            offset = 0
+            mode = "wb"
+            write_json(
+                temp_path + ".json",
+                {
+                    "etag": req.headers.get("ETag"),
+                    "last_modified": req.headers.get("Last-Modified"),
+                },
+            )
+
+        with open(temp_path, mode) as local:
+            for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                trace.add_bytes(len(chunk))
+                sha256.update(chunk)
+                local.write(chunk)
+
+    size = os.path.getsize(temp_path)
+    length = req.headers.get("Content-Length")
+
+    if (
+        length is not None
+        and "Content-Encoding" not in req.headers
+        and size != offset + int(length)
+    ):
+        raise DownloadError(
+            f"Truncated download of {url}: got {size - offset} bytes out "
+            f"of {length}"
+        )
+
+    if expected is not None and (
+        (expected.size >= 0 and size != expected.size)
+        or (expected.sha256 and sha256.hexdigest() != expected.sha256)
+    ):
+        _discard_partial(temp_path)
+        raise DownloadError(
+            f"Downloaded {url} does not match the size or checksum listed "
+            "in the remote index"
+        )
+
+    return req
+
+
+def download(  # pylint:disable=too-many-arguments,too-many-locals
+    session: requests.Session,
+    url: str,
+    dest: str,
+    expected: Optional[IndexEntry] = None,
+    breaker: Optional[CircuitBreaker] = None,
+    retries: int = RETRIES,
+    metadata: Optional[str] = None,
+    revalidate: bool = False,
+) -> bool:
+    """
+    Download a remote file reliably.
+
+    The file is first written to a temporary path next to its destination
+    and only moved into place once complete and verified, so that an
+    interrupted download never leaves a truncated file behind. Failed
+    transfers are resumed where they stopped, unless the remote file changed
+    in the meantime, and retried with exponential backoff.
+
+    When revalidating an existing file, a conditional request is sent so
+    that the file is only downloaded again if the remote copy changed.
+
+    :param session: HTTP session to use for downloading
+    :param url: address of the file to download
+    :param dest: path where the file should be stored
+    :param expected: size and checksum of the file from a remote index,
+        against which the download is verified
+    :param breaker: circuit breaker shared by the downloads from the same
+        remote server
+    :param retries: number of times a failed download is retried
+    :param metadata: if not None, file where the validators of the
+        downloaded file are saved for later revalidations
+    :param revalidate: if true and the file already exists, only download
+        it again if it changed on the remote
+    :returns: true if the file was downloaded, false if it does not exist
+        or did not change
+    :raises DownloadError: if the file cannot be downloaded
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp_path = os.path.join(
+        os.path.dirname(dest), "." + os.path.basename(dest) + ".download"
+    )
+    breaker = breaker or CircuitBreaker()
+    conditions = None
+    attempt = 0
+
+    if revalidate and os.path.isfile(dest):
+        conditions = _conditions(dest, metadata)
+
+    while True:
+        breaker.check()
+
+        try:
+            req = _download_once(session, url, temp_path, expected, conditions)
+        except requests.HTTPError as err:
+            if err.response.status_code not in RETRY_STATUSES:
+                breaker.success()
+                raise DownloadError(f"Unable to download {url}: {err}") from err
+
+            error: Exception = err
+        except (requests.RequestException, DownloadError) as err:
+            error = err
+        else:
+            breaker.success()
+
+            if req is None or req.status_code == 304:
+                return False
+
+            os.replace(temp_path, dest)
+            _discard_partial(temp_path)
+
+            if "Last-Modified" in req.headers:
+                last_modified = int(
+                    parsedate_to_datetime(
+                        req.headers["Last-Modified"]
+                    ).timestamp()
+                )
+                os.utime(dest, (last_modified, last_modified))
+
+            if metadata is not None:
+                _save_validators(req, dest, metadata)
+
+            return True
+
+        breaker.failure()
+
+        if attempt >= retries:
+            raise DownloadError(
+                f"Unable to download {url} after {attempt + 1} attempts: "
+                f"{error}"
+            ) from error
+
+        delay = BACKOFF * 2**attempt
+        logger.warning("%s, retrying in %g seconds", error, delay)
+        time.sleep(delay)
+        attempt += 1
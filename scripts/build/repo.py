@@ -3,36 +3,60 @@
 """
 Build the package repository.
 """
+import contextlib
+import itertools
 import logging
 import os
-import pathlib
 import shutil
+import threading
 
-from datetime import datetime
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
 from enum import auto
 from enum import Enum
 from typing import (
+    Callable,
     Dict,
     Iterable,
+    Iterator,
     List,
+    Mapping,
     Optional,
+    Tuple,
 )
 
 import requests
-from jinja2 import (
-    Environment,
-    FileSystemLoader,
-)
-from toltec import parse_recipe  # type: ignore
 from toltec.recipe import (
     Package,  # type: ignore
     Recipe,  # type: ignore
+    RecipeBundle,  # type: ignore
 )
-from toltec.util import HTTP_DATE_FORMAT  # type: ignore
-from toltec.version import DependencyKind  # type: ignore
+from toltec.version import DependencyKind, Version  # type: ignore
 
+from . import trace
+from .delta import generate_deltas
+from .dependencies import DependencyIndex
 from .graphlib import TopologicalSorter
-from .util import group_by
+from .remote import (
+    DEFAULT_JOBS,
+    CircuitBreaker,
+    DownloadError,
+    RemoteIndex,
+    download,
+    fetch_index,
+    make_session,
+)
+from .recipes import (
+    LazyRecipes,
+    RecipeCache,
+    find_recipes_mentioning,
+    list_recipes,
+    load_recipes,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -54,35 +78,87 @@ class PackageStatus(Enum):
     # pylint: enable=invalid-name
 
 
+# Packages of a recipe grouped by status and then by architecture
+RecipePackages = Dict[PackageStatus, Dict[str, List[Package]]]
+
 GroupedPackages = Dict[PackageStatus, Dict[str, Dict[str, List[Package]]]]
 
 
-class Repo:
+class Repo:  # pylint:disable=too-many-instance-attributes
     """Repository of Toltec packages."""
 
-    def __init__(self, recipe_dir: str, repo_dir: str) -> None:
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        recipe_dir: str,
+        repo_dir: str,
+        jobs: Optional[int] = None,
+        lazy: bool = False,
+        cache: Optional[RecipeCache] = None,
+        metadata_dir: Optional[str] = None,
+        dependency_index: Optional[str] = None,
+    ) -> None:
         """
         Initialize a package repository.
 
         :param recipe_dir: directory where recipe definitions are stored
         :param repo_dir: directory where built packages are stored
+        :param jobs: number of worker processes used for parsing recipes
+            (default: number of CPUs)
+        :param lazy: if true, only parse each recipe the first time it
+            is accessed instead of parsing all recipes upfront
+        :param cache: cache of parsed recipes to use (default: always parse)
+        :param metadata_dir: directory where the HTTP validators of fetched
+            packages are saved, so that they can be cheaply revalidated
+            against the remote later (default: do not save them)
+        :param dependency_index: file where the index of the dependencies
+            between recipes is persisted, so that only the recipes that
+            changed are parsed to update it (default: only keep the index
+            in memory)
         """
         self.recipe_dir = recipe_dir
         self.repo_dir = repo_dir
-        self.generic_recipes = {}
-
-        for name in os.listdir(self.recipe_dir):
-            path = pathlib.Path(self.recipe_dir) / name
-            if (
-                name[0] != "."
-                and os.path.isdir(path)
-                and os.path.exists(path / "package")
-            ):
-                self.generic_recipes[name] = parse_recipe(
-                    os.path.join(self.recipe_dir, name)
-                )
+        self.metadata_dir = metadata_dir
+        self.dependency_index = dependency_index
+        self._dependencies: Optional[DependencyIndex] = None
+        self.generic_recipes: Mapping[str, RecipeBundle]
+        # Held while fetching each package, so that concurrent fetches of
+        # the same package do not write to the same file
+        self._fetch_locks: Dict[str, threading.Lock] = {}
+        self._fetch_locks_guard = threading.Lock()
+        # Entries of the remote index of each remote and arch, downloaded
+        # at most once
+        self._remote_indexes: Dict[Tuple[str, str], RemoteIndex] = {}
+
+        if lazy:
+            self.generic_recipes = LazyRecipes(self.recipe_dir, jobs, cache)
+        else:
+            self.generic_recipes = load_recipes(
+                self.recipe_dir, list_recipes(self.recipe_dir), jobs, cache
+            )
+
+    def packages(self, names: Optional[Iterable[str]] = None) -> List[Package]:
+        """
+        List the packages defined by the recipes of the repository.
+
+        :param names: names of the recipes to list the packages of
+            (default: all recipes)
+        """
+        return [
+            package
+            for name in (names if names is not None else self.generic_recipes)
+            for recipe in self.generic_recipes[name].values()
+            for package in recipe.packages.values()
+        ]
 
-    def fetch_packages(self, remote: Optional[str]) -> GroupedPackages:
+    @trace.traced("fetch packages")
+    def fetch_packages(  # pylint:disable=too-many-arguments
+        self,
+        remote: Optional[str],
+        jobs: int = DEFAULT_JOBS,
+        plan_only: bool = False,
+        names: Optional[Iterable[str]] = None,
+        revalidate: bool = False,
+    ) -> GroupedPackages:
         """
         Fetch locally missing packages from a remote server and report which
         packages are missing from the remote and need to be built locally.
@@ -90,92 +166,483 @@ class Repo:
         If `remote` is None, no packages are fetched from the network and all
         the packages that are not in the local repo will be considered missing.
 
+        If `plan_only` is true, the remote package indexes are downloaded
+        instead of the packages themselves, and packages listed in those
+        indexes are reported as fetched without being downloaded. Use
+        :meth:`fetch_build_dependencies` to download the ones that are
+        needed for building the missing packages.
+
         :param remote: remote server from which to check for existing packages
+        :param jobs: maximum number of concurrent requests to the remote
+        :param plan_only: only decide which packages are missing from the
+            remote indexes, without downloading any package
+        :param names: names of the recipes whose packages should be checked
+            (default: all recipes)
+        :param revalidate: also check packages that exist locally against
+            the remote with conditional requests, and fetch them again if
+            they changed (ignored if `plan_only` is true)
         :returns: tuple containing fetched and missing packages grouped by
             their parent recipe and architecture
         """
-        logger.info("Scanning for missing packages")
+        names = list(names if names is not None else self.generic_recipes)
+        checked = dict(
+            self.stream_packages(remote, jobs, plan_only, names, revalidate)
+        )
         results: GroupedPackages = {
             PackageStatus.Fetched: {},
             PackageStatus.Missing: {},
         }
 
-        for name, generic_recipe in self.generic_recipes.items():
-            fetched_generic = {}
-            missing_generic = {}
+        for name in names:
+            for status, packages in checked[name].items():
+                results[status][name] = packages
+
+        return results
 
-            for arch, recipe in generic_recipe.items():
-                fetched_arch = []
-                missing_arch = []
+    def stream_packages(  # pylint:disable=too-many-arguments,too-many-locals
+        self,
+        remote: Optional[str],
+        jobs: int = DEFAULT_JOBS,
+        plan_only: bool = False,
+        names: Optional[Iterable[str]] = None,
+        revalidate: bool = False,
+    ) -> Iterator[Tuple[str, RecipePackages]]:
+        """
+        Fetch locally missing packages recipe by recipe, reporting each
+        recipe as soon as all of its packages are checked.
 
-                for package in recipe.packages.values():
-                    status = self.fetch_package(package, remote)
+        This behaves like :meth:`fetch_packages`, except that recipes are
+        reported in the order in which their checks finish, so that the
+        caller can act on a recipe while the others are still being checked.
+        At most twice as many recipes as concurrent requests are checked
+        ahead of the caller.
 
-                    if status == PackageStatus.Fetched:
-                        fetched_arch.append(package)
-                    elif status == PackageStatus.Missing:
-                        logger.info(
-                            "Package %s (%s) is missing",
-                            package.pkgid(),
-                            os.path.basename(recipe.path),
-                        )
-                        missing_arch.append(package)
+        :param remote: remote server from which to check for existing packages
+        :param jobs: maximum number of concurrent requests to the remote
+        :param plan_only: only decide which packages are missing from the
+            remote indexes, without downloading any package
+        :param names: names of the recipes whose packages should be checked
+            (default: all recipes)
+        :param revalidate: also check packages that exist locally against
+            the remote, see :meth:`fetch_packages`
+        :returns: name of each recipe along with its fetched and missing
+            packages grouped by status and architecture, omitting statuses
+            without any package
+        :raises DownloadError: if a package cannot be downloaded
+        """
+        logger.info("Scanning for missing packages")
+        names = list(names if names is not None else self.generic_recipes)
+        packages = self.packages(names)
+
+        if plan_only and remote is not None:
+            planned = dict(
+                zip(
+                    (package.filename() for package in packages),
+                    self._plan_all(packages, remote),
+                )
+            )
+
+            for name in names:
+                yield name, self._check_recipe(
+                    name, lambda package: planned[package.filename()]
+                )
+
+            return
+
+        remaining = iter(names)
+        window = 2 * max(jobs, 1)
+
+        with (
+            self._fetcher(remote, jobs, packages, revalidate) as fetch,
+            ThreadPoolExecutor(max_workers=jobs) as executor,
+        ):
+            running: Dict[Future[RecipePackages], str] = {}
+
+            while True:
+                for name in itertools.islice(remaining, window - len(running)):
+                    future = executor.submit(self._check_recipe, name, fetch)
+                    running[future] = name
 
-                if fetched_arch:
-                    fetched_generic[arch] = fetched_arch
+                if not running:
+                    return
 
-                if missing_arch:
-                    missing_generic[arch] = missing_arch
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
 
-            if fetched_generic:
-                results[PackageStatus.Fetched][name] = fetched_generic
+                for future in finished:
+                    yield running.pop(future), future.result()
+
+    def _check_recipe(
+        self, name: str, check: Callable[[Package], PackageStatus]
+    ) -> RecipePackages:
+        """
+        Check the packages of a recipe and group them by status.
+
+        :param name: name of the recipe to check
+        :param check: function giving the new status of a package
+        :returns: fetched and missing packages grouped by status and
+            architecture, omitting statuses without any package
+        """
+        results: RecipePackages = {}
 
-            if missing_generic:
-                results[PackageStatus.Missing][name] = missing_generic
+        for arch, recipe in self.generic_recipes[name].items():
+            for package in recipe.packages.values():
+                status = check(package)
+
+                if status == PackageStatus.Missing:
+                    logger.info(
+                        "Package %s (%s) is missing",
+                        package.pkgid(),
+                        os.path.basename(recipe.path),
+                    )
+
+                if status != PackageStatus.AlreadyExists:
+                    results.setdefault(status, {}).setdefault(arch, []).append(
+                        package
+                    )
 
         return results
 
-    def fetch_package(self, package: Package, remote: Optional[str]) -> PackageStatus:
+    def build_dependencies(
+        self, generic_recipes: Iterable[RecipeBundle]
+    ) -> List[Package]:
+        """
+        Find the packages from this repository that are needed to build
+        a list of recipes.
+
+        This includes the host build dependencies of each recipe and their
+        transitive installation dependencies that are found in the
+        repository, restricted to the architectures that are visible to the
+        build of each recipe.
+
+        :param generic_recipes: recipes to find the dependencies of
+        :returns: needed packages, sorted by archive path
+        """
+        needed: Dict[str, Package] = {}
+
+        for generic_recipe in generic_recipes:
+            for recipe in generic_recipe.values():
+                feeds = {"rmall", recipe.arch}
+                pending = [
+                    dep.package
+                    for dep in recipe.makedepends
+                    if dep.kind == DependencyKind.HOST
+                ]
+                seen = set()
+
+                while pending:
+                    name = pending.pop()
+
+                    if name in seen:
+                        continue
+
+                    seen.add(name)
+
+                    for package in self.find_packages((name,)):
+                        if package.parent.arch in feeds:
+                            needed[package.filename()] = package
+                            pending.extend(
+                                dep.package for dep in package.installdepends
+                            )
+
+        return [needed[filename] for filename in sorted(needed)]
+
+    @trace.traced("fetch build dependencies")
+    def fetch_build_dependencies(
+        self,
+        generic_recipes: Iterable[RecipeBundle],
+        remote: Optional[str],
+        jobs: int = DEFAULT_JOBS,
+    ) -> List[Package]:
+        """
+        Fetch the packages from this repository that are needed to build
+        a list of recipes and are not available locally.
+
+        See :meth:`build_dependencies` for which packages are needed.
+
+        :param generic_recipes: recipes to fetch the dependencies of
+        :param remote: remote server from which to fetch the packages
+        :param jobs: maximum number of concurrent requests to the remote
+        :returns: list of packages that were fetched
+        """
+        packages = self.build_dependencies(generic_recipes)
+        statuses = self._fetch_all(packages, remote, jobs)
+        return [
+            package
+            for package, status in zip(packages, statuses)
+            if status == PackageStatus.Fetched
+        ]
+
+    def find_packages(self, names: Iterable[str]) -> List[Package]:
+        """
+        Find all the packages with the given names, for any architecture.
+
+        When recipes are loaded lazily, only the recipes that mention one of
+        the names are parsed.
+
+        :param names: names of the packages to find
+        :returns: matching packages
+        """
+        names = set(names)
+        return [
+            package
+            for recipe_name in find_recipes_mentioning(
+                self.recipe_dir, names, self.generic_recipes
+            )
+            for recipe in self.generic_recipes[recipe_name].values()
+            for package in recipe.packages.values()
+            if package.name in names
+        ]
+
+    @trace.traced("find affected recipes")
+    def affected_recipes(self, names: Iterable[str]) -> List[str]:
+        """
+        Find the recipes that need rebuilding when some recipes change.
+
+        This expands the set of changed recipes with all the recipes that
+        transitively depend on them through host build dependencies, as
+        found by :meth:`DependencyIndex.impact`.
+
+        :param names: names of the changed recipes (names that do not
+            correspond to any recipe are ignored)
+        :returns: names of the affected recipes, in an order in which they
+            can be built
+        """
+        changed = [name for name in names if name in self.generic_recipes]
+
+        if not changed:
+            return []
+
+        return list(self.dependencies().impact(changed))
+
+    def dependencies(self) -> DependencyIndex:
+        """
+        Get the index of the dependencies between the recipes, bringing it
+        up to date on first use.
+
+        When recipes are loaded lazily, only the recipes that changed since
+        the persisted index was last updated are parsed.
+        """
+        if self._dependencies is None:
+
+            def load(names: List[str]) -> Dict[str, RecipeBundle]:
+                if isinstance(self.generic_recipes, LazyRecipes):
+                    self.generic_recipes.preload(names)
+
+                return {name: self.generic_recipes[name] for name in names}
+
+            index = DependencyIndex(self.dependency_index)
+            index.update(self.recipe_dir, load)
+            self._dependencies = index
+
+        return self._dependencies
+
+    def _remote_index(
+        self, session: requests.Session, remote: str, arches: Iterable[str]
+    ) -> RemoteIndex:
+        """
+        Get the entries of the package indexes of a remote repository,
+        downloading the index of each arch only the first time it is needed.
+        """
+        arches = set(arches)
+        index: RemoteIndex = {}
+
+        for arch in sorted(arches):
+            if (remote, arch) not in self._remote_indexes:
+                self._remote_indexes[(remote, arch)] = fetch_index(
+                    session, remote, (arch,)
+                )
+
+            index.update(self._remote_indexes[(remote, arch)])
+
+        return index
+
+    def _plan_all(
+        self, packages: List[Package], remote: str
+    ) -> List[PackageStatus]:
+        """Decide which packages exist on the remote from its indexes."""
+        with make_session(1) as session:
+            index = self._remote_index(
+                session, remote, (package.parent.arch for package in packages)
+            )
+
+        logger.debug("Remote indexes list %d packages", len(index))
+        return [
+            (
+                PackageStatus.AlreadyExists
+                if os.path.isfile(
+                    os.path.join(self.repo_dir, package.filename())
+                )
+                else (
+                    PackageStatus.Fetched
+                    if package.filename() in index
+                    else PackageStatus.Missing
+                )
+            )
+            for package in packages
+        ]
+
+    @contextlib.contextmanager
+    def _fetcher(
+        self,
+        remote: Optional[str],
+        jobs: int,
+        packages: List[Package],
+        revalidate: bool = False,
+    ) -> Iterator[Callable[[Package], PackageStatus]]:
+        """
+        Prepare for fetching packages concurrently, sharing connections.
+
+        :param remote: remote server from which to fetch the packages
+        :param jobs: maximum number of concurrent requests to the remote
+        :param packages: packages that will be fetched, used for deciding
+            which remote indexes to download
+        :param revalidate: whether packages that exist locally are
+            revalidated against the remote
+        :returns: function fetching a single package
+        """
+        breaker = CircuitBreaker()
+
+        with make_session(jobs) as session:
+            index: Optional[RemoteIndex] = None
+
+            if remote is not None and packages:
+                try:
+                    index = self._remote_index(
+                        session,
+                        remote,
+                        (package.parent.arch for package in packages),
+                    )
+                except requests.RequestException as err:
+                    logger.warning(
+                        "Unable to fetch the remote indexes, downloaded "
+                        "packages will not be verified: %s",
+                        err,
+                    )
+
+            yield lambda package: self.fetch_package(
+                package, remote, session, index, breaker, revalidate
+            )
+
+    def _fetch_all(
+        self, packages: List[Package], remote: Optional[str], jobs: int
+    ) -> List[PackageStatus]:
+        """
+        Fetch a list of packages concurrently, sharing connections.
+
+        :raises DownloadError: if a package cannot be downloaded
+        """
+        with (
+            self._fetcher(remote, jobs, packages) as fetch,
+            ThreadPoolExecutor(max_workers=jobs) as executor,
+        ):
+            return list(executor.map(fetch, packages))
+
+    def fetch_package(  # pylint:disable=too-many-arguments
+        self,
+        package: Package,
+        remote: Optional[str],
+        session: Optional[requests.Session] = None,
+        index: Optional[RemoteIndex] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        revalidate: bool = False,
+    ) -> PackageStatus:
         """
         Check if a package exists locally and fetch it otherwise.
 
         :param package: package to fetch
         :param remote: remote server from which to check for existing packages
-        :param fetch_missing: pass true to fetch missing packages from remote
+        :param session: HTTP session to use for fetching the package
+            (default: use a new connection)
+        :param index: entries of the remote indexes, used for verifying the
+            downloaded package and replacing truncated local copies
+        :param breaker: circuit breaker shared by the downloads from the
+            same remote server
+        :param revalidate: if the package exists locally, check with
+            a conditional request whether it changed on the remote and fetch
+            it again if so
         :returns: new status of the package
+        :raises DownloadError: if the package exists on the remote but
+            cannot be downloaded
         """
         filename = package.filename()
+
+        with self._fetch_locks_guard:
+            lock = self._fetch_locks.setdefault(filename, threading.Lock())
+
+        with lock:
+            return self._fetch_package(
+                package, remote, session, index, breaker, revalidate
+            )
+
+    def _fetch_package(  # pylint:disable=too-many-arguments
+        self,
+        package: Package,
+        remote: Optional[str],
+        session: Optional[requests.Session],
+        index: Optional[RemoteIndex],
+        breaker: Optional[CircuitBreaker],
+        revalidate: bool,
+    ) -> PackageStatus:
+        """Check if a package exists locally and fetch it otherwise."""
+        filename = package.filename()
         local_path = os.path.join(self.repo_dir, filename)
+        expected = index.get(filename) if index is not None else None
 
-        if os.path.isfile(local_path):
+        revalidate = revalidate and os.path.isfile(local_path)
+
+        # Local files are complete, since interrupted downloads are only left
+        # in temporary files that download() resumes, and may have been
+        # built locally, so they are kept unless asked to revalidate them
+        if os.path.isfile(local_path) and (not revalidate or remote is None):
             return PackageStatus.AlreadyExists
 
         if remote is None:
             return PackageStatus.Missing
 
-        remote_path = os.path.join(remote, filename)
+        if download(
+            session or make_session(1),
+            f"{remote}/{filename}",
+            local_path,
+            expected,
+            breaker,
+            metadata=(
+                os.path.join(self.metadata_dir, filename + ".json")
+                if self.metadata_dir is not None
+                else None
+            ),
+            revalidate=revalidate,
+        ):
+            if revalidate:
+                logger.info("Fetched %s again as it changed", filename)
+
+            return PackageStatus.Fetched
 
-        req = requests.get(remote_path, timeout=5)
+        if revalidate:
+            return PackageStatus.AlreadyExists
 
-        if req.status_code != 200:
-            return PackageStatus.Missing
+        return PackageStatus.Missing
 
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    def dependency_graph(
+        self,
+        generic_recipes: List[Dict[str, Recipe]],
+    ) -> Dict[str, List[str]]:
+        """
+        Compute the build dependencies between a list of recipes.
 
-        with open(local_path, "wb") as local:
-            for chunk in req.iter_content(chunk_size=1024):
-                local.write(chunk)
+        Only host dependencies on packages built by one of the recipes from
+        the list are taken into account, as found by
+        :meth:`DependencyIndex.graph`.
 
-        last_modified = int(
-            datetime.strptime(
-                req.headers["Last-Modified"],
-                HTTP_DATE_FORMAT,
-            ).timestamp()
+        :param generic_recipes: list of recipes to inspect
+        :returns: mapping of each recipe name to the names of the recipes
+            from the list that need to be built before it
+        """
+        return self.dependencies().graph(
+            os.path.basename(next(iter(generic_recipe.values())).path)
+            for generic_recipe in generic_recipes
         )
 
-        os.utime(local_path, (last_modified, last_modified))
-        return PackageStatus.Fetched
-
+    @trace.traced("order dependencies")
     def order_dependencies(
         self,
         generic_recipes: List[Dict[str, Recipe]],
@@ -191,59 +658,126 @@ class Repo:
         # See <https://github.com/PyCQA/pylint/issues/2822>
         toposort: TopologicalSorter[  # pylint:disable=unsubscriptable-object
             str
-        ] = TopologicalSorter()
-        parent_recipes = {}
-
-        for generic_recipe in generic_recipes:
-            for recipe in generic_recipe.values():
-                for package in recipe.packages.values():  # type: ignore
-                    parent_recipes[package.name] = os.path.basename(recipe.path)
-
-        for generic_recipe in generic_recipes:
-            for recipe in generic_recipe.values():
-                deps = []
-                for dep in recipe.makedepends:  # type: ignore
-                    if (
-                        dep.kind == DependencyKind.HOST
-                        and dep.package in parent_recipes
-                    ):
-                        deps.append(parent_recipes[dep.package])
+        ] = TopologicalSorter(self.dependency_graph(generic_recipes))
+        return [self.generic_recipes[name] for name in toposort.static_order()]
 
-                toposort.add(os.path.basename(recipe.path), *deps)
+    def fetch_previous_versions(
+        self,
+        packages: Iterable[Package],
+        remote: str,
+        dest_dir: str,
+        jobs: int = DEFAULT_JOBS,
+    ) -> Dict[str, str]:
+        """
+        Download the versions of packages that a remote repository publishes
+        when they differ from the local version.
+
+        Packages that are not published on the remote, or whose published
+        version cannot be downloaded, are left out.
+
+        :param packages: packages to find the published version of
+        :param remote: root of the remote repository
+        :param dest_dir: directory where the published archives are stored,
+            under the same paths as on the remote, and reused if present
+        :param jobs: maximum number of concurrent downloads
+        :returns: mapping of the archive path of each package to the path of
+            the archive of its published version
+        """
+        packages = list(packages)
+        breaker = CircuitBreaker()
+
+        with make_session(jobs) as session:
+            try:
+                index = self._remote_index(
+                    session,
+                    remote,
+                    (package.parent.arch for package in packages),
+                )
+            except requests.RequestException as err:
+                logger.warning("Unable to fetch the remote indexes: %s", err)
+                return {}
+
+            def fetch(package: Package) -> Optional[str]:
+                prefix = f"{package.parent.arch}/{package.name}_"
+                published = [
+                    filename
+                    for filename in index
+                    if filename.startswith(prefix)
+                    and filename != package.filename()
+                ]
+
+                if not published:
+                    return None
+
+                filename = max(
+                    published,
+                    key=lambda filename: Version.parse(index[filename].version),
+                )
+                dest = os.path.join(dest_dir, filename)
+
+                if not os.path.isfile(dest):
+                    try:
+                        download(
+                            session,
+                            f"{remote}/{filename}",
+                            dest,
+                            index[filename],
+                            breaker,
+                        )
+                    except DownloadError as err:
+                        logger.warning("%s", err)
+                        return None
+
+                return dest
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                return {
+                    package.filename(): path
+                    for package, path in zip(
+                        packages, executor.map(fetch, packages)
+                    )
+                    if path is not None
+                }
+
+    @trace.traced("make deltas")
+    def make_deltas(
+        self,
+        packages: Iterable[Package],
+        remote: str,
+        base_dir: str,
+        jobs: int = DEFAULT_JOBS,
+    ) -> None:
+        """
+        Create delta archives from the versions of packages that a remote
+        repository publishes to their local version.
 
-        return [self.generic_recipes[name] for name in toposort.static_order()]
+        :param packages: packages to create deltas for
+        :param remote: root of the remote repository
+        :param base_dir: directory where published versions are downloaded
+        :param jobs: maximum number of concurrent downloads and deltas
+        """
+        logger.info("Generating delta packages")
+        bases = self.fetch_previous_versions(packages, remote, base_dir, jobs)
+        created = generate_deltas(self.repo_dir, bases, jobs)
+        logger.info(
+            "Created %d delta packages out of %d candidates",
+            len(created),
+            len(bases),
+        )
 
+    @trace.traced("make listing")
     def make_listing(self) -> None:
         """Generate the static web listing for packages in the repo."""
         logger.info("Generating web listing")
+        # Imported here to avoid loading Jinja in commands that do not
+        # generate the listing
+        from .listing import (  # pylint:disable=import-outside-toplevel
+            make_listing,
+        )
 
-        packages = [
-            package
-            for generic_recipe in self.generic_recipes.values()
-            for recipe in generic_recipe.values()
-            for package in recipe.packages.values()
-        ]
-
-        # Group packages by section and then by shared package name
-        sections = {
-            section: group_by(section_packages, lambda package: package.name)
-            for section, section_packages in group_by(
-                packages, lambda package: package.section
-            ).items()
-        }
-
-        listing_path = os.path.join(self.repo_dir, "index.html")
-        template = Environment(
-            loader=FileSystemLoader(
-                pathlib.Path(__file__).parent.resolve() / ".." / "templates"
-            ),
-            autoescape=True,
-        ).get_template("listing.html")
-
-        # pylint: disable-next=unspecified-encoding
-        with open(listing_path, "w") as listing_file:
-            listing_file.write(template.render(sections=sections))
+        make_listing(self.repo_dir, self.packages())
 
+    @trace.traced("make compatibility")
     def make_compatibility(self) -> None:
         """Generate the OS compatibility information file."""
         logger.info("Generating compatibility info")
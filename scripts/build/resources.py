@@ -0,0 +1,455 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Estimate, record and limit the resources used by recipe builds."""
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import docker
+from toltec.recipe import Recipe  # type: ignore
+
+from . import paths
+from .stats import SMOOTHING
+from .util import write_json
+
+logger = logging.getLogger(__name__)
+
+# Suffixes accepted in memory sizes
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+SIZE_REGEX = re.compile(r"^([0-9.]+)\s*([KMGT]?)i?B?$", re.IGNORECASE)
+
+
+class Resources(NamedTuple):
+    """Amount of computing resources."""
+
+    # Number of CPUs
+    cpus: float
+
+    # Memory in bytes
+    memory: float
+
+    def __add__(self, other: Any) -> "Resources":
+        return Resources(self.cpus + other.cpus, self.memory + other.memory)
+
+    def __sub__(self, other: "Resources") -> "Resources":
+        return Resources(self.cpus - other.cpus, self.memory - other.memory)
+
+
+# Resources assumed to be used by builds with no declared or recorded usage
+DEFAULT_USAGE = Resources(cpus=1.0, memory=1024**3)
+
+# Time in seconds to wait for the statistics of a stopped container
+MONITOR_TIMEOUT = 5
+
+# Number of parts each CPU is divided into when accounting for budgets
+CPU_UNITS = 1000
+
+# Amount of resources that does not restrict anything
+UNLIMITED = Resources(cpus=float("inf"), memory=float("inf"))
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a memory size such as `512M` or `4G`.
+
+    :param size: size to parse
+    :returns: size in bytes
+    :raises ValueError: if the size is invalid
+    """
+    match = SIZE_REGEX.match(size.strip())
+
+    if match is None:
+        raise ValueError(f"Invalid size '{size}'")
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_hints(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    Read declared resource usage hints.
+
+    :param path: path to the hints file, which contains one line per recipe
+        with its name followed by `cpus=N` and/or `memory=SIZE` fields
+    :returns: declared fields for each recipe
+    """
+    hints: Dict[str, Dict[str, float]] = {}
+
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+
+            if not line:
+                continue
+
+            name, *fields = line.split()
+            hint = hints.setdefault(name, {})
+
+            for field in fields:
+                key, value = field.split("=", 1)
+
+                if key == "cpus":
+                    hint["cpus"] = float(value)
+                elif key == "memory":
+                    hint["memory"] = parse_size(value)
+                else:
+                    raise ValueError(
+                        f"Unknown resource '{key}' for recipe {name} in {path}"
+                    )
+
+    return hints
+
+
+class ResourceHints:
+    """
+    Expected resource usage of the builds of each recipe and arch.
+
+    Usage is either declared in a hints file, or learned from the peak
+    memory and average CPU usage of the build containers of past builds.
+    Declared values take precedence over learned ones.
+    """
+
+    def __init__(
+        self,
+        hints_path: Optional[str] = paths.RESOURCE_HINTS_PATH,
+        usage_path: Optional[str] = paths.USAGE_PATH,
+    ) -> None:
+        """
+        Load resource usage hints.
+
+        :param hints_path: file where usage hints are declared
+        :param usage_path: file where learned usage is stored, which is
+            created on the first save if it does not exist
+        """
+        self.usage_path = usage_path
+        self._lock = threading.Lock()
+        self._declared: Dict[str, Dict[str, float]] = {}
+        self._learned: Dict[str, Dict[str, List[float]]] = {}
+
+        if hints_path is not None and os.path.exists(hints_path):
+            self._declared = parse_hints(hints_path)
+
+        if usage_path is not None:
+            try:
+                with open(usage_path, encoding="utf-8") as file:
+                    self._learned = json.load(file)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logger.warning(
+                    "Ignoring unreadable usage record %s", usage_path
+                )
+
+    def get(self, name: str, arch: str) -> Optional[Resources]:
+        """
+        Get the expected resource usage of building an arch of a recipe.
+
+        :param name: name of the recipe
+        :param arch: architecture of the recipe
+        :returns: expected usage, or None if it is neither declared nor
+            learned
+        """
+        with self._lock:
+            declared = self._declared.get(name, {})
+            learned = self._learned.get(name, {}).get(arch)
+
+        if not declared and learned is None:
+            return None
+
+        default = Resources(*learned) if learned is not None else DEFAULT_USAGE
+        return Resources(
+            cpus=declared.get("cpus", default.cpus),
+            memory=declared.get("memory", default.memory),
+        )
+
+    def estimate(self, recipes: Iterable[Recipe], jobs: int = 1) -> Resources:
+        """
+        Estimate the peak resource usage of building a set of arches of
+        a recipe.
+
+        :param recipes: arch versions of a recipe to be built
+        :param jobs: maximum number of arches built concurrently
+        :returns: estimated peak usage
+        """
+        usages = sorted(
+            (
+                self.get(os.path.basename(recipe.path), recipe.arch)
+                or DEFAULT_USAGE
+                for recipe in recipes
+            ),
+            reverse=True,
+        )
+        total = Resources(0.0, 0.0)
+
+        for usage in usages[: max(jobs, 1)]:
+            total += usage
+
+        return total
+
+    def record(self, name: str, arch: str, usage: Resources) -> None:
+        """
+        Record the resources used by a build and save them.
+
+        :param name: name of the recipe
+        :param arch: architecture of the recipe
+        :param usage: average CPU usage and peak memory usage of the build
+        """
+        with self._lock:
+            arches = self._learned.setdefault(name, {})
+
+            if arch in arches:
+                previous = arches[arch]
+                arches[arch] = [
+                    old + SMOOTHING * (new - old)
+                    for old, new in zip(previous, usage)
+                ]
+            else:
+                arches[arch] = list(usage)
+
+            if self.usage_path is not None:
+                write_json(
+                    self.usage_path, self._learned, indent=2, sort_keys=True
+                )
+
+
+class ResourceBudget:
+    """
+    Global amount of resources that concurrent builds can use.
+
+    Reservations are counted in whole thousandths of a CPU and whole bytes,
+    so that releasing every reservation brings the budget back to exactly
+    nothing used, whatever the order of the releases.
+    """
+
+    def __init__(self, total: Resources) -> None:
+        """
+        Create a budget.
+
+        :param total: amount of resources available to all builds
+        """
+        self.total = total
+        self._total = self._units(total)
+        self._used = (0.0, 0.0)
+
+    @staticmethod
+    def _units(amount: Resources) -> Tuple[float, float]:
+        """Convert an amount of resources to whole accounting units."""
+        cpus = amount.cpus * CPU_UNITS
+        memory = amount.memory
+        return (
+            cpus if math.isinf(cpus) else round(cpus),
+            memory if math.isinf(memory) else round(memory),
+        )
+
+    @property
+    def used(self) -> Resources:
+        """Amount of resources currently reserved."""
+        return Resources(self._used[0] / CPU_UNITS, self._used[1])
+
+    def clamp(self, request: Resources) -> Resources:
+        """Reduce a request that exceeds the whole budget to fit it."""
+        return Resources(
+            min(request.cpus, self.total.cpus),
+            min(request.memory, self.total.memory),
+        )
+
+    def admits(self, request: Resources) -> bool:
+        """Check if a request fits in the remaining resources."""
+        cpus, memory = self._units(self.clamp(request))
+        return (
+            self._used[0] + cpus <= self._total[0]
+            and self._used[1] + memory <= self._total[1]
+        )
+
+    def acquire(self, request: Resources) -> None:
+        """Reserve resources for a build."""
+        cpus, memory = self._units(self.clamp(request))
+        self._used = (self._used[0] + cpus, self._used[1] + memory)
+
+    def release(self, request: Resources) -> None:
+        """Give back the resources reserved for a build."""
+        cpus, memory = self._units(self.clamp(request))
+        self._used = (self._used[0] - cpus, self._used[1] - memory)
+
+
+class UsageMonitor:  # pylint:disable=too-few-public-methods
+    """Measure the resources used by containers from their statistics."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cpus: List[float] = []
+        self._memory = 0.0
+        self._threads: List[threading.Thread] = []
+
+    def watch(self, container: Any) -> None:
+        """Start sampling the statistics of a running container."""
+        thread = threading.Thread(
+            target=self._sample, args=(container,), daemon=True
+        )
+        thread.start()
+        self._threads.append(thread)
+
+    def _sample(self, container: Any) -> None:
+        try:
+            for stats in container.stats(decode=True, stream=True):
+                cpu = stats.get("cpu_stats", {})
+                precpu = stats.get("precpu_stats", {})
+                cpu_delta = cpu.get("cpu_usage", {}).get(
+                    "total_usage", 0
+                ) - precpu.get("cpu_usage", {}).get("total_usage", 0)
+                system_delta = cpu.get("system_cpu_usage", 0) - precpu.get(
+                    "system_cpu_usage", 0
+                )
+                # Do not count reclaimable page cache, like `docker stats`
+                memory_stats = stats.get("memory_stats", {})
+                memory = memory_stats.get("usage", 0) - memory_stats.get(
+                    "stats", {}
+                ).get("inactive_file", 0)
+
+                with self._lock:
+                    if cpu_delta > 0 and system_delta > 0:
+                        self._cpus.append(
+                            cpu_delta
+                            / system_delta
+                            * (cpu.get("online_cpus") or 1)
+                        )
+
+                    self._memory = max(self._memory, memory)
+        except docker.errors.APIError:
+            # The container was removed before its statistics were read
+            pass
+
+    def usage(self) -> Optional[Resources]:
+        """
+        Get the measured usage of the watched containers.
+
+        :returns: average CPU usage and peak memory usage, or None if no
+            statistics were collected
+        """
+        for thread in self._threads:
+            thread.join(timeout=MONITOR_TIMEOUT)
+
+        with self._lock:
+            if not self._cpus:
+                return None
+
+            return Resources(sum(self._cpus) / len(self._cpus), self._memory)
+
+
+class _LimitedContainers:  # pylint:disable=too-few-public-methods
+    """Container collection that applies per-thread limits to new
+    containers and monitors their usage."""
+
+    def __init__(self, containers: Any, local: threading.local) -> None:
+        self._containers = containers
+        self._local = local
+
+    def run(self, *args: Any, **kwargs: Any) -> Any:
+        """Create and start a container, see `docker.models.containers`."""
+        cpus = getattr(self._local, "cpus", None)
+
+        if cpus is not None:
+            kwargs.setdefault("nano_cpus", int(cpus * 1e9))
+
+        container = self._containers.run(*args, **kwargs)
+        monitor = getattr(self._local, "monitor", None)
+
+        if monitor is not None and kwargs.get("detach"):
+            monitor.watch(container)
+
+        return container
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._containers, name)
+
+
+class LimitedDockerClient:
+    """
+    Docker client wrapper that limits the CPU usage of build containers and
+    measures their resource usage.
+
+    Limits and measurements apply to the containers started from the thread
+    that entered :meth:`limit`, so that a single client can be shared by
+    concurrent builds.
+    """
+
+    def __init__(self, client: Any) -> None:
+        """
+        Wrap a Docker client.
+
+        :param client: client to wrap
+        """
+        self._client = client
+        self._local = threading.local()
+        self.containers = _LimitedContainers(client.containers, self._local)
+
+    @contextlib.contextmanager
+    def limit(self, cpus: Optional[float] = None) -> Iterator[UsageMonitor]:
+        """
+        Limit and monitor the containers started from the current thread.
+
+        :param cpus: maximum number of CPUs each container can use
+            (default: no limit)
+        :returns: monitor whose :meth:`UsageMonitor.usage` returns the
+            resources used by the containers started within the block
+        """
+        monitor = UsageMonitor()
+        self._local.cpus = cpus
+        self._local.monitor = monitor
+
+        try:
+            yield monitor
+        finally:
+            self._local.cpus = None
+            self._local.monitor = None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+def add_resource_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add CLI options for controlling resource budgets."""
+    parser.add_argument(
+        "--cpus",
+        type=float,
+        metavar="N",
+        help="""number of CPUs that concurrent builds can use; builds are only
+        started while their expected CPU usage fits, and their containers
+        are limited to it (default: no limit)""",
+    )
+
+    parser.add_argument(
+        "--memory",
+        type=parse_size,
+        metavar="SIZE",
+        help="""amount of memory, such as 16G, that concurrent builds can
+        use; builds are only started while their expected memory usage fits
+        (default: no limit)""",
+    )
+
+
+def resource_budget(args: argparse.Namespace) -> Optional[Resources]:
+    """Get the resource budget selected by the CLI options, if any."""
+    if args.cpus is None and args.memory is None:
+        return None
+
+    return Resources(
+        cpus=args.cpus if args.cpus is not None else UNLIMITED.cpus,
+        memory=args.memory if args.memory is not None else UNLIMITED.memory,
+    )
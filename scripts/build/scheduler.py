@@ -0,0 +1,424 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Run recipe builds concurrently while respecting their dependencies."""
+
+import heapq
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import auto
+from enum import Enum
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from . import trace
+from .graphlib import TopologicalSorter
+from .resources import DEFAULT_USAGE, ResourceBudget, Resources
+
+logger = logging.getLogger(__name__)
+
+# Events processed by the scheduling thread: a recipe whose need for
+# building became known, a finished build, or None when all recipes are known
+_Event = Optional[Union[Tuple[str, bool], Future[bool]]]
+
+
+class BuildStatus(Enum):
+    """Possible outcomes of a scheduled build."""
+
+    # pylint: disable=invalid-name
+
+    # The build completed successfully
+    Built = auto()
+
+    # The build was attempted and failed
+    Failed = auto()
+
+    # The build was not attempted because a dependency failed or because
+    # the run was interrupted by another failure
+    Skipped = auto()
+
+    # pylint: enable=invalid-name
+
+
+@trace.traced("critical paths")
+def critical_paths(
+    graph: Mapping[str, Iterable[str]], costs: Mapping[str, float]
+) -> Dict[str, float]:
+    """
+    Compute the longest remaining path from each node of a graph.
+
+    :param graph: mapping of each node to its predecessors
+    :param costs: cost of each node (missing nodes have a zero cost)
+    :returns: mapping of each node to the total cost of the costliest chain
+        of nodes that starts with it and follows successor edges
+    :raises graphlib.CycleError: if a circular dependency exists
+    """
+    successors: Dict[str, List[str]] = {name: [] for name in graph}
+
+    for name, deps in graph.items():
+        for dep in deps:
+            successors.setdefault(dep, []).append(name)
+
+    # See <https://github.com/PyCQA/pylint/issues/2822>
+    toposort: TopologicalSorter[  # pylint:disable=unsubscriptable-object
+        str
+    ] = TopologicalSorter(graph)
+    paths: Dict[str, float] = {}
+
+    for name in reversed(list(toposort.static_order())):
+        paths[name] = costs.get(name, 0.0) + max(
+            (paths[succ] for succ in successors[name]), default=0.0
+        )
+
+    return paths
+
+
+def blocked_by(
+    graph: Mapping[str, Iterable[str]], failed: Iterable[str]
+) -> Dict[str, List[str]]:
+    """
+    Find the nodes of a graph that cannot be built because of failures.
+
+    :param graph: mapping of each node to its predecessors
+    :param failed: nodes whose build failed
+    :returns: mapping of each node that transitively depends on a failed
+        node to the failed nodes it depends on
+    """
+    failed = set(failed)
+    blockers: Dict[str, List[str]] = {}
+
+    def visit(name: str) -> List[str]:
+        if name not in blockers:
+            blockers[name] = []
+            found = set()
+
+            for dep in graph.get(name, ()):
+                if dep in failed:
+                    found.add(dep)
+
+                found.update(visit(dep))
+
+            blockers[name] = sorted(found)
+
+        return blockers[name]
+
+    return {
+        name: visit(name)
+        for name in graph
+        if name not in failed and visit(name)
+    }
+
+
+class Scheduler:
+    """Build a dependency graph of recipes using a pool of workers."""
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        graph: Mapping[str, Iterable[str]],
+        jobs: int,
+        costs: Optional[Mapping[str, float]] = None,
+        usage: Optional[Mapping[str, Resources]] = None,
+        budget: Optional[Resources] = None,
+    ) -> None:
+        """
+        Create a scheduler.
+
+        When several recipes are ready to be built, the ones with the longest
+        remaining critical path are started first, so that long chains of
+        builds do not end up delaying the whole run.
+
+        :param graph: mapping of each recipe name to the names of the
+            recipes that need to be built before it
+        :param jobs: maximum number of builds to run concurrently
+        :param costs: estimated duration of each recipe build (default:
+            start ready recipes in the order of the graph)
+        :param usage: expected resource usage of each recipe build
+        :param budget: total resources that concurrent builds can use; a
+            ready recipe is only started if its expected usage fits in what
+            is left, otherwise smaller ready recipes are started first
+            (default: only limit the number of concurrent builds)
+        :raises graphlib.CycleError: if a circular dependency exists
+        """
+        self.graph = {name: list(deps) for name, deps in graph.items()}
+        self.jobs = max(jobs, 1)
+        self.costs = dict(costs) if costs is not None else {}
+        self.usage = dict(usage) if usage is not None else {}
+        self.budget = budget
+        self.priorities = critical_paths(self.graph, self.costs)
+
+    def _sort_ready(self, ready: List[str]) -> None:
+        """Order ready recipes by decreasing critical path, in place."""
+        ready.sort(key=lambda name: -self.priorities.get(name, 0.0))
+
+    def _pop_admitted(
+        self,
+        ready: List[str],
+        budget: Optional[ResourceBudget],
+        idle: bool = False,
+    ) -> Optional[str]:
+        """
+        Remove and return the first ready recipe that fits in the budget.
+
+        :param ready: recipes ready to be built, in order of priority
+        :param budget: resources left for new builds, which are reserved
+            for the returned recipe
+        :param idle: whether no build is running, in which case the first
+            ready recipe is admitted even if it does not fit, so that a run
+            can never stall
+        :returns: admitted recipe, or None if no ready recipe fits
+        """
+        for index, name in enumerate(ready):
+            request = self.usage.get(name, DEFAULT_USAGE)
+
+            if budget is None or idle or budget.admits(request):
+                if budget is not None:
+                    budget.acquire(request)
+
+                return ready.pop(index)
+
+        return None
+
+    def _new_budget(self) -> Optional[ResourceBudget]:
+        """Create an empty budget for a run, if resources are limited."""
+        return ResourceBudget(self.budget) if self.budget is not None else None
+
+    def predict_makespan(self) -> float:
+        """
+        Predict how long building the whole graph will take.
+
+        This simulates the scheduling policy of :meth:`run` using the
+        estimated cost of each recipe.
+
+        :returns: predicted duration in seconds
+        """
+        # See <https://github.com/PyCQA/pylint/issues/2822>
+        toposort: TopologicalSorter[  # pylint:disable=unsubscriptable-object
+            str
+        ] = TopologicalSorter(self.graph)
+        toposort.prepare()
+
+        ready: List[str] = []
+        running: List[Tuple[float, int, str]] = []
+        budget = self._new_budget()
+        now = 0.0
+        counter = 0
+
+        while True:
+            ready.extend(toposort.get_ready())
+            self._sort_ready(ready)
+
+            while len(running) < self.jobs:
+                admitted = self._pop_admitted(ready, budget, not running)
+
+                if admitted is None:
+                    break
+
+                name = admitted
+                counter += 1
+                heapq.heappush(
+                    running,
+                    (now + self.costs.get(name, 0.0), counter, name),
+                )
+
+            if not running:
+                return now
+
+            now, _, name = heapq.heappop(running)
+            toposort.done(name)
+
+            if budget is not None:
+                budget.release(self.usage.get(name, DEFAULT_USAGE))
+
+    def _collect_ready(  # pylint:disable=too-many-arguments
+        self,
+        toposort: "TopologicalSorter[str]",
+        needed: Set[str],
+        unknown: Set[str],
+        waiting: Set[str],
+        ready: List[str],
+    ) -> None:
+        """
+        Find the recipes whose dependencies are all available.
+
+        Recipes that need building are added to the ready list, recipes
+        whose need for building is unknown yet are put aside as waiting, and
+        the other recipes are immediately marked as available.
+        """
+        while batch := toposort.get_ready():
+            for name in batch:
+                if name in needed:
+                    ready.append(name)
+                elif name in unknown:
+                    waiting.add(name)
+                else:
+                    toposort.done(name)
+
+        self._sort_ready(ready)
+
+    def run(  # pylint:disable=too-many-locals,too-many-branches,too-many-statements
+        self,
+        build: Callable[[str], bool],
+        on_done: Optional[Callable[[str, BuildStatus], None]] = None,
+        arrivals: Optional[Iterable[Tuple[str, bool]]] = None,
+        keep_going: bool = False,
+    ) -> Dict[str, BuildStatus]:
+        """
+        Build the recipes of the graph.
+
+        Each recipe is started as soon as all of its dependencies are built
+        and its expected resource usage fits in the budget. When a build
+        fails, no new build is started and the recipes that were not built
+        yet are reported as skipped, unless `keep_going` is true, in which
+        case only the recipes that depend on the failed one are skipped.
+
+        By default, all the recipes of the graph need building. Otherwise,
+        whether each recipe needs building is given by `arrivals`, which is
+        consumed from another thread so that builds can start while it is
+        still producing. Recipes that do not need building are treated as
+        built by their dependents, which wait until they are known.
+
+        :param build: callback building a recipe given its name, which is
+            called from a worker thread and returns true on success
+        :param on_done: callback called from the scheduling thread after
+            each build completes, one at a time
+        :param arrivals: name of each recipe of the graph along with whether
+            it needs building, in any order; recipes that are not listed do
+            not need building
+        :param keep_going: keep building the recipes that do not depend on
+            a failed recipe
+        :returns: outcome of each recipe that needed building
+        :raises graphlib.CycleError: if a circular dependency exists
+        """
+        # See <https://github.com/PyCQA/pylint/issues/2822>
+        toposort: TopologicalSorter[  # pylint:disable=unsubscriptable-object
+            str
+        ] = TopologicalSorter(self.graph)
+        toposort.prepare()
+
+        needed = set(self.graph) if arrivals is None else set()
+        unknown = set(self.graph) - needed
+        waiting: Set[str] = set()
+        results: Dict[str, BuildStatus] = {}
+        running: Dict[Future[bool], str] = {}
+        ready: List[str] = []
+        budget = self._new_budget()
+        failed = False
+        events: queue.Queue[_Event] = queue.Queue()
+        errors: List[Exception] = []
+
+        def feed() -> None:
+            try:
+                for arrival in arrivals or ():
+                    events.put(arrival)
+            except Exception as err:  # pylint:disable=broad-exception-caught
+                errors.append(err)
+            finally:
+                events.put(None)
+
+        feeder = threading.Thread(target=feed)
+        feeding = arrivals is not None
+
+        if feeding:
+            feeder.start()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                if not failed:
+                    self._collect_ready(
+                        toposort, needed, unknown, waiting, ready
+                    )
+
+                while len(running) < self.jobs:
+                    admitted = self._pop_admitted(ready, budget, not running)
+
+                    if admitted is None:
+                        break
+
+                    logger.debug("Starting build of %s", admitted)
+                    future = executor.submit(build, admitted)
+                    running[future] = admitted
+                    future.add_done_callback(events.put)
+
+                if not running and not feeding:
+                    break
+
+                event = events.get()
+
+                if event is None:
+                    feeding = False
+
+                    # Recipes that were not listed do not need building
+                    unknown.clear()
+                    toposort.done(*waiting)
+                    waiting.clear()
+
+                    if errors:
+                        failed = True
+                        ready.clear()
+                elif isinstance(event, tuple):
+                    name, need = event
+
+                    if name not in unknown:
+                        logger.debug("Ignoring unexpected recipe %s", name)
+                        continue
+
+                    unknown.remove(name)
+
+                    if need:
+                        needed.add(name)
+
+                    if name in waiting:
+                        waiting.remove(name)
+
+                        if not need:
+                            toposort.done(name)
+                        elif not failed:
+                            ready.append(name)
+                else:
+                    name = running.pop(event)
+
+                    if budget is not None:
+                        budget.release(self.usage.get(name, DEFAULT_USAGE))
+
+                    try:
+                        success = event.result()
+                    except Exception:  # pylint:disable=broad-exception-caught
+                        logger.exception("Build of %s crashed", name)
+                        success = False
+
+                    if success:
+                        results[name] = BuildStatus.Built
+                        toposort.done(name)
+                    else:
+                        logger.error("Build of %s failed", name)
+                        results[name] = BuildStatus.Failed
+
+                        # Recipes depending on this one never get ready
+                        if not keep_going:
+                            failed = True
+                            ready.clear()
+
+                    if on_done is not None:
+                        on_done(name, results[name])
+
+        if arrivals is not None:
+            feeder.join()
+
+        if errors:
+            raise errors[0]
+
+        return {
+            name: results.get(name, BuildStatus.Skipped)
+            for name in self.graph
+            if name in needed
+        }
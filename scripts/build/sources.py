@@ -0,0 +1,167 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Cache of recipe source files, addressed by their checksum."""
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Iterable,
+    List,
+    Optional,
+)
+
+import requests
+from toltec.builder import BuildError  # type: ignore
+from toltec.recipe import Source  # type: ignore
+
+from . import paths, trace
+from .cache import Cache
+from .remote import CHUNK_SIZE, DEFAULT_JOBS, make_session
+
+logger = logging.getLogger(__name__)
+
+# Default maximum size of the source cache
+SOURCE_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Timeouts in seconds for connecting to and reading from source servers
+SOURCE_TIMEOUT = (3.05, 300)
+
+# Detect non-local paths
+URL_REGEX = re.compile(r"[a-z]+://")
+
+# Name of the file holding the source contents in each cache entry
+ENTRY_NAME = "source"
+
+
+class SourceCache(Cache):
+    """
+    Cache of remote source files shared between all recipes and arches.
+
+    Entries are keyed by the SHA-256 checksum declared in recipes and are
+    verified when downloaded, so that a warm cache can be used to build
+    without accessing the network.
+    """
+
+    def __init__(self, root: str, max_size: int = SOURCE_CACHE_SIZE) -> None:
+        super().__init__(root, max_size)
+
+    @staticmethod
+    def cacheable(source: Source) -> bool:
+        """Check if a source item is a remote file with a known checksum."""
+        return (
+            URL_REGEX.match(source.url) is not None
+            and source.checksum != "SKIP"
+        )
+
+    def fetch(
+        self, source: Source, session: Optional[requests.Session] = None
+    ) -> str:
+        """
+        Get a source file, downloading it if it is not in the cache yet.
+
+        :param source: source item to get
+        :param session: HTTP session to use for downloading
+            (default: use a new connection)
+        :returns: path to the cached source file
+        :raises BuildError: if the file cannot be downloaded or does not
+            match its declared checksum
+        """
+        entry = self.lookup(source.checksum)
+
+        if entry is not None:
+            return os.path.join(entry, ENTRY_NAME)
+
+        def populate(path: str) -> None:
+            logger.info("Downloading %s", source.url)
+            sha256 = hashlib.sha256()
+
+            with (session or requests).get(
+                source.url, timeout=SOURCE_TIMEOUT, stream=True
+            ) as req:
+                if req.status_code != 200:
+                    raise BuildError(
+                        f"Unexpected status code while fetching \
+source file '{source.url}', got {req.status_code}"
+                    )
+
+                with open(os.path.join(path, ENTRY_NAME), "wb") as local:
+                    for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                        trace.add_bytes(len(chunk))
+                        sha256.update(chunk)
+                        local.write(chunk)
+
+            if sha256.hexdigest() != source.checksum:
+                raise BuildError(
+                    f"Invalid checksum for source file {source.url}:\n"
+                    f"  expected {source.checksum}\n"
+                    f"  actual   {sha256.hexdigest()}"
+                )
+
+        return os.path.join(self.store(source.checksum, populate), ENTRY_NAME)
+
+    @trace.traced("prefetch sources")
+    def prefetch(
+        self, sources: Iterable[Source], jobs: int = DEFAULT_JOBS
+    ) -> List[Source]:
+        """
+        Download all missing cacheable source files concurrently.
+
+        :param sources: source items to download
+        :param jobs: maximum number of concurrent downloads
+        :returns: list of source items that could not be downloaded
+        """
+        missing = {
+            source.checksum: source
+            for source in sources
+            if self.cacheable(source) and self.lookup(source.checksum) is None
+        }
+
+        if not missing:
+            return []
+
+        logger.info("Prefetching %d source files", len(missing))
+        failed: List[Source] = []
+
+        def fetch(source: Source) -> None:
+            try:
+                self.fetch(source, session)
+            except (BuildError, requests.RequestException) as err:
+                logger.warning("Unable to prefetch %s: %s", source.url, err)
+                failed.append(source)
+
+        with (
+            make_session(jobs) as session,
+            ThreadPoolExecutor(max_workers=jobs) as executor,
+        ):
+            list(executor.map(fetch, missing.values()))
+
+        return failed
+
+
+def add_source_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add CLI options for controlling the source cache."""
+    parser.add_argument(
+        "--source-cache",
+        default=paths.SOURCE_CACHE_DIR,
+        metavar="DIR",
+        help="""directory where downloaded source files are cached, shared
+        between all recipes and arches (default: %(default)s)""",
+    )
+
+    parser.add_argument(
+        "--no-source-cache",
+        action="store_true",
+        help="always download source files instead of reusing cached ones",
+    )
+
+
+def open_source_cache(args: argparse.Namespace) -> Optional[SourceCache]:
+    """Open the source cache selected by the CLI options, if any."""
+    if args.no_source_cache:
+        return None
+
+    return SourceCache(args.source_cache)
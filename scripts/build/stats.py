@@ -0,0 +1,117 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Record and predict how long recipe builds take."""
+
+import json
+import logging
+import os
+import threading
+from typing import (
+    Dict,
+    Iterable,
+    Optional,
+)
+
+from toltec.recipe import Recipe  # type: ignore
+
+from .util import write_json
+
+logger = logging.getLogger(__name__)
+
+# Estimated duration in seconds for building an architecture of a recipe
+# that has never been built before and that defines a build() script
+STATIC_ESTIMATE_BUILD = 600.0
+
+# Estimated duration in seconds for building an architecture of a recipe
+# that has never been built before and only packages prebuilt files
+STATIC_ESTIMATE_PACKAGE = 30.0
+
+# Weight given to the latest measurement when updating a recorded duration
+SMOOTHING = 0.5
+
+
+class BuildStats:
+    """Persistent record of build durations for each recipe and arch."""
+
+    def __init__(self, path: str) -> None:
+        """
+        Load build statistics from a file.
+
+        :param path: path to the file where statistics are stored, which is
+            created on the first save if it does not exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._durations: Dict[str, Dict[str, float]] = {}
+
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                self._durations = json.load(file)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning("Ignoring unreadable build statistics %s", path)
+
+    def get(self, name: str, arch: str) -> Optional[float]:
+        """
+        Get the recorded duration for building an arch of a recipe.
+
+        :param name: name of the recipe
+        :param arch: architecture of the recipe
+        :returns: duration in seconds, or None if it was never built
+        """
+        with self._lock:
+            return self._durations.get(name, {}).get(arch)
+
+    def record(self, name: str, arch: str, duration: float) -> None:
+        """
+        Record the duration of a build and save it.
+
+        Durations are smoothed across runs to reduce the influence of
+        outliers, such as builds slowed down by a cold Docker image cache.
+
+        :param name: name of the recipe
+        :param arch: architecture of the recipe
+        :param duration: build duration in seconds
+        """
+        with self._lock:
+            arches = self._durations.setdefault(name, {})
+
+            if arch in arches:
+                arches[arch] += SMOOTHING * (duration - arches[arch])
+            else:
+                arches[arch] = duration
+
+            self._save()
+
+    def estimate(self, recipes: Iterable[Recipe], jobs: int = 1) -> float:
+        """
+        Estimate how long it takes to build a set of arches of a recipe.
+
+        :param recipes: arch versions of a recipe to be built
+        :param jobs: maximum number of arches built concurrently
+        :returns: estimated duration in seconds
+        """
+        durations = []
+
+        for recipe in recipes:
+            duration = self.get(os.path.basename(recipe.path), recipe.arch)
+
+            if duration is None:
+                duration = (
+                    STATIC_ESTIMATE_BUILD
+                    if recipe.build
+                    else STATIC_ESTIMATE_PACKAGE
+                )
+
+            durations.append(duration)
+
+        if not durations:
+            return 0.0
+
+        # Concurrent arch builds take at least as long as the slowest arch
+        return max(*durations, sum(durations) / max(jobs, 1))
+
+    def _save(self) -> None:
+        """Atomically write the statistics to disk."""
+        write_json(self.path, self._durations, indent=2, sort_keys=True)
@@ -0,0 +1,276 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Record where time is spent during builds.
+
+Tracing is disabled by default and costs nothing until it is enabled with
+:func:`enable`. Spans are then recorded with their wall time, CPU time,
+number of bytes downloaded and peak memory usage, and can be saved in the
+Chrome trace event format, which can be opened with Perfetto
+(<https://ui.perfetto.dev>) or chrome://tracing.
+"""
+
+import argparse
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+    cast,
+)
+
+logger = logging.getLogger(__name__)
+
+# Number of rows of the summary table written to the log
+SUMMARY_ROWS = 15
+
+
+def _peak_rss() -> int:
+    """Get the peak resident memory of this process and its children in KiB."""
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def _cpu_time() -> float:
+    """Get the CPU time used by this process and its children in seconds."""
+    usage = os.times()
+    return (
+        usage.user + usage.system + usage.children_user + usage.children_system
+    )
+
+
+class Tracer:
+    """Collect nested spans of work from any thread."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._events: List[Dict[str, Any]] = []
+        self._threads: Dict[int, str] = {}
+        self._bytes = 0
+
+    def add_bytes(self, count: int) -> None:
+        """Count bytes downloaded from the network."""
+        with self._lock:
+            self._bytes += count
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args: Any) -> Iterator[None]:
+        """
+        Record a span of work around a block of code.
+
+        Spans started from the same thread while another one is open are
+        nested inside it. CPU time and downloaded bytes are measured for the
+        whole process, so they include the work of concurrent spans.
+
+        :param name: name of the span
+        :param category: kind of work done in the span
+        :param args: additional details to attach to the span
+        """
+        thread = threading.current_thread()
+        start = time.perf_counter()
+        start_cpu = _cpu_time()
+
+        with self._lock:
+            start_bytes = self._bytes
+
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+
+            with self._lock:
+                self._threads.setdefault(thread.ident or 0, thread.name)
+                self._events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "ts": (start - self._origin) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": thread.ident or 0,
+                        "args": {
+                            **args,
+                            "cpu_time": _cpu_time() - start_cpu,
+                            "bytes_downloaded": self._bytes - start_bytes,
+                            "peak_rss_kib": _peak_rss(),
+                        },
+                    }
+                )
+
+    def save(self, path: str) -> None:
+        """
+        Save the recorded spans in the Chrome trace event format.
+
+        :param path: path to the file to write
+        """
+        with self._lock:
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self._threads.items()
+            ]
+            events = metadata + self._events
+
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"traceEvents": events, "displayTimeUnit": "ms"},
+                file,
+                indent=1,
+            )
+
+    def summary(self) -> str:
+        """
+        Summarize the recorded spans by name.
+
+        :returns: table of the spans that took the most wall time
+        """
+        totals: Dict[str, List[float]] = {}
+
+        with self._lock:
+            for event in self._events:
+                total = totals.setdefault(event["name"], [0, 0.0, 0.0, 0])
+                total[0] += 1
+                total[1] += event["dur"] / 1e6
+                total[2] += event["args"]["cpu_time"]
+                total[3] += event["args"]["bytes_downloaded"]
+
+        rows = sorted(totals.items(), key=lambda item: -item[1][1])
+        lines = [
+            f"{'Span':<40} {'Count':>6} {'Wall (s)':>10} {'CPU (s)':>10} "
+            f"{'Downloaded':>12}"
+        ]
+
+        for name, (count, wall, cpu, downloaded) in rows[:SUMMARY_ROWS]:
+            lines.append(
+                f"{name[:40]:<40} {int(count):>6} {wall:>10.2f} {cpu:>10.2f} "
+                f"{_format_size(int(downloaded)):>12}"
+            )
+
+        if len(rows) > SUMMARY_ROWS:
+            lines.append(f"({len(rows) - SUMMARY_ROWS} more span names)")
+
+        lines.append(f"Peak memory usage: {_format_size(_peak_rss() * 1024)}")
+        return "\n".join(lines)
+
+
+def _format_size(size: int) -> str:
+    """Format a size in bytes for humans."""
+    value = float(size)
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024 or unit == "GiB":
+            break
+
+        value /= 1024
+
+    return f"{value:.1f} {unit}" if unit != "B" else f"{size} B"
+
+
+# Tracer used by the current process, if tracing is enabled
+_tracer: Optional[Tracer] = None
+
+
+def enable() -> Tracer:
+    """Enable tracing for the current process."""
+    global _tracer  # pylint:disable=global-statement
+
+    if _tracer is None:
+        _tracer = Tracer()
+
+    return _tracer
+
+
+def span(
+    name: str, category: str = "phase", **args: Any
+) -> contextlib.AbstractContextManager:
+    """
+    Record a span of work around a block of code, if tracing is enabled.
+
+    See :meth:`Tracer.span` for details.
+    """
+    if _tracer is None:
+        return contextlib.nullcontext()
+
+    return _tracer.span(name, category, **args)
+
+
+Function = TypeVar("Function", bound=Callable[..., Any])
+
+
+def traced(
+    name: str, category: str = "phase"
+) -> Callable[[Function], Function]:
+    """
+    Decorate a function to record a span each time it is called, if tracing
+    is enabled.
+
+    :param name: name of the span
+    :param category: kind of work done by the function
+    """
+
+    def decorator(function: Function) -> Function:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name, category):
+                return function(*args, **kwargs)
+
+        return cast(Function, wrapper)
+
+    return decorator
+
+
+def add_bytes(count: int) -> None:
+    """Count bytes downloaded from the network, if tracing is enabled."""
+    if _tracer is not None:
+        _tracer.add_bytes(count)
+
+
+def add_trace_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add CLI options for controlling tracing."""
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="""record how long each build phase and recipe takes and save
+        it in the Chrome trace event format, which can be opened in
+        Perfetto""",
+    )
+
+
+def start_tracing(args: argparse.Namespace) -> None:
+    """
+    Enable tracing if requested by the CLI options.
+
+    The trace is saved and summarized when the process exits.
+    """
+    if args.trace is None:
+        return
+
+    tracer = enable()
+
+    def finish() -> None:
+        tracer.save(args.trace)
+        logger.info("Trace summary:\n%s", tracer.summary())
+        logger.info("Trace saved to %s", args.trace)
+
+    atexit.register(finish)
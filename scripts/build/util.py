@@ -2,7 +2,13 @@
 # SPDX-License-Identifier: MIT
 """Collection of useful functions."""
 
+import functools
+import hashlib
 import itertools
+import json
+import os
+import shutil
+from importlib import metadata
 from typing import (
     Any,
     Callable,
@@ -42,3 +48,86 @@ def group_by(
             sorted(in_seq, key=key_fn), key=key_fn
         )
     )
+
+
+@functools.cache
+def toltecmk_version() -> str:
+    """Get the version of the installed toltecmk build system."""
+    return metadata.version("toltecmk")
+
+
+def tree_digest(path: str) -> str:
+    """
+    Compute a digest of the names and contents of all files in a directory.
+
+    :param path: directory to digest
+    :returns: hexadecimal SHA-256 digest
+    """
+    sha256 = hashlib.sha256()
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            sha256.update(os.path.relpath(file_path, path).encode() + b"\0")
+
+            with open(file_path, "rb") as file:
+                sha256.update(hashlib.sha256(file.read()).digest())
+
+    return sha256.hexdigest()
+
+
+def link_or_copy(source: str, dest: str) -> None:
+    """
+    Atomically place a file at a given path, as a hard link if possible.
+
+    :param source: file to link or copy
+    :param dest: path where the file should appear
+    """
+    temp_path = os.path.join(
+        os.path.dirname(dest), "." + os.path.basename(dest) + ".part"
+    )
+
+    try:
+        os.link(source, temp_path)
+    except FileExistsError:
+        os.remove(temp_path)
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copy2(source, temp_path)
+
+    os.replace(temp_path, dest)
+
+
+def write_json(path: str, data: Any, **options: Any) -> None:
+    """
+    Atomically write a JSON file, creating its parent directories.
+
+    :param path: path of the file to write
+    :param data: value to serialize
+    :param options: additional options for :func:`json.dump`
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, **options)
+
+    os.replace(temp_path, path)
+
+
+def list_recipes(recipe_dir: str) -> List[str]:
+    """
+    List the names of all the recipes in a directory.
+
+    :param recipe_dir: directory where recipe definitions are stored
+    :returns: sorted list of recipe names
+    """
+    return sorted(
+        entry.name
+        for entry in os.scandir(recipe_dir)
+        if entry.name[0] != "."
+        and entry.is_dir()
+        and os.path.exists(os.path.join(entry.path, "package"))
+    )
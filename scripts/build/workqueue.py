@@ -0,0 +1,453 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Distribute recipe builds to workers through a shared directory.
+
+The queue is a directory on a filesystem shared by the coordinator and all
+workers, such as an NFS mount, laid out as follows:
+
+- `pending/NAME.json`: jobs waiting to be claimed
+- `claimed/NAME@WORKER.json`: jobs being built by a worker
+- `done/NAME.json` and `failed/NAME.json`: finished jobs
+- `workers/WORKER`: heartbeat file of each worker
+- `base/`: packages available before the build started
+- `artifacts/NAME/`: packages built by each job
+- `stop`: created by the coordinator when workers should exit
+
+Workers claim a job by renaming its file from `pending/` to `claimed/`,
+which succeeds for exactly one of them. The coordinator puts the jobs of
+workers whose heartbeat stopped back into `pending/`.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from .scheduler import BuildStatus, blocked_by
+from .util import link_or_copy, write_json
+
+logger = logging.getLogger(__name__)
+
+# Interval in seconds between two heartbeats of a worker
+HEARTBEAT_INTERVAL = 5.0
+
+# Default time in seconds after which a worker whose heartbeat did not
+# change is considered dead
+WORKER_TIMEOUT = 60.0
+
+# Interval in seconds between two scans of the queue
+POLL_INTERVAL = 1.0
+
+
+class Job(NamedTuple):
+    """Build of a recipe to be done by a worker."""
+
+    # Name of the recipe to build
+    name: str
+
+    # Names of the jobs that must be done before this one
+    deps: List[str]
+
+    # Architectures of the recipe to build
+    arches: List[str]
+
+    # Jobs with a higher priority are claimed first
+    priority: float
+
+
+def _same_file(source: str, dest: str) -> bool:
+    """
+    Check if a file is a link to or a copy of another one.
+
+    Copies made by :func:`link_or_copy` keep the modification time of
+    their source, so a package rebuilt under the same name is detected
+    even if its size did not change.
+    """
+    try:
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return False
+
+    source_stat = os.stat(source)
+    return os.path.samestat(source_stat, dest_stat) or (
+        source_stat.st_size,
+        source_stat.st_mtime_ns,
+    ) == (dest_stat.st_size, dest_stat.st_mtime_ns)
+
+
+class WorkQueue:
+    """Queue of build jobs stored in a shared directory."""
+
+    def __init__(self, root: str) -> None:
+        """
+        Open a queue.
+
+        :param root: directory where the queue is stored
+        """
+        self.root = root
+        # Last heartbeat seen for each worker and when it was first seen,
+        # measured with the clock of the coordinator
+        self._heartbeats: Dict[str, Tuple[float, float]] = {}
+
+    def _path(self, *parts: str) -> str:
+        return os.path.join(self.root, *parts)
+
+    def _list(self, state: str) -> List[str]:
+        """List the job files in a given state."""
+        try:
+            return sorted(
+                entry
+                for entry in os.listdir(self._path(state))
+                if entry.endswith(".json")
+            )
+        except FileNotFoundError:
+            return []
+
+    def _names(self, state: str) -> Set[str]:
+        """Get the names of the jobs in a given state."""
+        return {
+            entry[: -len(".json")].split("@", 1)[0]
+            for entry in self._list(state)
+        }
+
+    def reset(self) -> None:
+        """Remove all the jobs and artifacts from the queue."""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+        for state in (
+            "pending",
+            "claimed",
+            "done",
+            "failed",
+            "workers",
+            "base",
+            "artifacts",
+        ):
+            os.makedirs(self._path(state), exist_ok=True)
+
+    def submit(self, jobs: Iterable[Job]) -> None:
+        """Add jobs to the queue."""
+        for job in jobs:
+            write_json(self._path("pending", job.name + ".json"), job._asdict())
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """
+        Claim the ready job with the highest priority.
+
+        :param worker: identifier of the claiming worker
+        :returns: claimed job, or None if no job is ready
+        """
+        done = self._names("done")
+        ready = []
+
+        for entry in self._list("pending"):
+            try:
+                with open(
+                    self._path("pending", entry), encoding="utf-8"
+                ) as file:
+                    job = Job(**json.load(file))
+            except (FileNotFoundError, ValueError):
+                continue
+
+            if all(dep in done for dep in job.deps):
+                ready.append(job)
+
+        for job in sorted(ready, key=lambda job: -job.priority):
+            try:
+                os.rename(
+                    self._path("pending", job.name + ".json"),
+                    self._path("claimed", f"{job.name}@{worker}.json"),
+                )
+            except FileNotFoundError:
+                # Another worker claimed it first
+                continue
+
+            return job
+
+        return None
+
+    def complete(self, job: Job, worker: str, success: bool) -> bool:
+        """
+        Mark a claimed job as finished.
+
+        :param job: finished job
+        :param worker: identifier of the worker that claimed the job
+        :param success: whether the job succeeded
+        :returns: false if the job was not claimed by this worker anymore
+            because it was requeued in the meantime
+        """
+        try:
+            os.rename(
+                self._path("claimed", f"{job.name}@{worker}.json"),
+                self._path("done" if success else "failed", job.name + ".json"),
+            )
+            return True
+        except FileNotFoundError:
+            return False
+
+    def publish(
+        self, name: str, worker: str, files: Iterable[Tuple[str, str]]
+    ) -> None:
+        """
+        Make the packages built by a job available to other workers.
+
+        :param name: name of the job
+        :param worker: identifier of the worker that built the packages
+        :param files: path to each built package and its path relative to
+            the root of the repository
+        """
+        temp_dir = self._path("artifacts", f".{name}@{worker}")
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+        for source, relpath in files:
+            dest = os.path.join(temp_dir, relpath)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            link_or_copy(source, dest)
+
+        try:
+            os.rename(temp_dir, self._path("artifacts", name))
+        except OSError:
+            # A requeued copy of this job was already published
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def publish_base(self, repo_dir: str) -> None:
+        """
+        Share the packages that exist before the build with the workers.
+
+        :param repo_dir: repository whose packages are shared
+        """
+        for dirpath, _, filenames in os.walk(repo_dir):
+            for filename in filenames:
+                if filename.endswith(".ipk"):
+                    source = os.path.join(dirpath, filename)
+                    dest = self._path("base", os.path.relpath(source, repo_dir))
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    link_or_copy(source, dest)
+
+    def sync(self, repo_dir: str) -> List[str]:
+        """
+        Copy the shared packages that are missing or outdated in a
+        repository.
+
+        Packages built by jobs take precedence over the packages with the
+        same path that existed before the build.
+
+        :param repo_dir: repository to copy the packages to
+        :returns: directories of the repository, relative to its root,
+            where packages were added or replaced
+        """
+        roots = [self._path("base")] + [
+            self._path("artifacts", entry)
+            for entry in sorted(os.listdir(self._path("artifacts")))
+            if not entry.startswith(".")
+        ]
+        sources: Dict[str, str] = {}
+
+        for root in roots:
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    source = os.path.join(dirpath, filename)
+                    sources[os.path.relpath(source, root)] = source
+
+        changed = set()
+
+        for relpath, source in sorted(sources.items()):
+            dest = os.path.join(repo_dir, relpath)
+
+            if not _same_file(source, dest):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                link_or_copy(source, dest)
+                changed.add(os.path.dirname(relpath) or ".")
+
+        return sorted(changed)
+
+    def heartbeat(self, worker: str) -> None:
+        """Signal that a worker is still alive."""
+        path = self._path("workers", worker)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "a", encoding="utf-8"):
+            os.utime(path)
+
+    def requeue_dead(self, timeout: float = WORKER_TIMEOUT) -> List[str]:
+        """
+        Put the jobs claimed by dead workers back into the queue.
+
+        A worker is considered dead if its heartbeat did not change for
+        the given time, as measured by the caller, so that clocks do not
+        need to be synchronized across hosts.
+
+        :param timeout: time in seconds without heartbeats after which a
+            worker is considered dead
+        :returns: names of the requeued jobs
+        """
+        now = time.monotonic()
+        requeued = []
+
+        for entry in self._list("claimed"):
+            name, worker = entry[: -len(".json")].split("@", 1)
+
+            try:
+                beat = os.stat(self._path("workers", worker)).st_mtime
+            except FileNotFoundError:
+                beat = 0.0
+
+            last_beat, seen = self._heartbeats.get(worker, (beat, now))
+
+            if beat != last_beat:
+                seen = now
+
+            self._heartbeats[worker] = (beat, seen)
+
+            if now - seen > timeout:
+                try:
+                    os.rename(
+                        self._path("claimed", entry),
+                        self._path("pending", name + ".json"),
+                    )
+                except FileNotFoundError:
+                    continue
+
+                logger.warning(
+                    "Worker %s stopped responding, requeuing %s", worker, name
+                )
+                requeued.append(name)
+
+        return requeued
+
+    def stop(self) -> None:
+        """Ask all workers to exit."""
+        with open(self._path("stop"), "w", encoding="utf-8"):
+            pass
+
+    def stopped(self) -> bool:
+        """Check if workers were asked to exit."""
+        return os.path.exists(self._path("stop"))
+
+    def coordinate(
+        self,
+        jobs: List[Job],
+        timeout: float = WORKER_TIMEOUT,
+        poll: float = POLL_INTERVAL,
+        keep_going: bool = False,
+    ) -> Dict[str, BuildStatus]:
+        """
+        Submit jobs and wait for workers to finish them.
+
+        When a job fails, no other job is claimed, and the coordinator waits
+        for the running jobs to finish before stopping, unless `keep_going`
+        is true, in which case only the jobs that depend on the failed one
+        are left out.
+
+        :param jobs: jobs to run, which must only depend on each other
+        :param timeout: time in seconds without heartbeats after which a
+            worker is considered dead and its job requeued
+        :param poll: interval in seconds between two scans of the queue
+        :param keep_going: keep running the jobs that do not depend on a
+            failed job
+        :returns: outcome of each job
+        """
+        self.submit(jobs)
+        graph = {job.name: job.deps for job in jobs}
+        finished: Set[str] = set()
+
+        while True:
+            self.requeue_dead(timeout)
+            done = self._names("done")
+            failed = self._names("failed")
+
+            for name in sorted((done | failed) - finished):
+                logger.info(
+                    "Recipe %s %s", name, "built" if name in done else "failed"
+                )
+                finished.add(name)
+
+            if keep_going:
+                settled = done | failed | set(blocked_by(graph, failed))
+
+                if len(settled) == len(jobs):
+                    break
+            elif failed and not self._list("claimed"):
+                break
+            elif failed and not self.stopped():
+                logger.error("Build of %s failed, stopping", ", ".join(failed))
+                self.stop()
+
+            if len(done) == len(jobs):
+                break
+
+            time.sleep(poll)
+
+        self.stop()
+        return {
+            job.name: (
+                BuildStatus.Built
+                if job.name in done
+                else (
+                    BuildStatus.Failed
+                    if job.name in failed
+                    else BuildStatus.Skipped
+                )
+            )
+            for job in jobs
+        }
+
+    def work(
+        self,
+        worker: str,
+        build: Callable[[Job], bool],
+        poll: float = POLL_INTERVAL,
+    ) -> None:
+        """
+        Claim and run jobs until the coordinator asks to stop.
+
+        :param worker: identifier of this worker, unique across all hosts
+        :param build: callback running a job, which returns true on success
+        :param poll: interval in seconds between two scans of the queue
+        """
+        stopping = threading.Event()
+
+        def beat() -> None:
+            while not stopping.wait(HEARTBEAT_INTERVAL):
+                self.heartbeat(worker)
+
+        self.heartbeat(worker)
+        heart = threading.Thread(target=beat, daemon=True)
+        heart.start()
+
+        try:
+            while not self.stopped():
+                job = self.claim(worker)
+
+                if job is None:
+                    time.sleep(poll)
+                    continue
+
+                logger.info("Claimed %s", job.name)
+
+                try:
+                    success = build(job)
+                except Exception:  # pylint:disable=broad-exception-caught
+                    logger.exception("Build of %s crashed", job.name)
+                    success = False
+
+                if not self.complete(job, worker, success):
+                    logger.warning(
+                        "Job %s was requeued while it was running", job.name
+                    )
+        finally:
+            stopping.set()
+            heart.join()
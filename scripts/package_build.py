@@ -13,11 +13,15 @@ from typing import (
     Optional,
 )
 from build import paths
+from build.artifacts import add_artifact_cache_arguments, open_artifact_cache
+from build.builder import Builder, add_builder_arguments, open_container_limit
+from build.index import Indexer
+from build.recipes import RecipeCache
 from build.repo import Repo
-from toltec import parse_recipe  # type: ignore
-from toltec.builder import Builder  # type: ignore
+from build.resources import ResourceHints
+from build.sources import add_source_cache_arguments, open_source_cache
+from build.trace import add_trace_arguments, start_tracing
 from toltec.recipe import Package  # type: ignore
-from toltec.repo import make_index  # type: ignore
 from toltec.util import argparse_add_verbose, LOGGING_FORMAT  # type: ignore
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -44,30 +48,72 @@ parser.add_argument(
     help="list of packages to build (default: all packages from the recipe)",
 )
 
+add_builder_arguments(parser)
+add_artifact_cache_arguments(parser)
+add_source_cache_arguments(parser)
+add_trace_arguments(parser)
 argparse_add_verbose(parser)
 
 args = parser.parse_args()
 logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
-repo = Repo(paths.RECIPE_DIR, paths.REPO_DIR)
-builder = Builder(paths.WORK_DIR, paths.REPO_DIR)
-arch_packages: Optional[Dict[str, Optional[List[Package]]]] = None
+start_tracing(args)
+repo = Repo(
+    paths.RECIPE_DIR,
+    paths.REPO_DIR,
+    lazy=True,
+    cache=RecipeCache(os.path.join(paths.CACHE_DIR, "recipes")),
+)
+
+if args.recipe_name not in repo.generic_recipes:
+    parser.error(f"Unknown recipe {args.recipe_name}")
+
+recipe_bundle = repo.generic_recipes[args.recipe_name]
+build_matrix: Optional[Dict[str, Optional[List[Package]]]] = None
+
+if args.arch_name or args.packages_names:
+    build_matrix = {}
+
+    for arch in args.arch_name or recipe_bundle:
+        if arch not in recipe_bundle:
+            parser.error(
+                f"Recipe {args.recipe_name} has no architecture {arch}"
+            )
+
+        if args.packages_names:
+            unknown = set(args.packages_names) - set(
+                recipe_bundle[arch].packages
+            )
+
+            if unknown:
+                parser.error(
+                    f"Recipe {args.recipe_name} has no package "
+                    + ", ".join(sorted(unknown))
+                )
+
+            build_matrix[arch] = [
+                recipe_bundle[arch].packages[pkg_name]
+                for pkg_name in args.packages_names
+            ]
+        else:
+            build_matrix[arch] = None
 
 with Builder(
-    os.path.join(paths.WORK_DIR, args.recipe_name), paths.REPO_DIR
+    os.path.join(paths.WORK_DIR, args.recipe_name),
+    paths.REPO_DIR,
+    artifacts=open_artifact_cache(args),
+    sources=open_source_cache(args),
+    arch_jobs=args.arch_jobs,
+    containers=open_container_limit(args),
+    resources=ResourceHints(),
 ) as builder:
-    recipe_bundle = parse_recipe(f"package/{args.recipe_name}")
-    build_matrix: Optional[Dict[str, Optional[List[Package]]]] = None
-    if args.arch_name or args.packages_names:
-        build_matrix = {}
-        for arch, recipes in recipe_bundle.items():
-            if args.package_name:
-                build_matrix[arch] = [
-                    recipes.packages[pkg_name] for pkg_name in args.package_name
-                ]
-            else:
-                build_matrix[arch] = None
+    if builder.sources is not None:
+        builder.sources.prefetch(
+            source
+            for arch in (build_matrix or recipe_bundle)
+            for source in recipe_bundle[arch].sources
+        )
 
     if not builder.make(recipe_bundle, build_matrix, False):
         sys.exit(1)
 
-    make_index(paths.REPO_DIR)
+    Indexer(paths.REPO_DIR, paths.INDEX_CACHE_PATH).update()
@@ -6,17 +6,39 @@
 import argparse
 import logging
 import os
+import socket
+import sys
+from datetime import timedelta
 from typing import (
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Mapping,
     Optional,
+    Tuple,
 )
 from build import paths
+from build.artifacts import add_artifact_cache_arguments, open_artifact_cache
+from build.builder import Builder, add_builder_arguments, open_container_limit
+from build.changes import changed_paths, changed_recipes
+from build.index import Indexer
+from build.journal import Journal
+from build.recipes import RecipeCache
+from build.remote import DEFAULT_JOBS
 from build.repo import Repo, PackageStatus
+from build.resources import (
+    ResourceHints,
+    add_resource_arguments,
+    resource_budget,
+)
+from build.sources import add_source_cache_arguments, open_source_cache
+from build.trace import add_trace_arguments, span, start_tracing
+from build.scheduler import BuildStatus, Scheduler, blocked_by
+from build.stats import BuildStats
+from build.workqueue import WORKER_TIMEOUT, Job, WorkQueue
 from toltec.recipe import Package  # type: ignore
 from toltec import parse_recipe  # type: ignore
-from toltec.builder import Builder  # type: ignore
-from toltec.repo import make_index  # type: ignore
 from toltec.util import argparse_add_verbose, LOGGING_FORMAT  # type: ignore
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -28,8 +50,119 @@ parser.add_argument(
     help="only keep new packages that do not exist on the remote repository",
 )
 
+parser.add_argument(
+    "--deltas",
+    action="store_true",
+    help="""create delta packages from the version of each newly built
+    package published on the remote repository, listed in a deltas.json
+    index next to each package index""",
+)
+
+parser.add_argument(
+    "--parse-jobs",
+    type=int,
+    metavar="N",
+    help="""number of worker processes used for parsing recipes
+    (default: number of CPUs)""",
+)
+
+parser.add_argument(
+    "--fetch-jobs",
+    type=int,
+    default=DEFAULT_JOBS,
+    metavar="N",
+    help="""maximum number of concurrent requests to the remote repository
+    (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    metavar="N",
+    help="""maximum number of recipes to build concurrently; recipes are
+    started as soon as the recipes they depend on are built
+    (default: %(default)s)""",
+)
+
+add_builder_arguments(parser)
+add_resource_arguments(parser)
+
+parser.add_argument(
+    "--prefetch-only",
+    action="store_true",
+    help="""only download the source files needed for building missing
+    packages into the source cache, without building anything""",
+)
+
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="""resume the previous build from its journal: recipes that it
+    built are not checked or built again as long as their recipe is
+    unchanged and their packages are intact""",
+)
+
+parser.add_argument(
+    "-k",
+    "--keep-going",
+    action="store_true",
+    help="""when a recipe fails to build, keep building the recipes that
+    do not depend on it instead of stopping""",
+)
+
+parser.add_argument(
+    "-c",
+    "--changed",
+    metavar="REVRANGE",
+    help="""only build the recipes affected by the changes in a range of Git
+    revisions (for example, origin/testing...HEAD) and the recipes that
+    depend on them; other recipes are not parsed and the package listing is
+    not regenerated""",
+)
+
+add_artifact_cache_arguments(parser)
+add_source_cache_arguments(parser)
+add_trace_arguments(parser)
 argparse_add_verbose(parser)
 
+distributed = parser.add_mutually_exclusive_group()
+
+distributed.add_argument(
+    "--coordinator",
+    metavar="QUEUE",
+    help="""instead of building recipes locally, submit them as jobs to a
+    queue directory shared with workers, wait for the workers to build them
+    and collect the built packages; any previous content of the queue is
+    removed""",
+)
+
+distributed.add_argument(
+    "--worker",
+    metavar="QUEUE",
+    help="""build the jobs submitted by a coordinator to a shared queue
+    directory until the coordinator finishes; the coordinator must be
+    started first""",
+)
+
+parser.add_argument(
+    "--worker-timeout",
+    type=float,
+    default=WORKER_TIMEOUT,
+    metavar="SECONDS",
+    help="""time after which the jobs of a worker that stopped responding
+    are given to other workers (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "--revalidate",
+    action="store_true",
+    help="""check the packages that already exist locally against the remote
+    repository using conditional requests, and fetch them again if they
+    changed on the remote""",
+)
+
 group = parser.add_mutually_exclusive_group()
 
 group.add_argument(
@@ -53,52 +186,431 @@ group.add_argument(
 args = parser.parse_args()
 remote = args.remote_repo if not args.local else None
 logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+start_tracing(args)
+logger = logging.getLogger(__name__)
+
+stats = BuildStats(paths.STATS_PATH)
+artifacts = open_artifact_cache(args)
+sources = open_source_cache(args)
+containers = open_container_limit(args)
+resources = ResourceHints()
+budget = resource_budget(args)
+
+
+def make_recipe(
+    recipe_name: str, arches: List[str], work_dir: str, repo_dir: str
+) -> Optional[List[str]]:
+    """
+    Build the packages of a recipe for a set of arches.
+
+    :param recipe_name: name of the recipe to build
+    :param arches: arches to build (default: all arches of the recipe)
+    :param work_dir: working directory for the build
+    :param repo_dir: repository where built packages are stored
+    :returns: paths of the built packages relative to the repository, or
+        None if the build failed
+    """
+    with Builder(
+        work_dir,
+        repo_dir,
+        stats,
+        artifacts,
+        sources,
+        args.arch_jobs,
+        containers,
+        resources,
+        budget is not None and args.cpus is not None,
+    ) as builder:
+        recipe_bundle = parse_recipe(
+            os.path.join(paths.RECIPE_DIR, recipe_name)
+        )
+        build_matrix: Dict[str, Optional[List[Package]]] = {
+            arch: list(recipe_bundle[arch].packages.values())
+            for arch in (arches or recipe_bundle)
+        }
+
+        if not builder.make(recipe_bundle, build_matrix, False):
+            return None
+
+        return [
+            package.filename()
+            for packages in build_matrix.values()
+            for package in packages or []
+        ]
+
+
+if args.worker is not None:
+    queue = WorkQueue(args.worker)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    worker_dir = os.path.join(paths.WORKERS_DIR, worker_id)
+    worker_repo = os.path.join(worker_dir, "repo")
+    os.makedirs(worker_repo, exist_ok=True)
+    worker_indexer = Indexer(worker_repo)
+
+    def run_job(job: Job) -> bool:
+        """Build a job using the packages published by previous jobs."""
+        worker_indexer.update(queue.sync(worker_repo))
+        filenames = make_recipe(
+            job.name,
+            job.arches,
+            os.path.join(worker_dir, "package", job.name),
+            worker_repo,
+        )
+
+        if filenames is None:
+            return False
+
+        queue.publish(
+            job.name,
+            worker_id,
+            (
+                (os.path.join(worker_repo, filename), filename)
+                for filename in filenames
+            ),
+        )
+        return True
+
+    logger.info("Worker %s waiting for jobs in %s", worker_id, args.worker)
+    queue.work(worker_id, run_job)
+    sys.exit(0)
 
-repo = Repo(paths.RECIPE_DIR, paths.REPO_DIR)
-results = repo.fetch_packages(remote)
+seeds: Optional[List[str]] = None
+selected_recipes: Optional[List[str]] = None
 
+if args.changed is not None:
+    seeds = changed_recipes(changed_paths(args.changed))
+
+repo = Repo(
+    paths.RECIPE_DIR,
+    paths.REPO_DIR,
+    jobs=args.parse_jobs,
+    lazy=seeds is not None,
+    cache=RecipeCache(os.path.join(paths.CACHE_DIR, "recipes")),
+    metadata_dir=paths.REMOTE_METADATA_DIR,
+    dependency_index=paths.DEPENDENCY_INDEX_PATH,
+)
+
+if seeds is not None:
+    selected_recipes = repo.affected_recipes(seeds)
+    logger.info(
+        "Recipes affected by %s: %s",
+        args.changed,
+        ", ".join(selected_recipes) or "none",
+    )
+
+candidates = (
+    selected_recipes
+    if selected_recipes is not None
+    else list(repo.generic_recipes)
+)
+fetched: Dict[str, Dict[str, List[Package]]] = {}
+missing: Dict[str, Dict[str, List[Package]]] = {}
+# Packages of other recipes fetched because they are needed for building
+build_deps_fetched: List[Package] = []
 os.makedirs(paths.REPO_DIR, exist_ok=True)
-make_index(paths.REPO_DIR)
-
-fetched = results[PackageStatus.Fetched]
-missing = results[PackageStatus.Missing]
-ordered_missing = repo.order_dependencies(
-    [repo.generic_recipes[name] for name in missing]
-)
-
-for generic_recipe in ordered_missing:
-    # Will need to rework toltec_old.repo into something inline and actually easy to work
-    # with Currently generic_recipe is a Dict[str, Recipe] where the index is the arch. Every
-    # single entry will have the same path, so we can use that for the name of the generic
-    # recipe we are actually building.
-    name = os.path.basename(next(iter(generic_recipe.values())).path)
-    if missing[name]:
-        with Builder(
-            os.path.join(paths.WORK_DIR, name), paths.REPO_DIR
-        ) as builder:
-            recipe_bundle = parse_recipe(os.path.join(paths.RECIPE_DIR, name))
-            build_matrix: Optional[Dict[str, Optional[List[Package]]]] = None
-            old_build_matrix = missing[name]
-            if old_build_matrix:
-                build_matrix = {}
-
-                for arch, recipes in old_build_matrix.items():
-                    build_matrix[arch] = [
-                        recipe_bundle[arch].packages[pkg_name]
-                        for pkg_name in recipe_bundle[arch].packages
-                    ]
-            builder.make(recipe_bundle, build_matrix, False)
-
-        make_index(paths.REPO_DIR)
+# The journal is only opened once a build is sure to start, so that
+# prefetching does not discard the journal of the previous build
+journal: Optional[Journal] = None
+resumed: List[str] = []
+
+indexer = Indexer(paths.REPO_DIR, paths.INDEX_CACHE_PATH)
+indexer.update()
+
+
+def prefetch_sources(recipe_name: str) -> None:
+    """Download the missing source files needed for building a recipe."""
+    if sources is not None:
+        sources.prefetch(
+            (
+                source
+                for recipe in (
+                    repo.generic_recipes[recipe_name][arch]
+                    for arch in missing[recipe_name]
+                )
+                if artifacts is None
+                or artifacts.lookup(artifacts.key(recipe)) is None
+                for source in recipe.sources
+            ),
+            args.fetch_jobs,
+        )
+
+
+def probe() -> Iterator[Tuple[str, bool]]:
+    """
+    Check which recipes need building, recipe by recipe.
+
+    Packages fetched for a recipe and the packages needed for building it
+    are indexed, and its source files downloaded, before the recipe is
+    reported, so that it can be built as soon as its dependencies are
+    available.
+
+    :returns: name of each recipe along with whether it needs building
+    """
+    for recipe_name in resumed:
+        yield recipe_name, False
+
+    for recipe_name, recipe_statuses in repo.stream_packages(
+        remote,
+        args.fetch_jobs,
+        plan_only=args.diff,
+        names=[name for name in candidates if name not in resumed],
+        revalidate=args.revalidate,
+    ):
+        if PackageStatus.Fetched in recipe_statuses:
+            fetched[recipe_name] = recipe_statuses[PackageStatus.Fetched]
+
+            if not args.diff:
+                indexer.update(fetched[recipe_name].keys())
+
+        if PackageStatus.Missing not in recipe_statuses:
+            yield recipe_name, False
+            continue
+
+        missing[recipe_name] = recipe_statuses[PackageStatus.Missing]
+
+        if journal is not None:
+            journal.plan(recipe_name, missing[recipe_name])
+
+        build_deps = repo.fetch_build_dependencies(
+            [repo.generic_recipes[recipe_name]], remote, args.fetch_jobs
+        )
+
+        build_deps_fetched.extend(build_deps)
+
+        if build_deps:
+            indexer.update({package.parent.arch for package in build_deps})
+
+        prefetch_sources(recipe_name)
+        yield recipe_name, True
+
+    logger.info("Found %d recipes to build", len(missing))
+
+
+def make_scheduler(
+    recipe_names: Iterable[str], arches: Mapping[str, Iterable[str]]
+) -> Scheduler:
+    """
+    Schedule the builds of a set of recipes.
+
+    :param recipe_names: names of the recipes to build
+    :param arches: arches to build for each recipe
+    """
+    recipe_names = list(recipe_names)
+    return Scheduler(
+        repo.dependency_graph(
+            [repo.generic_recipes[name] for name in recipe_names]
+        ),
+        args.jobs,
+        {
+            name: stats.estimate(
+                (repo.generic_recipes[name][arch] for arch in arches[name]),
+                args.arch_jobs,
+            )
+            for name in recipe_names
+        },
+        {
+            name: resources.estimate(
+                (repo.generic_recipes[name][arch] for arch in arches[name]),
+                args.arch_jobs,
+            )
+            for name in recipe_names
+        },
+        budget,
+    )
+
+
+def build(recipe_name: str) -> bool:
+    """Build the missing packages of a recipe."""
+    return (
+        make_recipe(
+            recipe_name,
+            list(missing[recipe_name]),
+            os.path.join(paths.WORK_DIR, recipe_name),
+            paths.REPO_DIR,
+        )
+        is not None
+    )
+
+
+def record(recipe_name: str, build_status: BuildStatus) -> None:
+    """Record the outcome of a recipe build in the journal."""
+    if journal is None:
+        return
+
+    journal.outcome(
+        recipe_name,
+        build_status,
+        RecipeCache.key(os.path.join(paths.RECIPE_DIR, recipe_name)),
+        paths.REPO_DIR,
+        (
+            package.filename()
+            for packages in missing[recipe_name].values()
+            for package in packages
+            if build_status == BuildStatus.Built
+        ),
+    )
+
+
+def finish(recipe_name: str, build_status: BuildStatus) -> None:
+    """Make newly built packages available to the next builds."""
+    if build_status == BuildStatus.Built:
+        indexer.update(missing[recipe_name].keys())
+
+    record(recipe_name, build_status)
+
+
+def summarize(
+    graph: Mapping[str, Iterable[str]], outcomes: Mapping[str, BuildStatus]
+) -> None:
+    """Report the outcome of all recipe builds."""
+    failed = [
+        recipe_name
+        for recipe_name, outcome in outcomes.items()
+        if outcome == BuildStatus.Failed
+    ]
+    blockers = blocked_by(graph, failed)
+    counts = {
+        kind: sum(1 for outcome in outcomes.values() if outcome == kind)
+        for kind in BuildStatus
+    }
+    logger.info(
+        "Built %d recipes, %d failed, %d skipped, %d built by the previous "
+        "build",
+        counts[BuildStatus.Built],
+        counts[BuildStatus.Failed],
+        counts[BuildStatus.Skipped],
+        len(resumed),
+    )
+
+    for recipe_name, outcome in outcomes.items():
+        if recipe_name in blockers:
+            logger.error(
+                "Recipe %s: %s because %s failed",
+                recipe_name,
+                outcome.name.lower(),
+                ", ".join(blockers[recipe_name]),
+            )
+        elif outcome != BuildStatus.Built:
+            logger.error("Recipe %s: %s", recipe_name, outcome.name.lower())
+
+
+if args.prefetch_only:
+    for _ in probe():
+        pass
+
+    sys.exit(0)
+
+journal = Journal(paths.JOURNAL_PATH, args.resume)
+
+if args.resume:
+    resumed = journal.completed(
+        paths.REPO_DIR,
+        {
+            name: RecipeCache.key(os.path.join(paths.RECIPE_DIR, name))
+            for name in candidates
+        },
+    )
+    logger.info("Recipes built by the previous build: %d", len(resumed))
+
+if args.coordinator is not None:
+    # The coordinator needs to know every recipe to build before starting
+    for _ in probe():
+        pass
+
+with span("build recipes"):
+    if args.coordinator is not None:
+        scheduler = make_scheduler(missing, missing)
+        logger.info(
+            "Predicted build time for %d recipes with %d jobs: %s",
+            len(scheduler.graph),
+            scheduler.jobs,
+            timedelta(seconds=round(scheduler.predict_makespan())),
+        )
+        queue = WorkQueue(args.coordinator)
+        queue.reset()
+        queue.publish_base(paths.REPO_DIR)
+        statuses = queue.coordinate(
+            [
+                Job(
+                    name=name,
+                    deps=sorted(set(deps)),
+                    arches=list(missing[name]),
+                    priority=scheduler.priorities.get(name, 0.0),
+                )
+                for name, deps in scheduler.graph.items()
+            ],
+            args.worker_timeout,
+            keep_going=args.keep_going,
+        )
+        queue.sync(paths.REPO_DIR)
+
+        for name, status in statuses.items():
+            record(name, status)
+    else:
+        # Start building recipes that are known to be missing while the
+        # others are still being checked; priorities are computed as if
+        # every arch of every recipe needed building
+        scheduler = make_scheduler(candidates, repo.generic_recipes)
+        logger.info(
+            "Predicted build time if all %d recipes need building with %d "
+            "jobs: at most %s",
+            len(scheduler.graph),
+            scheduler.jobs,
+            timedelta(seconds=round(scheduler.predict_makespan())),
+        )
+        statuses = scheduler.run(build, finish, probe(), args.keep_going)
+
+        for name, status in statuses.items():
+            if status == BuildStatus.Skipped:
+                record(name, status)
+
+summarize(scheduler.graph, statuses)
+
+if any(status != BuildStatus.Built for status in statuses.values()):
+    sys.exit(1)
 
 if args.diff:
-    for name in fetched:
-        for packages in fetched[name].values():
-            for package in packages:
-                filename = package.filename()
-                local_path = os.path.join(repo.repo_dir, filename)
-                os.remove(local_path)
-
-make_index(paths.REPO_DIR)
-repo.make_listing()
+    built = {
+        package.filename()
+        for missing_arches in missing.values()
+        for packages in missing_arches.values()
+        for package in packages
+    }
+
+    downloaded = [
+        package
+        for fetched_arches in fetched.values()
+        for packages in fetched_arches.values()
+        for package in packages
+    ] + build_deps_fetched
+
+    for package in downloaded:
+        filename = package.filename()
+        local_path = os.path.join(repo.repo_dir, filename)
+
+        if filename not in built and os.path.exists(local_path):
+            os.remove(local_path)
+
+indexer.update()
+
+if args.deltas:
+    if remote is None:
+        logger.warning("Delta packages need a remote repository")
+    else:
+        repo.make_deltas(
+            (
+                package
+                for recipe_name, outcome in statuses.items()
+                if outcome == BuildStatus.Built
+                for packages in missing[recipe_name].values()
+                for package in packages
+            ),
+            remote,
+            paths.DELTA_BASE_DIR,
+            args.fetch_jobs,
+        )
+
+if selected_recipes is None:
+    repo.make_listing()
+
 repo.make_compatibility()
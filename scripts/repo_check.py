@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Check that a local repository and a remote repository are identical."""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from build.compare import FileStatus, check_repo
+from build.remote import DEFAULT_JOBS
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT  # type: ignore
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "local_repo",
+    metavar="LOCALREPO",
+    help="root of the local repository",
+)
+
+parser.add_argument(
+    "remote_repo",
+    metavar="REMOTEREPO",
+    nargs="?",
+    default="https://toltec-dev.org/testing",
+    help="root of the remote repository (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=DEFAULT_JOBS,
+    metavar="N",
+    help="""maximum number of remote files downloaded and compared
+    concurrently (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "-u",
+    "--unified",
+    action="store_true",
+    help="show differences between text files as unified diffs",
+)
+
+parser.add_argument(
+    "--report",
+    metavar="PATH",
+    help="write a machine-readable report of the comparison as JSON",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+logger = logging.getLogger(__name__)
+
+if not os.path.isfile(os.path.join(args.local_repo, "Packages")):
+    logger.error("Local repository is missing packages index")
+    sys.exit(1)
+
+files = []
+
+for report in check_repo(
+    args.local_repo, args.remote_repo, args.jobs, args.unified
+):
+    logger.info("Checking %s", report.path)
+
+    for difference in report.differences:
+        print(difference)
+
+    files.append(
+        {
+            "path": report.path,
+            "status": report.status.name,
+            "differences": report.differences,
+        }
+    )
+
+identical = all(file["status"] == FileStatus.Identical.name for file in files)
+
+if args.report is not None:
+    with open(args.report, "w", encoding="utf-8") as report_file:
+        json.dump(
+            {
+                "local": args.local_repo,
+                "remote": args.remote_repo,
+                "identical": identical,
+                "files": files,
+            },
+            report_file,
+            indent=2,
+        )
+
+if not identical:
+    logger.error("Some files differ")
+    sys.exit(1)
+
+logger.info("Successful")
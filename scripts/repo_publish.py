@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Publish a local repository to a directory, only copying what changed."""
+
+import argparse
+import logging
+from build import paths
+from build.publish import DEFAULT_JOBS, publish
+from toltec.util import argparse_add_verbose, LOGGING_FORMAT  # type: ignore
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "target",
+    metavar="TARGET",
+    help="directory to publish to, such as the root of a channel",
+)
+
+parser.add_argument(
+    "-s",
+    "--source",
+    metavar="DIR",
+    default=paths.REPO_DIR,
+    help="root of the local repository (default: %(default)s)",
+)
+
+parser.add_argument(
+    "-l",
+    "--link-dest",
+    metavar="DIR",
+    action="append",
+    default=[],
+    help="""published directory, such as another channel on the same
+    file system, whose files are hard-linked into the target when identical
+    instead of copied (can be repeated)""",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    metavar="N",
+    type=int,
+    default=DEFAULT_JOBS,
+    help="""maximum number of files hashed or copied concurrently
+    (default: %(default)s)""",
+)
+
+parser.add_argument(
+    "-n",
+    "--dry-run",
+    action="store_true",
+    help="only print what would change",
+)
+
+argparse_add_verbose(parser)
+
+args = parser.parse_args()
+logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+logger = logging.getLogger(__name__)
+
+stats = publish(
+    args.source, args.target, args.link_dest, args.jobs, args.dry_run
+)
+
+for action, filenames in stats._asdict().items():
+    for filename in filenames:
+        print(f"{action} {filename}")
+
+logger.info(
+    "%s %d files, linked %d and removed %d",
+    "Would copy" if args.dry_run else "Copied",
+    len(stats.copied),
+    len(stats.linked),
+    len(stats.removed),
+)
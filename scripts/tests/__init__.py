@@ -0,0 +1,3 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for the build tooling."""
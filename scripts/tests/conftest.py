@@ -0,0 +1,17 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Fixtures shared by the tests of the build tooling."""
+
+from typing import Iterator
+
+import pytest
+
+from .helpers import FakeRemote
+
+
+@pytest.fixture(name="remote")
+def fixture_remote() -> Iterator[FakeRemote]:
+    """Provide a fake remote repository."""
+    server = FakeRemote()
+    yield server
+    server.close()
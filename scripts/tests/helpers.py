@@ -0,0 +1,265 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Helpers shared by the tests of the build tooling."""
+
+import itertools
+import os
+import socket
+import textwrap
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from toltec import ipk  # type: ignore
+
+# Fault injected in the response to a request: an HTTP status to answer
+# with, or DROP to close the connection in the middle of the body
+Fault = Union[int, str]
+DROP = "drop"
+
+
+class Request(NamedTuple):
+    """Request received by a fake remote."""
+
+    # Path of the requested file, relative to the remote root
+    path: str
+
+    # Headers of the request
+    headers: Dict[str, str]
+
+    # Status of the response
+    status: int
+
+
+class FakeRemote:  # pylint:disable=too-many-instance-attributes
+    """Remote repository served over HTTP from memory, for tests."""
+
+    def __init__(self) -> None:
+        """Start serving an empty remote on a free local port."""
+        self.files: Dict[str, bytes] = {}
+        self.etags: Dict[str, str] = {}
+        self.modified: Dict[str, float] = {}
+        self.faults: Dict[str, List[Fault]] = {}
+        self.requests: List[Request] = []
+        self.connections: Set[Tuple[str, int]] = set()
+        self._lock = threading.Lock()
+        self._versions = itertools.count()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}
+        )
+        self._thread.start()
+
+    @property
+    def url(self) -> str:
+        """Root URL of the remote."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def close(self) -> None:
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def add(self, path: str, data: bytes, modified: float = 1e9) -> None:
+        """
+        Publish a file, replacing any previous version.
+
+        :param path: path of the file relative to the remote root
+        :param data: contents of the file
+        :param modified: modification time of the file
+        """
+        with self._lock:
+            self.files[path] = data
+            self.etags[path] = f'"{next(self._versions)}"'
+            self.modified[path] = modified
+
+    def fail(self, path: str, *faults: Fault) -> None:
+        """Inject faults in the next responses to requests for a file."""
+        with self._lock:
+            self.faults.setdefault(path, []).extend(faults)
+
+    def count(self, path: str) -> int:
+        """Count the requests received for a file."""
+        return sum(1 for request in self.requests if request.path == path)
+
+    def respond(
+        self, path: str, headers: Dict[str, str]
+    ) -> Tuple[int, Dict[str, str], bytes, bool]:
+        """
+        Decide how to answer a request.
+
+        :returns: status, headers and body of the response, and whether
+            the connection must be dropped in the middle of the body
+        """
+        with self._lock:
+            faults = self.faults.get(path)
+            fault = faults.pop(0) if faults else None
+
+            if isinstance(fault, int):
+                return fault, {}, b"", False
+
+            if path not in self.files:
+                return 404, {}, b"", False
+
+            data = self.files[path]
+            etag = self.etags[path]
+            last_modified = formatdate(self.modified[path], usegmt=True)
+
+        validators = {"ETag": etag, "Last-Modified": last_modified}
+
+        if "If-None-Match" in headers:
+            if headers["If-None-Match"] == etag:
+                return 304, validators, b"", False
+        elif "If-Modified-Since" in headers:
+            since = parsedate_to_datetime(headers["If-Modified-Since"])
+
+            if self.modified[path] <= since.timestamp():
+                return 304, validators, b"", False
+
+        status = 200
+        range_header = headers.get("Range", "")
+        if_range = headers.get("If-Range")
+
+        if range_header.startswith("bytes=") and if_range in (
+            None,
+            etag,
+            last_modified,
+        ):
+            offset = int(range_header[len("bytes=") :].rstrip("-"))
+
+            if offset >= len(data):
+                return 416, {}, b"", False
+
+            validators["Content-Range"] = (
+                f"bytes {offset}-{len(data) - 1}/{len(data)}"
+            )
+            data = data[offset:]
+            status = 206
+
+        return status, validators, data, fault == DROP
+
+    def record(self, request: Request, address: Tuple[str, int]) -> None:
+        """Remember a request and the connection it was received on."""
+        with self._lock:
+            self.requests.append(request)
+            self.connections.add(address)
+
+    def _handler(self) -> type:
+        """Make the request handler class bound to this remote."""
+        remote = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Serve the files of the remote."""
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:  # pylint:disable=invalid-name
+                """Answer a request for a file."""
+                path = self.path.lstrip("/")
+                headers = dict(self.headers.items())
+                status, extra, body, drop = remote.respond(path, headers)
+                remote.record(
+                    Request(path, headers, status), self.client_address
+                )
+
+                self.send_response(status)
+
+                for key, value in extra.items():
+                    self.send_header(key, value)
+
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+
+                if drop:
+                    self.wfile.write(body[: len(body) // 2])
+                    self.wfile.flush()
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    # pylint:disable-next=attribute-defined-outside-init
+                    self.close_connection = True
+                else:
+                    self.wfile.write(body)
+
+            def log_message(  # pylint:disable=arguments-differ
+                self, *_: object
+            ) -> None:
+                """Keep the test output quiet."""
+
+        return Handler
+
+
+def read(path: Path) -> bytes:
+    """Read the contents of a file."""
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def write_recipes(
+    recipe_dir: str,
+    names: List[str],
+    makedepends: Optional[Dict[str, List[str]]] = None,
+) -> None:
+    """
+    Create minimal recipes, each defining a single package for rmall.
+
+    :param recipe_dir: directory where the recipes are created
+    :param names: names of the recipes and of their package
+    :param makedepends: build dependencies of each recipe
+    """
+    makedepends = makedepends or {}
+
+    for name in names:
+        deps = " ".join(makedepends.get(name, []))
+
+        os.makedirs(os.path.join(recipe_dir, name))
+
+        with open(
+            os.path.join(recipe_dir, name, "package"), "w", encoding="utf-8"
+        ) as file:
+            file.write(
+                textwrap.dedent(
+                    f"""\
+                    #!/usr/bin/env bash
+                    pkgnames=({name})
+                    pkgdesc="Test package"
+                    url=https://example.org
+                    pkgver=1.0-1
+                    timestamp=2021-01-01T00:00Z
+                    section=utils
+                    maintainer="Test <test@example.org>"
+                    license=MIT
+                    archs=(rmall)
+                    makedepends=({deps})
+
+                    package() {{
+                        :
+                    }}
+                    """
+                )
+            )
+
+
+def write_ipk(path: str, control: str, tree_dir: str) -> None:
+    """
+    Create a package archive.
+
+    :param path: path of the archive to create
+    :param control: contents of the control file of the package
+    :param tree_dir: directory holding the files of the package
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "wb") as file:
+        ipk.write(file, 1600000000, control, {}, tree_dir)
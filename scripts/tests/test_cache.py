@@ -0,0 +1,80 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for the size-bounded on-disk caches."""
+
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from build.cache import Cache
+
+
+def test_store_keeps_existing_entry(tmp_path: Path) -> None:
+    """Storing an entry that exists leaves the existing one in place."""
+    cache = Cache(str(tmp_path), max_size=1024)
+    cache.write("aaaa", "file", b"first")
+    path = cache.lookup("aaaa")
+    assert path is not None
+    inode = os.stat(os.path.join(path, "file")).st_ino
+
+    cache.write("aaaa", "file", b"second")
+
+    assert os.stat(os.path.join(path, "file")).st_ino == inode
+    assert cache.read("aaaa", "file") == b"first"
+    assert os.listdir(tmp_path / "aa") == ["aaaa"]
+
+
+def test_evict_least_recently_used(tmp_path: Path) -> None:
+    """Entries unused during the run are evicted oldest first."""
+    old = Cache(str(tmp_path), max_size=25)
+
+    for number, key in enumerate(("aaaa", "bbbb", "cccc")):
+        old.write(key, "file", b"x" * 10)
+        os.utime(old.path(key), (number, number))
+
+    cache = Cache(str(tmp_path), max_size=25)
+    cache.write("dddd", "file", b"x" * 10)
+
+    assert cache.lookup("aaaa") is None
+    assert cache.lookup("bbbb") is None
+    assert cache.lookup("cccc") is not None
+    assert cache.lookup("dddd") is not None
+
+
+def test_evict_spares_used_entries(tmp_path: Path) -> None:
+    """Entries returned during the run are never evicted."""
+    old = Cache(str(tmp_path), max_size=1024)
+
+    for number, key in enumerate(("aaaa", "bbbb")):
+        old.write(key, "file", b"x" * 10)
+        os.utime(old.path(key), (number, number))
+
+    cache = Cache(str(tmp_path), max_size=15)
+    assert cache.lookup("aaaa") is not None
+    cache.write("cccc", "file", b"x" * 10)
+
+    assert cache.read("aaaa", "file") == b"x" * 10
+    assert cache.lookup("bbbb") is None
+    assert cache.read("cccc", "file") == b"x" * 10
+
+
+def test_store_scans_once(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Filling a cache below its limit only scans it once."""
+    cache = Cache(str(tmp_path), max_size=1024)
+    scans: List[str] = []
+    entries = cache._entries  # pylint:disable=protected-access
+
+    def count() -> List[Tuple[str, float, int]]:
+        scans.append("scan")
+        return entries()
+
+    monkeypatch.setattr(cache, "_entries", count)
+
+    for number in range(20):
+        cache.write(f"{number:04}", "file", b"x")
+
+    assert len(scans) == 1
@@ -0,0 +1,42 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for comparing files and archives."""
+
+import io
+
+from build.compare import compare
+
+
+def test_default_format_matches_diff() -> None:
+    """Text differences use the default output format of diff(1)."""
+    differences = compare(
+        io.BytesIO(b"a\nb\nc\nd\n"),
+        io.BytesIO(b"a\nB\nc\nd\ne\n"),
+        "local x",
+        "remote x",
+    )
+
+    assert differences == [
+        "Files local x and remote x differ:\n2c2\n< b\n---\n> B\n4a5\n> e"
+    ]
+
+
+def test_unified_format() -> None:
+    """Text differences can be shown as a unified diff."""
+    differences = compare(
+        io.BytesIO(b"a\nb\n"),
+        io.BytesIO(b"a\nc\n"),
+        "local x",
+        "remote x",
+        unified=True,
+    )
+
+    assert differences == [
+        "Files local x and remote x differ:\n--- local x\n+++ remote x\n"
+        "@@ -1,2 +1,2 @@\n a\n-b\n+c"
+    ]
+
+
+def test_identical_files() -> None:
+    """Identical files have no differences."""
+    assert not compare(io.BytesIO(b"same"), io.BytesIO(b"same"), "a", "b")
@@ -0,0 +1,114 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for creating and applying delta packages."""
+
+import io
+import json
+import os
+import random
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pytest
+
+from build.delta import (
+    DELTA_INDEX_NAME,
+    DeltaError,
+    apply_delta,
+    generate_deltas,
+)
+from build.util import toltecmk_version
+
+from .helpers import write_ipk
+
+# Contents shared by both versions of the package, which do not compress
+SHARED = random.Random(0).randbytes(64 * 1024)
+
+
+def write_package(
+    path: Path, version: str, files: Dict[str, bytes], pkg_dir: Path
+) -> None:
+    """Write a package holding the given files."""
+    for name, data in files.items():
+        (pkg_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (pkg_dir / name).write_bytes(data)
+
+    write_ipk(str(path), f"Package: pkg\nVersion: {version}\n", str(pkg_dir))
+
+
+def make_versions(tmp_path: Path) -> Tuple[str, Dict[str, str]]:
+    """
+    Create two versions of a package that only differ by a small file.
+
+    :returns: repository holding the new version, and the path of the
+        previous version for the new one
+    """
+    base = tmp_path / "base" / "pkg_1.0-1_rmall.ipk"
+    write_package(
+        base,
+        "1.0-1",
+        {"opt/shared": SHARED, "opt/version": b"1"},
+        tmp_path / "tree-1",
+    )
+    repo_dir = tmp_path / "repo"
+    write_package(
+        repo_dir / "rmall" / "pkg_1.0-2_rmall.ipk",
+        "1.0-2",
+        {"opt/shared": SHARED, "opt/version": b"2"},
+        tmp_path / "tree-2",
+    )
+    return str(repo_dir), {"rmall/pkg_1.0-2_rmall.ipk": str(base)}
+
+
+def test_delta_rebuilds_package(tmp_path: Path) -> None:
+    """A delta rebuilds the new package and records the toltecmk version."""
+    repo_dir, bases = make_versions(tmp_path)
+
+    created = generate_deltas(repo_dir, bases)
+
+    assert len(created) == 1
+    entry = created[0]
+    assert entry.toltecmk == toltecmk_version()
+    target_path = os.path.join(repo_dir, "rmall", entry.target)
+    delta_path = os.path.join(repo_dir, "rmall", entry.delta)
+    assert entry.size < os.path.getsize(target_path)
+
+    rebuilt = io.BytesIO()
+    apply_delta(bases["rmall/pkg_1.0-2_rmall.ipk"], delta_path, rebuilt)
+
+    with open(target_path, "rb") as target:
+        assert rebuilt.getvalue() == target.read()
+
+    with open(
+        os.path.join(repo_dir, "rmall", DELTA_INDEX_NAME), encoding="utf-8"
+    ) as file:
+        assert json.load(file) == [entry._asdict()]
+
+
+def test_unsupported_toltecmk(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Only full packages are published with an unsupported toltecmk."""
+    monkeypatch.setattr("build.delta.SUPPORTED_TOLTECMK", ())
+    repo_dir, bases = make_versions(tmp_path)
+
+    assert not generate_deltas(repo_dir, bases)
+    assert os.listdir(os.path.join(repo_dir, "rmall")) == [
+        "pkg_1.0-2_rmall.ipk"
+    ]
+
+
+def test_delta_from_other_toltecmk(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Deltas created by another toltecmk version are not applied."""
+    repo_dir, bases = make_versions(tmp_path)
+    entry = generate_deltas(repo_dir, bases)[0]
+    monkeypatch.setattr("build.delta.toltecmk_version", lambda: "0.0.0")
+
+    with pytest.raises(DeltaError, match="toltecmk"):
+        apply_delta(
+            bases["rmall/pkg_1.0-2_rmall.ipk"],
+            os.path.join(repo_dir, "rmall", entry.delta),
+            io.BytesIO(),
+        )
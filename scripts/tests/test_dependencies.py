@@ -0,0 +1,78 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for the dependencies between recipes."""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from build.dependencies import DependencyIndex
+from build.recipes import load_recipes
+from build.repo import Repo
+
+from .helpers import write_recipes
+
+
+def make_repo(tmp_path: Path) -> Repo:
+    """Open a repository where lib is needed for building app and tool."""
+    recipe_dir = os.path.join(tmp_path, "recipes")
+
+    if not os.path.isdir(recipe_dir):
+        write_recipes(
+            recipe_dir,
+            ["lib", "app", "tool", "other"],
+            {"app": ["host:lib"], "tool": ["host:app", "build:other"]},
+        )
+
+    return Repo(
+        recipe_dir,
+        os.path.join(tmp_path, "repo"),
+        jobs=1,
+        lazy=True,
+        dependency_index=os.path.join(tmp_path, "dependencies.json"),
+    )
+
+
+def test_affected_recipes_match_impact(tmp_path: Path) -> None:
+    """Affected recipes are the ones reported by the dependency index."""
+    repo = make_repo(tmp_path)
+    index = DependencyIndex()
+    index.update(
+        repo.recipe_dir,
+        lambda names: load_recipes(repo.recipe_dir, names, 1),
+    )
+
+    assert repo.affected_recipes(["lib"]) == ["lib", "app", "tool"]
+    assert repo.affected_recipes(["lib"]) == list(index.impact(["lib"]))
+    assert repo.affected_recipes(["other", "unknown"]) == ["other"]
+
+
+def test_dependency_graph(tmp_path: Path) -> None:
+    """Only host dependencies on recipes from the list are edges."""
+    repo = make_repo(tmp_path)
+    names = ["app", "lib", "other", "tool"]
+
+    assert repo.dependency_graph(
+        [repo.generic_recipes[name] for name in names]
+    ) == {"app": ["lib"], "lib": [], "other": [], "tool": ["app"]}
+    assert [
+        os.path.basename(next(iter(bundle.values())).path)
+        for bundle in repo.order_dependencies(
+            [repo.generic_recipes[name] for name in names]
+        )
+    ][-2:] == ["app", "tool"]
+
+
+def test_persisted_index_is_reused(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Unchanged recipes are not parsed again to answer queries."""
+    make_repo(tmp_path).affected_recipes(["lib"])
+    repo = make_repo(tmp_path)
+
+    def fail(path: str) -> None:
+        raise AssertionError(f"Parsed {path}")
+
+    monkeypatch.setattr("build.recipes.parse_recipe", fail)
+    assert repo.affected_recipes(["lib"]) == ["lib", "app", "tool"]
@@ -0,0 +1,164 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for downloading files reliably from flaky servers."""
+
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from build.remote import (
+    CircuitBreaker,
+    DownloadError,
+    download,
+    make_session,
+)
+
+from .helpers import DROP, FakeRemote, read
+
+DATA = bytes(range(256)) * 400
+
+
+@pytest.fixture(autouse=True)
+def fixture_fast_retries(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Retry immediately, in small enough chunks to keep partial files."""
+    monkeypatch.setattr("build.remote.BACKOFF", 0.0)
+    monkeypatch.setattr("build.remote.CHUNK_SIZE", 1024)
+
+
+def test_resume_after_drop(remote: FakeRemote, tmp_path: Path) -> None:
+    """A dropped transfer is resumed where it stopped."""
+    remote.add("file", DATA)
+    remote.fail("file", DROP)
+
+    with make_session(1) as session:
+        assert download(session, f"{remote.url}/file", str(tmp_path / "file"))
+
+    assert read(tmp_path / "file") == DATA
+    assert os.listdir(tmp_path) == ["file"]
+
+    first, second = remote.requests
+    assert "Range" not in first.headers
+    assert second.headers["Range"] != "bytes=0-"
+    assert second.headers["If-Range"] == remote.etags["file"]
+    assert second.status == 206
+
+
+def test_retry_server_errors(remote: FakeRemote, tmp_path: Path) -> None:
+    """Transient server errors are retried."""
+    remote.add("file", DATA)
+    remote.fail("file", 503, 500)
+
+    with make_session(1) as session:
+        assert download(session, f"{remote.url}/file", str(tmp_path / "file"))
+
+    assert read(tmp_path / "file") == DATA
+    assert [request.status for request in remote.requests] == [503, 500, 200]
+
+
+def test_restart_when_changed(remote: FakeRemote, tmp_path: Path) -> None:
+    """A partial download of a file that changed since is started over."""
+    remote.add("file", DATA)
+    remote.fail("file", DROP)
+
+    with make_session(1) as session:
+        with pytest.raises(DownloadError):
+            download(
+                session, f"{remote.url}/file", str(tmp_path / "file"), retries=0
+            )
+
+        old_etag = remote.etags["file"]
+        remote.add("file", DATA[::-1], modified=2e9)
+        assert download(session, f"{remote.url}/file", str(tmp_path / "file"))
+
+    assert read(tmp_path / "file") == DATA[::-1]
+    assert os.listdir(tmp_path) == ["file"]
+    assert remote.requests[-1].headers["If-Range"] == old_etag
+    assert remote.requests[-1].status == 200
+
+
+def test_restart_without_validator(remote: FakeRemote, tmp_path: Path) -> None:
+    """A partial download whose origin is unknown is started over."""
+    remote.add("file", DATA)
+
+    with open(tmp_path / ".file.download", "wb") as file:
+        file.write(b"stale")
+
+    with make_session(1) as session:
+        assert download(session, f"{remote.url}/file", str(tmp_path / "file"))
+
+    assert read(tmp_path / "file") == DATA
+    assert "Range" not in remote.requests[0].headers
+
+
+def test_breaker_opens(remote: FakeRemote, tmp_path: Path) -> None:
+    """Requests stop once a server failed too many times in a row."""
+    remote.add("file", DATA)
+    remote.fail("file", *[503] * 10)
+    breaker = CircuitBreaker(threshold=2, cooldown=60.0)
+
+    with make_session(1) as session:
+        with pytest.raises(DownloadError, match="unavailable"):
+            download(
+                session,
+                f"{remote.url}/file",
+                str(tmp_path / "file"),
+                breaker=breaker,
+            )
+
+        assert remote.count("file") == 2
+
+        with pytest.raises(DownloadError, match="unavailable"):
+            download(
+                session,
+                f"{remote.url}/file",
+                str(tmp_path / "file"),
+                breaker=breaker,
+            )
+
+    assert remote.count("file") == 2
+
+
+def test_breaker_half_open(remote: FakeRemote, tmp_path: Path) -> None:
+    """A single probe is let through after the cool-down."""
+    remote.add("file", DATA)
+    remote.fail("file", 503)
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+
+    with make_session(1) as session:
+        with pytest.raises(DownloadError):
+            download(
+                session,
+                f"{remote.url}/file",
+                str(tmp_path / "file"),
+                breaker=breaker,
+                retries=0,
+            )
+
+        with pytest.raises(DownloadError, match="unavailable"):
+            breaker.check()
+
+        time.sleep(0.1)
+
+        # The first request after the cool-down probes the server, and
+        # the other ones are refused until it completes
+        breaker.check()
+
+        with pytest.raises(DownloadError, match="unavailable"):
+            breaker.check()
+
+        time.sleep(0.1)
+        assert download(
+            session,
+            f"{remote.url}/file",
+            str(tmp_path / "file"),
+            breaker=breaker,
+        )
+
+        # A successful probe closes the breaker
+        breaker.check()
+        breaker.check()
+
+    assert read(tmp_path / "file") == DATA
+    assert remote.count("file") == 2
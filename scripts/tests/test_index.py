@@ -0,0 +1,76 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for incrementally generating package indexes."""
+
+import gzip
+import os
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import pytest
+from toltec import ipk  # type: ignore
+
+from build.index import Indexer
+
+from .helpers import write_ipk
+
+
+def write_package(repo_dir: Path, name: str, tmp_path: Path) -> None:
+    """Write an empty package to the rmall directory of a repository."""
+    pkg_dir = tmp_path / "tree" / name
+    pkg_dir.mkdir(parents=True)
+    write_ipk(
+        str(repo_dir / "rmall" / f"{name}_1.0-1_rmall.ipk"),
+        f"Package: {name}\nVersion: 1.0-1\n",
+        str(pkg_dir),
+    )
+
+
+def read_index(repo_dir: Path) -> Tuple[bytes, bytes]:
+    """Read the plain and compressed indexes of the rmall directory."""
+    return (
+        (repo_dir / "rmall" / "Packages").read_bytes(),
+        (repo_dir / "rmall" / "Packages.gz").read_bytes(),
+    )
+
+
+def test_update_matches_full_rebuild(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Updating after changes gives the same index as a full rebuild."""
+    repo_dir = tmp_path / "repo"
+    cache_path = str(tmp_path / "index.json")
+
+    for name in ("a", "b"):
+        write_package(repo_dir, name, tmp_path)
+
+    Indexer(str(repo_dir), cache_path).update()
+
+    os.remove(repo_dir / "rmall" / "a_1.0-1_rmall.ipk")
+    write_package(repo_dir, "c", tmp_path)
+    opened: List[str] = []
+    reader = ipk.Reader
+
+    def count(path: str, *args: Any) -> Any:
+        opened.append(os.path.basename(path))
+        return reader(path, *args)
+
+    monkeypatch.setattr("build.index.ipk.Reader", count)
+    Indexer(str(repo_dir), cache_path).update()
+    monkeypatch.undo()
+
+    # Only the added package is read, using cached entries for the others
+    assert opened == ["c_1.0-1_rmall.ipk"]
+    updated, updated_gzip = read_index(repo_dir)
+    assert b"Package: a\n" not in updated
+    assert b"Package: c\n" in updated
+    assert gzip.decompress(updated_gzip) == updated
+    assert sorted(os.listdir(repo_dir / "rmall")) == [
+        "Packages",
+        "Packages.gz",
+        "b_1.0-1_rmall.ipk",
+        "c_1.0-1_rmall.ipk",
+    ]
+
+    Indexer(str(repo_dir)).update()
+    assert read_index(repo_dir) == (updated, updated_gzip)
@@ -0,0 +1,68 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for resuming repository builds from their journal."""
+
+import os
+from pathlib import Path
+
+from build.journal import Journal
+from build.scheduler import BuildStatus
+
+
+def build(journal: Journal, repo_dir: Path, recipe: str, key: str) -> None:
+    """Write the package of a recipe and record that it was built."""
+    filename = f"rmall/{recipe}_1.0-1_rmall.ipk"
+    (repo_dir / filename).parent.mkdir(parents=True, exist_ok=True)
+    (repo_dir / filename).write_bytes(recipe.encode())
+    journal.outcome(recipe, BuildStatus.Built, key, str(repo_dir), [filename])
+
+
+def test_truncated_line_is_ignored(tmp_path: Path) -> None:
+    """A last line cut short does not prevent resuming."""
+    path = str(tmp_path / "journal")
+    repo_dir = tmp_path / "repo"
+    build(Journal(path), repo_dir, "a", "key-a")
+
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"event": "outcome", "recipe": "b"')
+
+    journal = Journal(path, resume=True)
+
+    assert list(journal.previous) == ["a"]
+    assert journal.completed(str(repo_dir), {"a": "key-a"}) == ["a"]
+
+
+def test_start_clears_outcomes(tmp_path: Path) -> None:
+    """Outcomes recorded before a new build started are forgotten."""
+    path = str(tmp_path / "journal")
+    repo_dir = tmp_path / "repo"
+    build(Journal(path), repo_dir, "a", "key-a")
+
+    # Another build started in the same journal after the first one
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"event": "start"}\n')
+
+    journal = Journal(path, resume=True)
+
+    assert not journal.previous
+    assert not journal.completed(str(repo_dir), {"a": "key-a"})
+
+
+def test_outdated_packages_are_removed(tmp_path: Path) -> None:
+    """Packages of changed recipes or with altered contents are removed."""
+    path = str(tmp_path / "journal")
+    repo_dir = tmp_path / "repo"
+    journal = Journal(path)
+
+    for recipe in ("a", "b", "c"):
+        build(journal, repo_dir, recipe, f"key-{recipe}")
+
+    (repo_dir / "rmall" / "c_1.0-1_rmall.ipk").write_bytes(b"altered")
+    journal = Journal(path, resume=True)
+
+    completed = journal.completed(
+        str(repo_dir), {"a": "key-a", "b": "changed", "c": "key-c"}
+    )
+
+    assert completed == ["a"]
+    assert sorted(os.listdir(repo_dir / "rmall")) == ["a_1.0-1_rmall.ipk"]
@@ -0,0 +1,95 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for publishing repositories to a directory."""
+
+import os
+from pathlib import Path
+from typing import Dict
+
+from build.publish import MANIFEST_NAME, publish
+
+
+def make_repo(root: Path, files: Dict[str, bytes]) -> str:
+    """Create a repository holding the given files."""
+    for relpath, data in files.items():
+        path = root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    return str(root)
+
+
+def test_publish_is_idempotent(tmp_path: Path) -> None:
+    """Publishing the same repository again changes nothing."""
+    source = make_repo(
+        tmp_path / "source",
+        {
+            "rmall/a_1.0-1_rmall.ipk": b"a",
+            "rmall/Packages": b"Package: a\n",
+        },
+    )
+    target = str(tmp_path / "target")
+
+    first = publish(source, target, jobs=2)
+    assert first.copied == ["rmall/Packages", "rmall/a_1.0-1_rmall.ipk"]
+
+    inodes = {
+        relpath: os.stat(os.path.join(target, relpath)).st_ino
+        for relpath in first.copied
+    }
+    second = publish(source, target, jobs=2)
+
+    assert second.copied == second.linked == second.removed == []
+    assert inodes == {
+        relpath: os.stat(os.path.join(target, relpath)).st_ino
+        for relpath in first.copied
+    }
+    assert os.path.exists(os.path.join(target, MANIFEST_NAME))
+
+
+def test_publish_removes_stale_files(tmp_path: Path) -> None:
+    """Files that are not in the source anymore are removed."""
+    source = make_repo(tmp_path / "source", {"rmall/a_1.0-1_rmall.ipk": b"a"})
+    target = str(tmp_path / "target")
+    publish(source, target, jobs=2)
+
+    os.remove(os.path.join(source, "rmall/a_1.0-1_rmall.ipk"))
+    make_repo(tmp_path / "source", {"rmall/a_1.0-2_rmall.ipk": b"a2"})
+    stats = publish(source, target, jobs=2)
+
+    assert stats.copied == ["rmall/a_1.0-2_rmall.ipk"]
+    assert stats.removed == ["rmall/a_1.0-1_rmall.ipk"]
+    assert os.listdir(os.path.join(target, "rmall")) == ["a_1.0-2_rmall.ipk"]
+
+
+def test_publish_links_across_channels(tmp_path: Path) -> None:
+    """Files identical to another channel share its inode."""
+    files = {"rmall/a_1.0-1_rmall.ipk": b"a"}
+    stable = str(tmp_path / "stable")
+    testing = str(tmp_path / "testing")
+    publish(make_repo(tmp_path / "source-stable", files), stable, jobs=2)
+
+    stats = publish(
+        make_repo(tmp_path / "source-testing", files),
+        testing,
+        link_dests=[stable],
+        jobs=2,
+    )
+
+    assert stats.linked == ["rmall/a_1.0-1_rmall.ipk"]
+    assert not stats.copied
+    assert (
+        os.stat(os.path.join(stable, "rmall/a_1.0-1_rmall.ipk")).st_ino
+        == os.stat(os.path.join(testing, "rmall/a_1.0-1_rmall.ipk")).st_ino
+    )
+
+
+def test_publish_dry_run(tmp_path: Path) -> None:
+    """A dry run reports changes without making them."""
+    source = make_repo(tmp_path / "source", {"rmall/Packages": b""})
+    target = str(tmp_path / "target")
+
+    stats = publish(source, target, dry_run=True)
+
+    assert stats.copied == ["rmall/Packages"]
+    assert not os.path.exists(target)
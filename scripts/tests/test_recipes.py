@@ -0,0 +1,49 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for parsing recipes."""
+
+import os
+from pathlib import Path
+from typing import Any, Dict
+
+from toltec.recipe import RecipeBundle  # type: ignore
+
+from build.recipes import load_recipes
+
+from .helpers import write_recipes
+
+
+def describe(bundle: RecipeBundle) -> Dict[str, Any]:
+    """Summarize the parsed fields of a recipe, which refer to each other."""
+    return {
+        arch: (
+            recipe.path,
+            recipe.timestamp,
+            sorted(str(dep) for dep in recipe.makedepends),
+            recipe.build,
+            {
+                name: (package.filename(), package.control_fields())
+                for name, package in recipe.packages.items()
+            },
+        )
+        for arch, recipe in bundle.items()
+    }
+
+
+def test_parallel_parsing_matches_serial(tmp_path: Path) -> None:
+    """Parsing recipes in worker processes gives the same recipes."""
+    recipe_dir = os.path.join(tmp_path, "recipes")
+    names = ["lib", "app", "tool", "other"]
+    write_recipes(
+        recipe_dir,
+        names,
+        {"app": ["host:lib"], "tool": ["host:app", "build:other"]},
+    )
+
+    serial = load_recipes(recipe_dir, names, jobs=1)
+    parallel = load_recipes(recipe_dir, names, jobs=2)
+
+    assert list(parallel) == list(serial) == names
+    assert {name: describe(bundle) for name, bundle in parallel.items()} == {
+        name: describe(bundle) for name, bundle in serial.items()
+    }
@@ -0,0 +1,105 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for fetching packages from remote repositories."""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict
+
+from build.remote import download, make_session
+from build.repo import PackageStatus, Repo
+
+from .helpers import FakeRemote, write_recipes
+
+
+def publish_index(remote: FakeRemote, packages: Dict[str, bytes]) -> None:
+    """Publish packages for rmall along with their index."""
+    index = ""
+
+    for filename, data in packages.items():
+        remote.add(f"rmall/{filename}", data)
+        index += (
+            f"Package: {filename.split('_')[0]}\n"
+            f"Version: {filename.split('_')[1]}\n"
+            f"Filename: {filename}\n"
+            f"SHA256sum: {hashlib.sha256(data).hexdigest()}\n"
+            f"Size: {len(data)}\n\n"
+        )
+
+    remote.add("rmall/Packages", index.encode())
+
+
+def test_session_reuses_connection(remote: FakeRemote, tmp_path: Path) -> None:
+    """Sequential downloads through a session share a single connection."""
+    for number in range(5):
+        remote.add(f"file{number}", b"x" * 1000)
+
+    with make_session(1) as session:
+        for number in range(5):
+            assert download(
+                session,
+                f"{remote.url}/file{number}",
+                os.path.join(tmp_path, f"file{number}"),
+            )
+
+    assert len(remote.requests) == 5
+    assert len(remote.connections) == 1
+
+
+def test_fetch_packages_concurrently(
+    remote: FakeRemote, tmp_path: Path
+) -> None:
+    """Packages are fetched concurrently over a bounded connection pool."""
+    names = [f"pkg{number}" for number in range(8)]
+    recipe_dir = os.path.join(tmp_path, "recipes")
+    repo_dir = os.path.join(tmp_path, "repo")
+    write_recipes(recipe_dir, names)
+    published = {
+        f"{name}_1.0-1_rmall.ipk": name.encode() * 1000 for name in names[:6]
+    }
+    publish_index(remote, published)
+
+    repo = Repo(recipe_dir, repo_dir, jobs=1)
+    results = repo.fetch_packages(remote.url, jobs=3)
+
+    assert sorted(results[PackageStatus.Fetched]) == names[:6]
+    assert sorted(results[PackageStatus.Missing]) == names[6:]
+
+    for filename, data in published.items():
+        with open(os.path.join(repo_dir, "rmall", filename), "rb") as file:
+            assert file.read() == data
+
+    # One index download plus one request per package, over at most as
+    # many connections as concurrent jobs
+    assert remote.count("rmall/Packages") == 1
+    assert len(remote.connections) <= 3
+
+    # Packages that already exist locally are not requested again
+    before = len(remote.requests)
+    repo.fetch_packages(remote.url, jobs=3)
+    assert len(remote.requests) - before == len(names[6:])
+
+
+def test_keep_local_packages(remote: FakeRemote, tmp_path: Path) -> None:
+    """Local packages are kept even if they differ from the remote."""
+    recipe_dir = os.path.join(tmp_path, "recipes")
+    repo_dir = os.path.join(tmp_path, "repo")
+    write_recipes(recipe_dir, ["pkg"])
+    publish_index(remote, {"pkg_1.0-1_rmall.ipk": b"remote" * 1000})
+    local_path = os.path.join(repo_dir, "rmall", "pkg_1.0-1_rmall.ipk")
+    os.makedirs(os.path.dirname(local_path))
+
+    with open(local_path, "wb") as file:
+        file.write(b"local")
+
+    repo = Repo(recipe_dir, repo_dir, jobs=1)
+    results = repo.fetch_packages(remote.url, jobs=1)
+
+    assert not results[PackageStatus.Fetched]
+    assert not results[PackageStatus.Missing]
+
+    with open(local_path, "rb") as file:
+        assert file.read() == b"local"
+
+    assert remote.count("rmall/pkg_1.0-1_rmall.ipk") == 0
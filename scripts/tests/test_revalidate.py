@@ -0,0 +1,85 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for revalidating downloaded files against a remote."""
+
+import os
+from pathlib import Path
+
+from build.remote import download, make_session
+
+from .helpers import FakeRemote, read
+
+
+def fetch(remote: FakeRemote, tmp_path: Path, revalidate: bool) -> bool:
+    """Download a file from the remote, saving its validators."""
+    with make_session(1) as session:
+        return download(
+            session,
+            f"{remote.url}/file",
+            str(tmp_path / "file"),
+            metadata=str(tmp_path / "meta" / "file.json"),
+            revalidate=revalidate,
+        )
+
+
+def test_unchanged_file(remote: FakeRemote, tmp_path: Path) -> None:
+    """A file that did not change is not downloaded again."""
+    remote.add("file", b"old")
+    assert fetch(remote, tmp_path, revalidate=False)
+    mtime_ns = os.stat(tmp_path / "file").st_mtime_ns
+
+    assert not fetch(remote, tmp_path, revalidate=True)
+
+    request = remote.requests[-1]
+    assert request.headers["If-None-Match"] == remote.etags["file"]
+    assert request.status == 304
+    assert read(tmp_path / "file") == b"old"
+    assert os.stat(tmp_path / "file").st_mtime_ns == mtime_ns
+
+
+def test_changed_file(remote: FakeRemote, tmp_path: Path) -> None:
+    """A file that changed is downloaded again, with its new validators."""
+    remote.add("file", b"old")
+    assert fetch(remote, tmp_path, revalidate=False)
+    remote.add("file", b"new", modified=2e9)
+
+    assert fetch(remote, tmp_path, revalidate=True)
+    assert remote.requests[-1].status == 200
+    assert read(tmp_path / "file") == b"new"
+
+    # The validators of the new version are saved for the next check
+    assert not fetch(remote, tmp_path, revalidate=True)
+    assert remote.requests[-1].headers["If-None-Match"] == remote.etags["file"]
+    assert remote.requests[-1].status == 304
+
+
+def test_etag_mismatch(remote: FakeRemote, tmp_path: Path) -> None:
+    """A changed entity tag wins over an unchanged modification date."""
+    remote.add("file", b"old")
+    assert fetch(remote, tmp_path, revalidate=False)
+    old_etag = remote.etags["file"]
+    remote.add("file", b"new")
+
+    assert fetch(remote, tmp_path, revalidate=True)
+
+    request = remote.requests[-1]
+    assert request.headers["If-None-Match"] == old_etag
+    assert request.status == 200
+    assert read(tmp_path / "file") == b"new"
+
+
+def test_local_change(remote: FakeRemote, tmp_path: Path) -> None:
+    """Saved validators are ignored when the local copy changed."""
+    remote.add("file", b"old", modified=2e9)
+    assert fetch(remote, tmp_path, revalidate=False)
+
+    with open(tmp_path / "file", "wb") as file:
+        file.write(b"local")
+
+    os.utime(tmp_path / "file", (1e9, 1e9))
+    assert fetch(remote, tmp_path, revalidate=True)
+
+    request = remote.requests[-1]
+    assert "If-None-Match" not in request.headers
+    assert "If-Modified-Since" in request.headers
+    assert read(tmp_path / "file") == b"old"
@@ -0,0 +1,128 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for scheduling concurrent recipe builds."""
+
+from typing import Callable, Dict, List, Tuple
+
+from build.resources import ResourceBudget, Resources
+from build.scheduler import BuildStatus, Scheduler
+
+# Usages whose sum does not round-trip exactly in floating point
+LIGHT = [
+    Resources(cpus=0.909, memory=1.0),
+    Resources(cpus=1.105, memory=1.0),
+    Resources(cpus=1.219, memory=1.0),
+]
+
+HEAVY = Resources(cpus=8.0, memory=1.0)
+
+BUDGET = Resources(cpus=4.0, memory=float("inf"))
+
+# Recipe "a" is started first since it lies on the longest chain
+GRAPH: Dict[str, List[str]] = {"a": [], "b": [], "c": ["a"]}
+
+COSTS = {"a": 2.0, "b": 1.0, "c": 1.0}
+
+
+def test_budget_is_empty_after_releases() -> None:
+    """Releasing every reservation leaves nothing used."""
+    budget = ResourceBudget(BUDGET)
+
+    for usage in LIGHT:
+        budget.acquire(usage)
+
+    for usage in LIGHT:
+        budget.release(usage)
+
+    assert budget.used == Resources(0.0, 0.0)
+    assert budget.admits(HEAVY)
+
+
+def test_heavy_recipe_after_light_ones() -> None:
+    """A recipe clamped to the whole budget runs once the others finish."""
+    scheduler = Scheduler(
+        {"a": [], "b": [], "c": [], "heavy": ["a", "b", "c"]},
+        jobs=3,
+        usage={"a": LIGHT[0], "b": LIGHT[1], "c": LIGHT[2], "heavy": HEAVY},
+        budget=BUDGET,
+    )
+
+    results = scheduler.run(lambda name: True)
+
+    assert results == {
+        "a": BuildStatus.Built,
+        "b": BuildStatus.Built,
+        "c": BuildStatus.Built,
+        "heavy": BuildStatus.Built,
+    }
+
+
+def test_oversized_recipe_runs_alone() -> None:
+    """A recipe that never fits is still built when nothing else runs."""
+    scheduler = Scheduler({"huge": []}, jobs=2, budget=Resources(0.5, 1.0))
+
+    assert scheduler.run(lambda name: True) == {"huge": BuildStatus.Built}
+    assert scheduler.predict_makespan() == 0.0
+
+
+def fail_a(started: List[str]) -> Callable[[str], bool]:
+    """Make a build callback that records its calls and fails on "a"."""
+
+    def build(name: str) -> bool:
+        started.append(name)
+        return name != "a"
+
+    return build
+
+
+def test_failure_stops_new_builds() -> None:
+    """Nothing is started after a failure and the rest is skipped."""
+    started: List[str] = []
+    scheduler = Scheduler(GRAPH, jobs=1, costs=COSTS)
+
+    results = scheduler.run(fail_a(started))
+
+    assert started == ["a"]
+    assert results == {
+        "a": BuildStatus.Failed,
+        "b": BuildStatus.Skipped,
+        "c": BuildStatus.Skipped,
+    }
+
+
+def test_keep_going_after_failure() -> None:
+    """Recipes that do not depend on a failed one are still built."""
+    started: List[str] = []
+    scheduler = Scheduler(GRAPH, jobs=1, costs=COSTS)
+
+    results = scheduler.run(fail_a(started), keep_going=True)
+
+    assert started == ["a", "b"]
+    assert results == {
+        "a": BuildStatus.Failed,
+        "b": BuildStatus.Built,
+        "c": BuildStatus.Skipped,
+    }
+
+
+def test_crashed_build_fails() -> None:
+    """A build callback that raises counts as a failed build."""
+    done: List[Tuple[str, BuildStatus]] = []
+
+    def build(name: str) -> bool:
+        if name == "a":
+            raise RuntimeError("crash")
+
+        return True
+
+    scheduler = Scheduler(GRAPH, jobs=1, costs=COSTS)
+    results = scheduler.run(
+        build, on_done=lambda name, status: done.append((name, status))
+    )
+
+    assert done == [("a", BuildStatus.Failed)]
+    assert results == {
+        "a": BuildStatus.Failed,
+        "b": BuildStatus.Skipped,
+        "c": BuildStatus.Skipped,
+    }
@@ -0,0 +1,118 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""Tests for distributing builds through a shared queue directory."""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from build.workqueue import Job, WorkQueue
+
+
+def make_queue(root: Path) -> WorkQueue:
+    """Create an empty queue holding a single job."""
+    queue = WorkQueue(os.path.join(root, "queue"))
+    queue.reset()
+    queue.submit([Job("pkg", deps=[], arches=["rmall"], priority=1.0)])
+    return queue
+
+
+def entries(queue: WorkQueue, state: str) -> List[str]:
+    """List the job files of a queue in a given state."""
+    return sorted(os.listdir(os.path.join(queue.root, state)))
+
+
+def race(queue: WorkQueue, workers: int) -> List[Optional[Job]]:
+    """Make several workers claim a job at the same time."""
+    barrier = threading.Barrier(workers)
+    claims: List[Optional[Job]] = []
+
+    def claim(worker: str) -> None:
+        barrier.wait()
+        claims.append(queue.claim(worker))
+
+    threads = [
+        threading.Thread(target=claim, args=(f"worker{number}",))
+        for number in range(workers)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return claims
+
+
+def test_racing_workers_claim_once(tmp_path: Path) -> None:
+    """Exactly one of several workers racing for a job gets it."""
+    for attempt in range(20):
+        queue = make_queue(tmp_path / str(attempt))
+        claims = race(queue, workers=4)
+
+        assert [job.name for job in claims if job is not None] == ["pkg"]
+        assert len(entries(queue, "claimed")) == 1
+        assert not entries(queue, "pending")
+
+
+def test_expired_lease_is_reclaimed(tmp_path: Path) -> None:
+    """Jobs of a worker whose heartbeat stopped go to another worker."""
+    queue = make_queue(tmp_path)
+    job = queue.claim("dead")
+    assert job is not None
+    queue.heartbeat("dead")
+
+    # The first scan only records the heartbeat
+    assert not queue.requeue_dead(timeout=0.05)
+    time.sleep(0.1)
+    assert queue.requeue_dead(timeout=0.05) == ["pkg"]
+
+    assert queue.claim("alive") == job
+    assert queue.complete(job, "alive", success=True)
+
+    # The dead worker finishing late does not clobber the new claim
+    assert not queue.complete(job, "dead", success=False)
+    assert entries(queue, "done") == ["pkg.json"]
+    assert not entries(queue, "failed")
+
+
+def test_live_lease_is_kept(tmp_path: Path) -> None:
+    """Jobs of a worker whose heartbeat keeps changing are not requeued."""
+    queue = make_queue(tmp_path)
+    assert queue.claim("alive") is not None
+    beat = os.path.join(queue.root, "workers", "alive")
+    queue.heartbeat("alive")
+
+    for number in range(3):
+        queue.requeue_dead(timeout=0.05)
+        time.sleep(0.1)
+        os.utime(beat, (number + 1.0, number + 1.0))
+
+    assert not queue.requeue_dead(timeout=0.05)
+    assert entries(queue, "claimed") == ["pkg@alive.json"]
+
+
+def test_sync_prefers_artifacts(tmp_path: Path) -> None:
+    """Packages rebuilt under the same name replace the previous ones."""
+    queue = make_queue(tmp_path)
+    repo_dir = tmp_path / "repo"
+    before = tmp_path / "before"
+    (before / "rmall").mkdir(parents=True)
+    (before / "rmall" / "pkg.ipk").write_bytes(b"old")
+    queue.publish_base(str(before))
+
+    assert queue.sync(str(repo_dir)) == ["rmall"]
+    assert (repo_dir / "rmall" / "pkg.ipk").read_bytes() == b"old"
+
+    built = tmp_path / "built.ipk"
+    built.write_bytes(b"new")
+    os.utime(built, (2e9, 2e9))
+    queue.publish("pkg", "worker", [(str(built), "rmall/pkg.ipk")])
+
+    assert queue.sync(str(repo_dir)) == ["rmall"]
+    assert (repo_dir / "rmall" / "pkg.ipk").read_bytes() == b"new"
+    assert not queue.sync(str(repo_dir))
+    assert (repo_dir / "rmall" / "pkg.ipk").read_bytes() == b"new"
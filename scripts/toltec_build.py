@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Build packages and repositories, or plan what a build would do.
+
+Modules needed by a command are only imported when that command runs, so
+that getting help, or querying the dependencies between recipes while the
+dependency index is up to date, does not pay for loading the recipe
+parser along with the Docker and HTTP libraries. Planning a build needs
+the recipe parser, and therefore loads them too.
+"""
+
+import argparse
+import json
+import logging
+import os
+import runpy
+import sys
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+# pylint:disable=import-outside-toplevel
+
+# Same format as toltec.util.LOGGING_FORMAT, which is slow to import
+LOGGING_FORMAT = "[%(levelname)8s] %(name)s: %(message)s"
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Commands implemented by the other scripts of this directory
+SCRIPTS = {
+    "repo": ("repo_build.py", "build all packages and create a package index"),
+    "package": ("package_build.py", "build packages from a given recipe"),
+    "check": ("repo_check.py", "compare a local repository to a remote one"),
+    "publish": ("repo_publish.py", "publish a repository to a directory"),
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+def add_verbose_argument(
+    parser: argparse.ArgumentParser, default: int = logging.INFO
+) -> None:
+    """Add a CLI option for setting the verbosity level."""
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_const",
+        const=logging.DEBUG,
+        default=default,
+        help="show debugging information",
+    )
+
+
+def add_query_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the CLI options shared by the commands printing query results."""
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("text", "json"),
+        default="text",
+        help="output format (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--parse-jobs",
+        type=int,
+        metavar="N",
+        help="number of processes parsing recipes (default: one per CPU)",
+    )
+
+    # Only show warnings by default to keep the results readable
+    add_verbose_argument(parser, logging.WARNING)
+
+
+def run_script(command: str, argv: List[str]) -> None:
+    """Run the script implementing a command with the given arguments."""
+    path = os.path.join(SCRIPTS_DIR, SCRIPTS[command][0])
+    sys.argv = [f"{os.path.basename(sys.argv[0])} {command}"] + argv
+    runpy.run_path(path, run_name="__main__")
+
+
+def open_dependency_index(args: argparse.Namespace) -> Any:
+    """
+    Load the dependency index and update it with the recipes that changed.
+
+    :param args: options of the command
+    :returns: up-to-date :class:`DependencyIndex`
+    """
+    from build import paths
+    from build.dependencies import DependencyIndex
+
+    def load(names: List[str]) -> Dict[str, Any]:
+        from build.recipes import RecipeCache, load_recipes
+
+        return load_recipes(
+            paths.RECIPE_DIR,
+            names,
+            args.parse_jobs,
+            RecipeCache(os.path.join(paths.CACHE_DIR, "recipes")),
+        )
+
+    index = DependencyIndex(paths.DEPENDENCY_INDEX_PATH)
+    updated = index.update(paths.RECIPE_DIR, load)
+
+    if updated:
+        logger.info("Indexed the dependencies of %d recipes", len(updated))
+
+    return index
+
+
+def make_plan(  # pylint:disable=too-many-locals
+    args: argparse.Namespace,
+) -> Dict[str, Any]:
+    """
+    Decide which packages a repository build would fetch and build.
+
+    :param args: options of the plan command
+    :returns: packages to fetch and recipes to build in order
+    """
+    from build import paths
+    from build.changes import changed_paths, changed_recipes
+    from build.recipes import RecipeCache
+    from build.repo import PackageStatus, Repo
+    from build.scheduler import Scheduler
+    from build.stats import BuildStats
+
+    remote = args.remote_repo if not args.local else None
+    names: Optional[List[str]] = args.recipes or None
+
+    if args.changed is not None:
+        names = changed_recipes(changed_paths(args.changed))
+
+    repo = Repo(
+        paths.RECIPE_DIR,
+        paths.REPO_DIR,
+        jobs=args.parse_jobs,
+        lazy=names is not None or args.impact is not None,
+        cache=RecipeCache(os.path.join(paths.CACHE_DIR, "recipes")),
+        dependency_index=paths.DEPENDENCY_INDEX_PATH,
+    )
+
+    if args.impact:
+        names = list(repo.dependencies().impact(args.impact))
+
+    if names is not None:
+        unknown = [name for name in names if name not in repo.generic_recipes]
+
+        if unknown:
+            raise KeyError(f"Unknown recipe {', '.join(unknown)}")
+
+    if args.changed is not None and names is not None:
+        names = repo.affected_recipes(names)
+
+    results = repo.fetch_packages(remote, plan_only=True, names=names)
+    missing = results[PackageStatus.Missing]
+    missing_recipes = [repo.generic_recipes[name] for name in missing]
+
+    fetch = {
+        package.filename()
+        for arches in results[PackageStatus.Fetched].values()
+        for packages in arches.values()
+        for package in packages
+    }
+
+    if remote is not None:
+        fetch.update(
+            package.filename()
+            for package in repo.build_dependencies(missing_recipes)
+            if not os.path.isfile(
+                os.path.join(repo.repo_dir, package.filename())
+            )
+        )
+
+    stats = BuildStats(paths.STATS_PATH)
+    costs = {
+        name: stats.estimate(
+            (repo.generic_recipes[name][arch] for arch in missing[name]),
+        )
+        for name in missing
+    }
+    graph = repo.dependency_graph(missing_recipes)
+    scheduler = Scheduler(graph, args.jobs, costs)
+    order = [
+        os.path.basename(next(iter(generic_recipe.values())).path)
+        for generic_recipe in repo.order_dependencies(missing_recipes)
+    ]
+
+    return {
+        "fetch": sorted(fetch),
+        "build": [
+            {
+                "recipe": name,
+                "arches": list(missing[name]),
+                "after": sorted(set(graph[name])),
+                "estimate": costs[name],
+            }
+            for name in order
+        ],
+        "jobs": scheduler.jobs,
+        "predicted_duration": scheduler.predict_makespan(),
+    }
+
+
+def print_plan(plan: Dict[str, Any]) -> None:
+    """Print a build plan for humans."""
+    print(f"Fetch {len(plan['fetch'])} packages:")
+
+    for filename in plan["fetch"]:
+        print(f"  {filename}")
+
+    print(f"Build {len(plan['build'])} recipes, in order:")
+
+    for step in plan["build"]:
+        after = f" after {', '.join(step['after'])}" if step["after"] else ""
+        print(
+            f"  {step['recipe']} ({', '.join(step['arches'])}), "
+            f"~{step['estimate']:.0f} s{after}"
+        )
+
+    print(
+        f"Predicted build time with {plan['jobs']} jobs: "
+        f"{plan['predicted_duration']:.0f} s"
+    )
+
+
+def plan_command(args: argparse.Namespace) -> Any:
+    """Print what a repository build would fetch and build."""
+    plan = make_plan(args)
+
+    if args.format == "text":
+        print_plan(plan)
+
+    return plan
+
+
+def dependents_command(args: argparse.Namespace) -> Any:
+    """Print the recipes that depend on some recipes or packages."""
+    from build.dependencies import HOST, INSTALL
+
+    dependents = [
+        dependent
+        for dependent in open_dependency_index(args).dependents(
+            args.targets,
+            kinds=(HOST, INSTALL) if args.kind == "all" else (args.kind,),
+            transitive=not args.direct,
+        )
+        if args.arch is None or dependent.arch in args.arch
+    ]
+
+    if args.format == "text":
+        for dependent in dependents:
+            print(
+                f"{'  ' * (dependent.depth - 1)}{dependent.recipe} "
+                f"({dependent.arch}) needs {dependent.package} from "
+                f"{dependent.provider} [{dependent.kind}]"
+            )
+
+    return [dependent._asdict() for dependent in dependents]
+
+
+def impact_command(args: argparse.Namespace) -> Any:
+    """Print the recipes to rebuild when some recipes or packages change."""
+    impact = {
+        name: [
+            arch for arch in arches if args.arch is None or arch in args.arch
+        ]
+        for name, arches in open_dependency_index(args)
+        .impact(args.targets)
+        .items()
+    }
+    impact = {name: arches for name, arches in impact.items() if arches}
+
+    if args.format == "text":
+        for name, arches in impact.items():
+            print(f"{name} ({', '.join(arches)})")
+
+    return impact
+
+
+def run_query(args: argparse.Namespace) -> None:
+    """Run a command that prints results as text or JSON."""
+    logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+
+    try:
+        result = args.handler(args)
+    except KeyError as err:
+        logger.error("%s", err.args[0])
+        sys.exit(1)
+
+    if args.format == "json":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+def main() -> None:
+    """Parse the command line and run the selected command."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for command, (_, description) in SCRIPTS.items():
+        commands.add_parser(
+            command,
+            help=description,
+            add_help=False,
+            prefix_chars="\0",
+        )
+
+    plan = commands.add_parser(
+        "plan",
+        help="print what a repository build would fetch and build",
+        description="""Print the packages that a repository build would
+        download and the recipes it would build, in order, without
+        building anything.""",
+    )
+
+    plan.add_argument(
+        "recipes",
+        nargs="*",
+        metavar="RECIPENAME",
+        help="only plan for the given recipes (default: all recipes)",
+    )
+
+    plan.add_argument(
+        "-c",
+        "--changed",
+        metavar="REVRANGE",
+        help="""only plan for the recipes affected by the changes in a
+        range of Git revisions and the recipes that depend on them""",
+    )
+
+    plan.add_argument(
+        "-i",
+        "--impact",
+        nargs="+",
+        metavar="NAME",
+        help="""only plan for the recipes that must be rebuilt when the
+        given recipes or packages change""",
+    )
+
+    plan.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="""number of concurrent builds used for predicting the build
+        time (default: %(default)s)""",
+    )
+
+    add_query_arguments(plan)
+    plan.set_defaults(handler=plan_command)
+    remote = plan.add_mutually_exclusive_group()
+
+    remote.add_argument(
+        "-l",
+        "--local",
+        action="store_true",
+        help="plan as if no remote repository was available",
+    )
+
+    remote.add_argument(
+        "-r",
+        "--remote-repo",
+        default="https://toltec-dev.org/testing",
+        metavar="URL",
+        help="""root of the remote repository whose indexes tell which
+        packages are already built (default: %(default)s)""",
+    )
+
+    dependents = commands.add_parser(
+        "dependents",
+        help="print the recipes that depend on some recipes or packages",
+        description="""Print the recipes whose host build dependencies or
+        installation dependencies include the given recipes or packages,
+        along with the recipes that depend on those, and so on.""",
+    )
+
+    dependents.add_argument(
+        "targets",
+        nargs="+",
+        metavar="NAME",
+        help="names of the recipes or packages to look for",
+    )
+
+    dependents.add_argument(
+        "-k",
+        "--kind",
+        choices=("host", "install", "all"),
+        default="all",
+        help="kind of dependencies to follow (default: %(default)s)",
+    )
+
+    dependents.add_argument(
+        "--direct",
+        action="store_true",
+        help="only print the recipes that directly depend on the targets",
+    )
+
+    impact = commands.add_parser(
+        "impact",
+        help="print the recipes to rebuild when some recipes change",
+        description="""Print the recipes that must be rebuilt when the given
+        recipes or packages change, in an order in which they can be built,
+        with the architectures that need rebuilding.""",
+    )
+
+    impact.add_argument(
+        "targets",
+        nargs="+",
+        metavar="NAME",
+        help="names of the changed recipes or packages",
+    )
+
+    for query, handler in (
+        (dependents, dependents_command),
+        (impact, impact_command),
+    ):
+        query.add_argument(
+            "-a",
+            "--arch",
+            action="append",
+            metavar="ARCH",
+            help="only print results for the given arch (can be repeated)",
+        )
+
+        add_query_arguments(query)
+        query.set_defaults(handler=handler)
+
+    args, rest = parser.parse_known_args()
+
+    if args.command in SCRIPTS:
+        run_script(args.command, rest)
+    elif rest:
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    elif args.command == "plan" and (
+        sum(map(bool, (args.recipes, args.changed, args.impact))) > 1
+    ):
+        parser.error("recipe names, --changed and --impact cannot be combined")
+    else:
+        run_query(args)
+
+
+if __name__ == "__main__":
+    main()